@@ -2,38 +2,66 @@
 """
 🎨 AI Cover Generator - Генератор обложек для социальных сетей
 С системой регистрации, личными API токенами и Google OAuth
+
+Приложение создаёт create_app(config); модульный `app` оставлен для
+`gunicorn app:app`, asgi.py и `python app.py`. Импорт модуля не трогает диск
+и сеть: база данных, каталоги загрузок и Google OAuth инициализируются при
+первом использовании, тяжёлые библиотеки (authlib, requests, Pillow, smtplib)
+импортируются там, где нужны. Бюджет времени импорта проверяет
+`python bench/importtime.py`.
 """
 
-from flask import Flask, render_template, request, jsonify, session, redirect, url_for, send_from_directory
+from flask import (Blueprint, Flask, Request, current_app, g, has_app_context, render_template, request,
+                   jsonify, session, redirect, url_for, send_from_directory, stream_with_context)
 from flask_cors import CORS
-from authlib.integrations.flask_client import OAuth
+from markupsafe import Markup
 from werkzeug.utils import secure_filename
-import requests
 import time
 import os
 import uuid
+import mimetypes
 import hashlib
 import sqlite3
 import re
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
+import unicodedata
+import gzip
+import json
+import random
+import csv
+import io
+import bisect
+import zipfile
+import contextvars
 from datetime import datetime, timedelta
 from functools import wraps
+from contextlib import contextmanager
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+import threading
+import fcntl
+import logging
+import logging.handlers
+import queue
+import sys
+import atexit
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Все маршруты регистрируются на blueprint, create_app() подключает его к приложению
+bp = Blueprint('covers', __name__)
+
 
-app = Flask(__name__)
-app.secret_key = os.environ.get('SECRET_KEY', 'your-super-secret-key-change-me-in-production-12345')
-app.config['PERMANENT_SESSION_LIFETIME'] = 86400 * 30  # 30 дней
-# SESSION_COOKIE_SECURE только на HTTPS (проверяем по переменной окружения или hostname)
-app.config['SESSION_COOKIE_HTTPONLY'] = True  # Защита от XSS
-app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'  # Защита от CSRF
-CORS(app)
+class UploadRequest(Request):
+    """Пакетной загрузке разрешаем тело больше MAX_CONTENT_LENGTH (до 6 файлов по 16MB)"""
 
-# Устанавливаем SESSION_COOKIE_SECURE только если не localhost
-import socket
-hostname = socket.gethostname()
-if 'localhost' not in hostname and '127.0.0.1' not in hostname:
-    app.config['SESSION_COOKIE_SECURE'] = True
+    @property
+    def max_content_length(self):
+        if self.endpoint == 'covers.upload_batch':
+            return Config.MAX_BATCH_CONTENT_LENGTH
+        return super().max_content_length
 
 # ============ GOOGLE OAUTH CONFIG ============
 # Для настройки Google OAuth:
@@ -46,33 +74,360 @@ if 'localhost' not in hostname and '127.0.0.1' not in hostname:
 GOOGLE_CLIENT_ID = os.environ.get('GOOGLE_CLIENT_ID', '')
 GOOGLE_CLIENT_SECRET = os.environ.get('GOOGLE_CLIENT_SECRET', '')
 
-oauth = OAuth(app)
 
-if GOOGLE_CLIENT_ID and GOOGLE_CLIENT_SECRET:
-    google = oauth.register(
-        name='google',
-        client_id=GOOGLE_CLIENT_ID,
-        client_secret=GOOGLE_CLIENT_SECRET,
-        server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
-        client_kwargs={'scope': 'openid email profile'}
-    )
-else:
-    google = None
-
-# Конфигурация
-class Config:
-    KIE_API_URL = "https://api.kie.ai/api/v1/jobs"
-    OUTPUT_FOLDER = "/tmp/cover-generator"
-    UPLOAD_FOLDER = "/var/www/cover-generator/uploads"
-    DATABASE = "/var/www/cover-generator/users.db"
+def google_oauth_enabled():
+    return bool(GOOGLE_CLIENT_ID and GOOGLE_CLIENT_SECRET)
+
+
+def get_google():
+    """Клиент Google OAuth текущего приложения. authlib импортируется и клиент
+    регистрируется при первом входе через Google, а не при старте."""
+    if not google_oauth_enabled():
+        return None
+    google = current_app.extensions.get('covers_google')
+    if google is None:
+        from authlib.integrations.flask_client import OAuth
+        oauth = OAuth(current_app)
+        google = oauth.register(
+            name='google',
+            client_id=GOOGLE_CLIENT_ID,
+            client_secret=GOOGLE_CLIENT_SECRET,
+            server_metadata_url='https://accounts.google.com/.well-known/openid-configuration',
+            client_kwargs={'scope': 'openid email profile'}
+        )
+        current_app.extensions['covers_google'] = google
+    return google
+
+# Конфигурация по умолчанию (из окружения)
+class DefaultConfig:
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'your-super-secret-key-change-me-in-production-12345')
+    KIE_API_URL = os.environ.get('KIE_API_URL', "https://api.kie.ai/api/v1/jobs")
+    OPENAI_API_URL = os.environ.get('OPENAI_API_URL', "https://api.openai.com/v1/chat/completions")
+    OUTPUT_FOLDER = os.environ.get('OUTPUT_FOLDER', "/tmp/cover-generator")
+    UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', "/var/www/cover-generator/uploads")
+    DATABASE = os.environ.get('DATABASE', "/var/www/cover-generator/users.db")
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max file size
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
+    # Пакетная и докачиваемая загрузка
+    MAX_BATCH_FILES = 6
+    MAX_BATCH_CONTENT_LENGTH = MAX_BATCH_FILES * MAX_CONTENT_LENGTH
+    CHUNK_SIZE = 1024 * 1024  # рекомендуемый размер куска для клиента
+    MAX_CHUNK_SIZE = 8 * 1024 * 1024
+    CHUNKED_UPLOAD_TTL = timedelta(hours=24)  # незавершённые загрузки удаляются
+    # Сборщик мусора загрузок
+    UPLOAD_GC_INTERVAL = int(os.environ.get('UPLOAD_GC_INTERVAL', '600'))  # секунд, 0 - выключен
+    UPLOAD_GC_GRACE = int(os.environ.get('UPLOAD_GC_GRACE', str(24 * 3600)))  # секунд без использования
+    UPLOAD_USER_QUOTA = int(os.environ.get('UPLOAD_USER_QUOTA', str(200 * 1024 * 1024)))
+    UPLOAD_GLOBAL_QUOTA = int(os.environ.get('UPLOAD_GLOBAL_QUOTA', str(20 * 1024 * 1024 * 1024)))
+    UPLOAD_GC_SCAN_BATCH = 5000  # записей каталога за один проход
+    UPLOAD_GC_DELETE_BATCH = 1000
+    PUBLIC_URL = "https://2msp.webversy.top"
+    # ASGI режим (asgi.py): общий пул соединений к Kie.ai/OpenAI и потоки для шагов с БД
+    ASYNC_MAX_CONNECTIONS = int(os.environ.get('ASYNC_MAX_CONNECTIONS', '1000'))
+    ASYNC_STEP_WORKERS = int(os.environ.get('ASYNC_STEP_WORKERS', '32'))
+    # Синхронный режим: keep-alive соединений к одному хосту внешнего API на процесс
+    UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', '32'))
+    # Путь отмены задачи в Kie.ai относительно KIE_API_URL (например '/cancelTask').
+    # В публичном jobs API отмены нет - по умолчанию задача отменяется только у нас.
+    KIE_CANCEL_PATH = os.environ.get('KIE_CANCEL_PATH', '')
+    # Circuit breaker внешних API: окно статистики, порог ошибок/медленных вызовов
+    BREAKER_WINDOW = int(os.environ.get('BREAKER_WINDOW', '60'))  # секунд
+    BREAKER_MIN_CALLS = int(os.environ.get('BREAKER_MIN_CALLS', '10'))  # меньше - не судим
+    BREAKER_ERROR_RATE = float(os.environ.get('BREAKER_ERROR_RATE', '0.5'))
+    BREAKER_SLOW_RATE = float(os.environ.get('BREAKER_SLOW_RATE', '0.8'))
+    BREAKER_OPEN_SECONDS = int(os.environ.get('BREAKER_OPEN_SECONDS', '30'))  # до пробного вызова
+    BREAKER_SLOW_CALL = {'kie': 10.0, 'openai': 6.0}  # секунд, дольше - медленный вызов
+    # Повторы createTask при сбоях, после которых задача точно не создана
+    UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', '2'))
+    UPSTREAM_RETRY_BASE_DELAY = 0.5  # секунд, удваивается с каждой попыткой
+    UPSTREAM_RETRY_MAX_DELAY = 4.0
+    # Кэш статусов задач Kie.ai (recordInfo): общий для воркеров через SQLite + горячий слой в процессе
+    STATUS_CACHE_TTL = float(os.environ.get('STATUS_CACHE_TTL', '2'))  # секунд для незавершённых задач
+    STATUS_CACHE_HOT_SIZE = 2048  # записей в памяти процесса
+    STATUS_CACHE_MAX_ROWS = 20000  # записей в SQLite, лишние вытесняются по давности
+    STATUS_CACHE_LEASE = 35  # секунд: дольше таймаута recordInfo
+    # Ключи идемпотентности генераций (заголовок Idempotency-Key)
+    IDEMPOTENCY_TTL = timedelta(hours=24)
+    IDEMPOTENCY_WAIT = 120  # секунд ждём результат запроса-дубликата, который ещё выполняется
+    IDEMPOTENCY_LEASE = 180  # секунд: дольше генерации со всеми повторами createTask
+    # Метрики Prometheus (/metrics): воркеры складывают снимки в общий каталог
+    METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(OUTPUT_FOLDER, 'metrics'))
+    METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', '5'))  # секунд, 0 - только свой процесс
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')  # если задан - нужен Authorization: Bearer <токен>
+    SQLITE_BUSY_TIMEOUT = 60  # секунд ожидания при блокировке БД
+    # Журнал медленных SQL запросов (ожидание блокировки + выполнение)
+    SLOW_QUERY_SECONDS = float(os.environ.get('SLOW_QUERY_SECONDS', '0.1'))
+    SLOW_QUERY_MAX_ROWS = 500  # разных запросов в сводке slow_queries
+    # Заголовок Server-Timing на ответах генераций/статуса и поле timings в JSON (для отладки)
+    SERVER_TIMING = os.environ.get('SERVER_TIMING', '1') == '1'
+    DEBUG_TIMINGS = os.environ.get('DEBUG_TIMINGS', '0') == '1'
+    # Логи: JSON в stdout из фонового потока; частые события - выборочно
+    LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+    LOG_QUEUE_SIZE = 10000  # записей; при переполнении новые отбрасываются
+    LOG_SAMPLE_RATE = float(os.environ.get('LOG_SAMPLE_RATE', '0.05'))  # доля опросов статуса, статики
+    LOG_SLOW_REQUEST = 5.0  # секунд; медленные запросы логируются всегда
+    # Пакетная генерация: фоновый планировщик отправляет элементы в Kie.ai
+    BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '5000'))
+    BATCH_DEFAULT_CONCURRENCY = 3  # одновременных задач пакета в Kie.ai
+    BATCH_MAX_CONCURRENCY = int(os.environ.get('BATCH_MAX_CONCURRENCY', '10'))
+    BATCH_SUBMIT_RATE = float(os.environ.get('BATCH_SUBMIT_RATE', '2'))  # createTask в секунду на все пакеты
+    BATCH_TICK = float(os.environ.get('BATCH_TICK', '1'))  # секунд между проходами, 0 - выключен
+    BATCH_POLL_INTERVAL = 5  # секунд между опросами статуса одного элемента
+    BATCH_POLL_LIMIT = 200  # опросов за проход
+    BATCH_WORKERS = 8  # потоков отправки и опроса
+    BATCH_MAX_ATTEMPTS = 3  # попыток создать задачу при временных ошибках
+    BATCH_SUBMIT_TIMEOUT = 300  # секунд; дольше в submitting - воркер умер, элемент снова в очереди
+    # Сборка комикса из кадров в одно изображение
+    COMIC_FOLDER = os.environ.get('COMIC_FOLDER', os.path.join(OUTPUT_FOLDER, 'comics'))
+    COMIC_PANEL_MAX = int(os.environ.get('COMIC_PANEL_MAX', '1536'))  # длинная сторона кадра, px
+    COMIC_GUTTER = int(os.environ.get('COMIC_GUTTER', '24'))  # отступ между кадрами, px
+    COMIC_JPEG_QUALITY = int(os.environ.get('COMIC_JPEG_QUALITY', '88'))
+    COMIC_WORKERS = 2
+    COMIC_COMPOSE_TIMEOUT = 300  # секунд; дольше в composing - сборка потеряна
+    COMIC_STREAM_CHUNK = 256 * 1024
+    # Экспорт истории в ZIP
+    EXPORT_MAX_ITEMS = int(os.environ.get('EXPORT_MAX_ITEMS', '500'))
+    EXPORT_PREFETCH = int(os.environ.get('EXPORT_PREFETCH', '4'))  # картинок в памяти на один экспорт
+    EXPORT_WORKERS = 8
+    EXPORT_FETCH_TIMEOUT = 60
+    # Администраторы (статистика генераций и т.п.): email через запятую
+    ADMIN_EMAILS = {e.strip().lower() for e in os.environ.get('ADMIN_EMAILS', '').split(',') if e.strip()}
+    # Почасовые агрегаты генераций для статистики
+    ROLLUP_RETENTION = timedelta(days=int(os.environ.get('ROLLUP_RETENTION_DAYS', '90')))
+    STATS_MAX_HOURS = 24 * 90
+    # Профилирование запросов: заголовок X-Profile от администратора или доля запросов
+    PROFILE_HEADER = 'X-Profile'
+    PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))  # 0 - только по заголовку
+    PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', '0.005'))  # секунд между снимками стека
+    PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(OUTPUT_FOLDER, 'profiles'))
+    PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', '20'))  # на маршрут, последний хранится всегда
+    # Сколько секунд при остановке воркера ждать фоновые задачи
+    DRAIN_TIMEOUT = int(os.environ.get('DRAIN_TIMEOUT', '30'))
+    # Нормализация референсных фото перед отправкой в Kie.ai
+    REFERENCE_MAX_DIMENSION = int(os.environ.get('REFERENCE_MAX_DIMENSION', '2048'))
+    REFERENCE_JPEG_QUALITY = int(os.environ.get('REFERENCE_JPEG_QUALITY', '85'))
+    REFERENCE_WORKERS = int(os.environ.get('REFERENCE_WORKERS', '2'))
+    REFERENCE_WAIT_TIMEOUT = 20  # секунд ожидания нормализации при генерации
+    # Отдача загрузок: 'direct' (Flask + sendfile), 'x-accel' (nginx) или 'x-sendfile' (apache/lighttpd)
+    UPLOAD_SERVE_MODE = os.environ.get('UPLOAD_SERVE_MODE', 'direct')
+    UPLOAD_ACCEL_PREFIX = os.environ.get('UPLOAD_ACCEL_PREFIX', '/internal-uploads/')
+    UPLOAD_CACHE_MAX_AGE = 31536000  # год - имена с UUID никогда не меняются
+    # Статика: собирается build_assets.py в static/dist с хэшами в именах
+    STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+    ASSET_DIST_FOLDER = os.path.join(STATIC_FOLDER, 'dist')
+    ASSET_CACHE_MAX_AGE = 31536000
+    # Динамическое сжатие HTML/JSON ответов
+    COMPRESS_MIN_SIZE = 1024
+    COMPRESS_MIMETYPES = {'text/html', 'application/json'}
+
+
+class AppConfig:
+    """Настройки текущего приложения: переопределения create_app(config) поверх
+    DefaultConfig. Вне контекста приложения (импорт модуля, поток без контекста)
+    действуют значения по умолчанию"""
+
+    def __getattr__(self, name):
+        if has_app_context():
+            overrides = current_app.extensions.get('covers_config')
+            if overrides and name in overrides:
+                return overrides[name]
+        return getattr(DefaultConfig, name)
+
+
+Config = AppConfig()
+
+
+def in_app_context(func):
+    """Оборачивает функцию для фонового потока или пула: она выполнится в контексте
+    текущего приложения и увидит его Config, а не значения по умолчанию"""
+    if not has_app_context():
+        return func
+    flask_app = current_app._get_current_object()
+
+    @wraps(func)
+    def run(*args, **kwargs):
+        with flask_app.app_context():
+            return func(*args, **kwargs)
+    return run
+
+
+class AppState:
+    """Изменяемое состояние приложения: фоновые потоки, пулы, кэши и флаг остановки.
+    Живёт в app.extensions['covers_state'] рядом с covers_config, так что у второго
+    приложения в процессе свои потоки и пулы нужного размера, свои кэши и своя
+    остановка. Общими на процесс остаются метрики, профилировщик, кэш статусов
+    Kie.ai и HTTP сессия к внешним API"""
+
+    def __init__(self, setting):
+        self.init_lock = threading.Lock()
+        self.initialized = set()  # 'storage', 'db' - уже созданы для этого приложения
+        self.shutdown_event = threading.Event()  # выставляется при остановке воркера
+        self.asset_manifest = None
+        self.fragment_cache = {}  # имя шаблона -> готовый HTML
+        self.fragment_lock = threading.Lock()
+        self.metrics_flush_thread = None
+        self.upload_gc_thread = None
+        self.upload_gc_scan = None  # итератор os.scandir, живёт между проходами
+        self.batch_scheduler_thread = None
+        # Пулы не создают потоков до первой задачи
+        self.normalize_executor = ThreadPoolExecutor(max_workers=setting('REFERENCE_WORKERS'),
+                                                     thread_name_prefix='normalize')
+        self.normalize_jobs = {}  # filename -> Future
+        self.normalize_lock = threading.Lock()
+        self.upstream_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='upstream')
+        self.export_executor = ThreadPoolExecutor(max_workers=setting('EXPORT_WORKERS'), thread_name_prefix='export')
+        self.comic_executor = ThreadPoolExecutor(max_workers=setting('COMIC_WORKERS'), thread_name_prefix='comic')
+        self.batch_executor = ThreadPoolExecutor(max_workers=setting('BATCH_WORKERS'), thread_name_prefix='batch')
+
+
+def app_state():
+    """Состояние текущего приложения; вне контекста - модульного app (как у Config)"""
+    return (current_app if has_app_context() else app).extensions['covers_state']
+
+
+# ============ ЛОГИРОВАНИЕ ============
+# Структурированные JSON логи (одна строка - один объект). Поток запроса только
+# кладёт запись в очередь; в stdout пишет фоновый поток QueueListener, так что
+# медленный вывод не задерживает ответы. Переполненная очередь отбрасывает
+# записи (covers_log_dropped_total). В каждую запись попадают request_id и
+# user_id текущего запроса - они лежат в contextvar и видны в потоках flow.
+# Частые события (опросы статуса, статика, /metrics) пишутся с вероятностью
+# LOG_SAMPLE_RATE, ошибки и медленные запросы - всегда.
+
+logger = logging.getLogger('covers')
+log_context = contextvars.ContextVar('log_context', default=None)  # {'request_id', 'user_id'}
+traceback_formatter = logging.Formatter()
+
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname.lower(),
+            'event': getattr(record, 'event', 'message'),
+            'msg': record.getMessage(),
+            'pid': record.process,
+        }
+        entry.update(getattr(record, 'context', None) or {})
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class BackgroundLogHandler(logging.handlers.QueueHandler):
+    """Очередь + поток вывода, свои в каждом процессе. Поток стартует при первой
+    записи: импорт модуля не запускает потоков, а после fork очередь и поток
+    мастера не используются."""
+
+    def __init__(self):
+        super().__init__(None)
+        self.listener = None
+        self.pid = None
+        self.start_lock = threading.Lock()
 
-os.makedirs(Config.OUTPUT_FOLDER, exist_ok=True)
-os.makedirs(Config.UPLOAD_FOLDER, exist_ok=True)
+    def start(self):
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue(maxsize=Config.LOG_QUEUE_SIZE)
+            output = logging.StreamHandler(sys.stdout)
+            output.setFormatter(JsonLogFormatter())
+            self.listener = logging.handlers.QueueListener(self.queue, output)
+            self.listener.start()
+            self.pid = os.getpid()
 
-app.config['UPLOAD_FOLDER'] = Config.UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = Config.MAX_CONTENT_LENGTH
+    def stop(self):
+        """Дописывает очередь и останавливает поток (при остановке воркера)"""
+        with self.start_lock:
+            if self.listener is not None and self.pid == os.getpid():
+                self.listener.stop()
+            self.listener, self.pid = None, None
+
+    def prepare(self, record):
+        # На потоке запроса - только то, что нельзя отложить: текст, трейсбек, контекст
+        record.context = log_context.get()
+        record.msg, record.args = record.getMessage(), None
+        if record.exc_info:
+            record.exc_text = traceback_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.inc('covers_log_dropped_total')
+
+
+log_handler = BackgroundLogHandler()
+logger.addHandler(log_handler)
+logger.setLevel(Config.LOG_LEVEL)
+logger.propagate = False
+atexit.register(log_handler.stop)
+
+
+def log_event(event, msg='', level=logging.INFO, exc_info=False, **fields):
+    """Структурированная запись: event - имя события, fields - поля (task_id, *_ms...)"""
+    logger.log(level, msg, exc_info=exc_info, extra={'event': event, 'fields': fields})
+
+
+# Маршруты, которые дёргаются постоянно: их запросы логируются выборочно
+SAMPLED_LOG_ROUTES = {'/api/status/<task_id>', '/covers/api/status/<task_id>',
+                      '/covers/assets/<path:filename>', '/covers/uploads/<filename>',
+                      '/metrics', '/covers/metrics'}
+
+
+def log_request(route, method, status_code, seconds, stages=None):
+    """Строка access лога с длительностями этапов (Server-Timing)"""
+    sampled = route in SAMPLED_LOG_ROUTES
+    if (sampled and status_code < 400 and seconds < Config.LOG_SLOW_REQUEST
+            and random.random() >= Config.LOG_SAMPLE_RATE):
+        return
+    fields = {'route': route, 'method': method, 'status': status_code,
+              'duration_ms': round(seconds * 1000, 1)}
+    if stages:
+        fields['stages_ms'] = stages
+    if sampled:
+        fields['sample_rate'] = Config.LOG_SAMPLE_RATE
+    log_event('request', f'{method} {route} {status_code}',
+              level=logging.WARNING if status_code >= 500 else logging.INFO, **fields)
+
+
+def start_log_context(request_id=None, user_id=None):
+    """Контекст логов запроса; request_id из X-Request-ID клиента или прокси, иначе новый"""
+    request_id = (request_id or '')[:64] or uuid.uuid4().hex[:16]
+    log_context.set({'request_id': request_id, 'user_id': user_id})
+    return request_id
+
+
+# ============ ЛЕНИВАЯ ИНИЦИАЛИЗАЦИЯ ============
+# Каталоги и схема БД создаются при первом использовании (один раз на приложение и процесс)
+
+def ensure_storage():
+    """Создаёт каталоги загрузок и временных файлов"""
+    state = app_state()
+    if 'storage' in state.initialized:
+        return
+    with state.init_lock:
+        if 'storage' not in state.initialized:
+            os.makedirs(Config.OUTPUT_FOLDER, exist_ok=True)
+            os.makedirs(Config.UPLOAD_FOLDER, exist_ok=True)
+            os.makedirs(os.path.join(Config.UPLOAD_FOLDER, '.partial'), exist_ok=True)
+            state.initialized.add('storage')
+
+
+def ensure_db():
+    """Создаёт схему БД перед первым соединением"""
+    state = app_state()
+    if 'db' in state.initialized:
+        return
+    with state.init_lock:
+        if 'db' not in state.initialized:
+            init_db()
+            state.initialized.add('db')
 
 # Инициализация базы данных
 def init_db():
@@ -128,22 +483,286 @@ def init_db():
         c.execute('ALTER TABLE users ADD COLUMN google_id TEXT')
     except:
         pass
+    # Незавершённые докачиваемые загрузки (общие для всех воркеров)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS chunked_uploads (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            filename TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_chunked_uploads_created ON chunked_uploads (created_at)')
+    # Учёт загруженных файлов и ссылок генераций на них (для сборщика мусора)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS uploads (
+            filename TEXT PRIMARY KEY,
+            user_id INTEGER,
+            ref_filename TEXT,
+            bytes INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_uploads_last_used ON uploads (last_used_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_uploads_user_last_used ON uploads (user_id, last_used_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_uploads_ref ON uploads (ref_filename)')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS upload_refs (
+            task_id TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            PRIMARY KEY (task_id, filename)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_upload_refs_filename ON upload_refs (filename)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_generations_task ON generations (task_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_generations_status ON generations (status)')
+    # Удалённая генерация (clear_history, очистка старой истории) освобождает свои фото
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS generations_release_uploads
+        AFTER DELETE ON generations
+        BEGIN
+            DELETE FROM upload_refs WHERE task_id = OLD.task_id;
+        END
+    ''')
+    # Ключи идемпотентности генераций: повтор запроса возвращает ту же задачу
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            user_id INTEGER NOT NULL,
+            key TEXT NOT NULL,
+            endpoint TEXT NOT NULL,
+            request_hash TEXT NOT NULL,
+            state TEXT NOT NULL DEFAULT 'pending',
+            status_code INTEGER,
+            response_json TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, key)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created ON idempotency_keys (created_at)')
+    # Аренда pending ключа: воркер, упавший посреди генерации, не держит ключ вечно
+    try:
+        c.execute('ALTER TABLE idempotency_keys ADD COLUMN lease_until REAL NOT NULL DEFAULT 0')
+    except sqlite3.OperationalError:
+        pass
+    # Общий кэш ответов recordInfo и аренда "кто сейчас опрашивает Kie.ai"
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS status_cache (
+            cache_key TEXT PRIMARY KEY,
+            payload TEXT,
+            terminal INTEGER NOT NULL DEFAULT 0,
+            fetched_at REAL NOT NULL DEFAULT 0,
+            lease_until REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_status_cache_fetched ON status_cache (fetched_at)')
+    # Жизненный цикл генерации (unix время) и разрешение - для аналитики
+    for column in ('resolution TEXT', 'submitted_at REAL', 'running_at REAL', 'completed_at REAL',
+                   'upstream_seconds REAL'):
+        try:
+            c.execute(f'ALTER TABLE generations ADD COLUMN {column}')
+        except sqlite3.OperationalError:
+            pass
+    # Почасовые агрегаты завершённых генераций и гистограмма их длительности
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS generation_rollups (
+            bucket INTEGER NOT NULL,
+            platform TEXT NOT NULL,
+            resolution TEXT NOT NULL,
+            style TEXT NOT NULL,
+            total INTEGER NOT NULL DEFAULT 0,
+            success INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            cancelled INTEGER NOT NULL DEFAULT 0,
+            latency_sum REAL NOT NULL DEFAULT 0,
+            latency_count INTEGER NOT NULL DEFAULT 0,
+            queue_sum REAL NOT NULL DEFAULT 0,
+            queue_count INTEGER NOT NULL DEFAULT 0,
+            upstream_sum REAL NOT NULL DEFAULT 0,
+            upstream_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, platform, resolution, style)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS generation_latency (
+            bucket INTEGER NOT NULL,
+            platform TEXT NOT NULL,
+            resolution TEXT NOT NULL,
+            style TEXT NOT NULL,
+            le_index INTEGER NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, platform, resolution, style, le_index)
+        )
+    ''')
+    # Сводка медленных SQL запросов всех воркеров
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS slow_queries (
+            fingerprint TEXT PRIMARY KEY,
+            sql TEXT NOT NULL,
+            plan TEXT,
+            count INTEGER NOT NULL DEFAULT 0,
+            total_seconds REAL NOT NULL DEFAULT 0,
+            max_seconds REAL NOT NULL DEFAULT 0,
+            lock_wait_seconds REAL NOT NULL DEFAULT 0,
+            execution_seconds REAL NOT NULL DEFAULT 0,
+            last_seen REAL NOT NULL DEFAULT 0
+        )
+    ''')
+    # Пакетная генерация: пакеты и их элементы
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS batches (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            total INTEGER NOT NULL,
+            concurrency INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            finished_at REAL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_batches_user ON batches (user_id, created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_batches_status ON batches (status)')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS batch_items (
+            batch_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            prompt TEXT NOT NULL,
+            platform TEXT NOT NULL,
+            style TEXT NOT NULL,
+            format TEXT NOT NULL,
+            image_urls TEXT,
+            status TEXT NOT NULL,
+            task_id TEXT,
+            image_url TEXT,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            claimed_at REAL,
+            polled_at REAL,
+            PRIMARY KEY (batch_id, position)
+        )
+    ''')
+    # Пакет, пока идёт, держит фото своих элементов (upload_refs с task_id 'batch:<id>'):
+    # у элементов в очереди ещё нет генераций. Завершённый или отменённый пакет их отпускает
+    c.execute('''
+        CREATE TRIGGER IF NOT EXISTS batches_release_uploads
+        AFTER UPDATE OF status ON batches WHEN NEW.status != 'running'
+        BEGIN
+            DELETE FROM upload_refs WHERE task_id = 'batch:' || NEW.id;
+        END
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_batch_items_status ON batch_items (batch_id, status)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_batch_items_polled ON batch_items (status, polled_at)')
+    # Комиксы: собранное изображение и кадры (задачи Kie.ai), из которых оно собрано
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS comics (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            layout TEXT NOT NULL,
+            status TEXT NOT NULL,
+            panels INTEGER NOT NULL,
+            filename TEXT,
+            width INTEGER,
+            height INTEGER,
+            bytes INTEGER,
+            error TEXT,
+            created_at REAL NOT NULL,
+            claimed_at REAL,
+            composed_at REAL,
+            FOREIGN KEY (user_id) REFERENCES users (id)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS comic_panels (
+            comic_id TEXT NOT NULL,
+            block INTEGER NOT NULL,
+            task_id TEXT NOT NULL,
+            PRIMARY KEY (comic_id, block)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_comic_panels_task ON comic_panels (task_id)')
     conn.commit()
+    init_history_search(conn)
     conn.close()
 
-init_db()
+
+# Замены сверх unicode61 (он не считает ё вариантом е). Применяются к тексту в
+# индексе (search_fold_sql) и в search_fold - к запросу и при ранжировании
+SEARCH_FOLD_CHARS = (('ё', 'е'), ('Ё', 'Е'))
+
+
+def search_fold_sql(expression):
+    """SQL выражение для текста в индексе поиска: expression с заменами SEARCH_FOLD_CHARS"""
+    for old, new in SEARCH_FOLD_CHARS:
+        expression = f"replace({expression}, '{old}', '{new}')"
+    return expression
+
+
+def init_history_search(conn):
+    """Полнотекстовый индекс истории и триггеры синхронизации с generations.
+    Индекс contentless: тексты читаются из generations, в FTS только словарь."""
+    c = conn.cursor()
+    # Под блокировкой записи: воркеры без preload не заполнят индекс дважды
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        c.execute("SELECT 1 FROM sqlite_master WHERE name = 'generations_fts'")
+        if c.fetchone() is None:
+            # unicode61 приводит к нижнему регистру кириллицу и латиницу и убирает латинские
+            # диакритики; ё на е заменяем сами (search_fold_sql), search_fold повторяет
+            # то же для запроса. Префиксные индексы:
+            # короткий префикс раскрывается в тысячи слов, а так читается одним списком
+            c.execute('''
+                CREATE VIRTUAL TABLE generations_fts USING fts5(
+                    prompt, platform, style, user_id,
+                    content='', tokenize='unicode61 remove_diacritics 2', prefix='2 3 4'
+                )
+            ''')
+            c.execute(f'INSERT INTO generations_fts (rowid, prompt, platform, style, user_id) '
+                      f'SELECT id, {search_fold_sql("prompt")}, platform, style, user_id FROM generations')
+        # Из contentless индекса удаляют, передавая те же значения колонок, что и при вставке
+        new_prompt, old_prompt = search_fold_sql('new.prompt'), search_fold_sql('old.prompt')
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS generations_fts_insert AFTER INSERT ON generations BEGIN
+                INSERT INTO generations_fts (rowid, prompt, platform, style, user_id)
+                VALUES (new.id, {new_prompt}, new.platform, new.style, new.user_id);
+            END
+        ''')
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS generations_fts_delete AFTER DELETE ON generations BEGIN
+                INSERT INTO generations_fts (generations_fts, rowid, prompt, platform, style, user_id)
+                VALUES ('delete', old.id, {old_prompt}, old.platform, old.style, old.user_id);
+            END
+        ''')
+        c.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS generations_fts_update
+            AFTER UPDATE OF prompt, platform, style, user_id ON generations BEGIN
+                INSERT INTO generations_fts (generations_fts, rowid, prompt, platform, style, user_id)
+                VALUES ('delete', old.id, {old_prompt}, old.platform, old.style, old.user_id);
+                INSERT INTO generations_fts (rowid, prompt, platform, style, user_id)
+                VALUES (new.id, {new_prompt}, new.platform, new.style, new.user_id);
+            END
+        ''')
+        c.execute('COMMIT')
+    except sqlite3.OperationalError as e:
+        # SQLite без FTS5 - приложение работает, поиск отвечает 503
+        c.execute('ROLLBACK')
+        log_event('history_search_disabled', f"Поиск по истории недоступен: {e}", level=logging.WARNING)
+
 
 def get_db():
     """Получить соединение с БД с правильными настройками для многопользовательского доступа"""
+    ensure_db()
     conn = sqlite3.connect(
         Config.DATABASE, 
-        timeout=60,  # Увеличенный таймаут
+        timeout=0,  # Ожидание блокировки (до SQLITE_BUSY_TIMEOUT) делает MeteredCursor
         check_same_thread=False,  # Разрешить многопоточность
-        isolation_level=None  # Autocommit режим
+        isolation_level=None,  # Autocommit режим
+        factory=MeteredConnection  # Время запросов и ожидания блокировок в метриках
     )
     conn.row_factory = sqlite3.Row
     conn.execute('PRAGMA journal_mode=WAL')
-    conn.execute('PRAGMA busy_timeout=60000')  # 60 секунд ожидания при блокировке
     conn.execute('PRAGMA synchronous=NORMAL')  # Быстрее, но безопасно
     return conn
 
@@ -153,7 +772,1151 @@ def hash_password(password):
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in Config.ALLOWED_EXTENSIONS
 
-def fix_prompt_with_openai(prompt, openai_token):
+
+# ============ МЕТРИКИ PROMETHEUS ============
+# Счётчики и гистограммы пишутся в шард текущего потока (threading.local) без
+# блокировок: на горячем пути только поиск в dict и сложение под GIL. Шарды
+# складываются при чтении /metrics. Воркеры раз в METRICS_FLUSH_INTERVAL секунд
+# сбрасывают свой снимок в METRICS_DIR/<pid>.json, и /metrics суммирует снимки
+# живых процессов - любой воркер отдаёт метрики всего сервера. Когда воркер
+# перезапускается, его счётчики пропадают из суммы (для rate() это обычный сброс).
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SQLITE_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1, 5)
+
+# имя -> (тип, описание, границы корзин гистограммы)
+METRICS = {
+    'covers_http_requests_total': ('counter', 'HTTP запросы по маршруту, методу и коду ответа', None),
+    'covers_http_request_duration_seconds': ('histogram', 'Время обработки HTTP запроса', LATENCY_BUCKETS),
+    'covers_upstream_requests_total': ('counter', 'Вызовы Kie.ai/OpenAI по коду ответа '
+                                       '(exception - нет ответа, rejected - отказ breaker)', None),
+    'covers_upstream_errors_total': ('counter', 'Неудачные вызовы Kie.ai/OpenAI (5xx, 429, сбой сети, breaker)', None),
+    'covers_upstream_request_duration_seconds': ('histogram', 'Время вызова Kie.ai/OpenAI', LATENCY_BUCKETS),
+    'covers_upstream_breaker_open': ('gauge', 'Число процессов, где breaker внешнего API разомкнут', None),
+    'covers_upstream_breaker_opened_total': ('counter', 'Сколько раз breaker размыкался', None),
+    'covers_status_cache_events_total': ('counter', 'Обращения к кэшу статусов recordInfo', None),
+    'covers_sqlite_query_duration_seconds': ('histogram', 'Время выполнения SQL без ожидания блокировки', SQLITE_BUCKETS),
+    'covers_sqlite_lock_wait_seconds': ('histogram', 'Ожидание блокировки SQLite (database is locked)', SQLITE_BUCKETS),
+    'covers_upload_bytes_total': ('counter', 'Байт принято в загрузках фото', None),
+    'covers_uploads_stored_bytes': ('gauge', 'Байт в учтённых загрузках на диске', None),
+    'covers_generations_active': ('gauge', 'Незавершённые генерации по состоянию', None),
+    'covers_sqlite_slow_queries_total': ('counter', 'SQL запросы дольше SLOW_QUERY_SECONDS', None),
+    'covers_log_dropped_total': ('counter', 'Записи лога, отброшенные из-за переполненной очереди', None),
+}
+
+
+class MetricsRegistry:
+    """Метрики процесса: у каждого потока свой шард (counters, histograms)"""
+
+    def __init__(self):
+        self.collectors = []  # функции, отдающие (тип, имя, метки, значение) при чтении
+        self.reset()
+
+    def reset(self):
+        # После fork шарды мастера воркеру не нужны
+        self.local = threading.local()
+        self.shards = []
+        self.shards_lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self.local.shard
+        except AttributeError:
+            shard = self.local.shard = ({}, {})
+            with self.shards_lock:  # один раз на поток
+                self.shards.append(shard)
+            return shard
+
+    def inc(self, name, labels=(), value=1):
+        counters = self._shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        histograms = self._shard()[1]
+        key = (name, labels)
+        buckets = METRICS[name][2]
+        entry = histograms.get(key)
+        if entry is None:
+            # счётчики корзин, +Inf, сумма
+            entry = histograms[key] = [0] * (len(buckets) + 1) + [0.0]
+        entry[bisect.bisect_left(buckets, value)] += 1
+        entry[-1] += value
+
+    def snapshot(self):
+        """{'counters', 'gauges', 'histograms'}: {(имя, метки): значение} по всем потокам"""
+        counters, gauges, histograms = {}, {}, {}
+        with self.shards_lock:
+            shards = list(self.shards)
+        for shard_counters, shard_histograms in shards:
+            for key, value in list(shard_counters.items()):
+                counters[key] = counters.get(key, 0) + value
+            for key, entry in list(shard_histograms.items()):
+                entry = list(entry)
+                total = histograms.setdefault(key, [0] * len(entry))
+                for i, value in enumerate(entry):
+                    total[i] += value
+        for collect in self.collectors:
+            for kind, name, labels, value in collect():
+                target = gauges if kind == 'gauge' else counters
+                target[(name, labels)] = target.get((name, labels), 0) + value
+        return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+
+metrics = MetricsRegistry()
+os.register_at_fork(after_in_child=metrics.reset)
+
+
+def dump_metrics_snapshot(snapshot):
+    return {kind: [[name, [list(pair) for pair in labels], value]
+                   for (name, labels), value in values.items()]
+            for kind, values in snapshot.items()}
+
+
+def load_metrics_snapshot(data):
+    return {kind: {(name, tuple(tuple(pair) for pair in labels)): value for name, labels, value in values}
+            for kind, values in data.items()}
+
+
+def merge_metrics_snapshots(snapshots):
+    merged = {'counters': {}, 'gauges': {}, 'histograms': {}}
+    for snapshot in snapshots:
+        for kind in ('counters', 'gauges'):
+            for key, value in snapshot.get(kind, {}).items():
+                merged[kind][key] = merged[kind].get(key, 0) + value
+        for key, entry in snapshot.get('histograms', {}).items():
+            total = merged['histograms'].get(key)
+            if total is None or len(total) != len(entry):
+                merged['histograms'][key] = list(entry)
+            else:
+                for i, value in enumerate(entry):
+                    total[i] += value
+    return merged
+
+
+def flush_metrics():
+    """Сбрасывает снимок процесса в METRICS_DIR для соседних воркеров"""
+    os.makedirs(Config.METRICS_DIR, exist_ok=True)
+    path = os.path.join(Config.METRICS_DIR, f'{os.getpid()}.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(dump_metrics_snapshot(metrics.snapshot()), f)
+    os.replace(path + '.tmp', path)
+
+
+def metrics_flush_loop():
+    while not app_state().shutdown_event.wait(Config.METRICS_FLUSH_INTERVAL):
+        try:
+            flush_metrics()
+            flush_slow_queries()
+        except (OSError, sqlite3.Error) as e:
+            log_event('metrics_flush_failed', f"Ошибка записи метрик: {e}", level=logging.WARNING)
+
+
+def start_metrics_flush():
+    """Запускает сброс снимков метрик в текущем процессе (как start_upload_gc)"""
+    state = app_state()
+    if Config.METRICS_FLUSH_INTERVAL <= 0 or state.shutdown_event.is_set():
+        return
+    if state.metrics_flush_thread is not None and state.metrics_flush_thread.is_alive():
+        return
+    state.metrics_flush_thread = threading.Thread(target=in_app_context(metrics_flush_loop), name='metrics-flush',
+                                                  daemon=True)
+    state.metrics_flush_thread.start()
+
+
+def forget_metrics_snapshot():
+    """Убирает снимок завершающегося воркера из суммы"""
+    try:
+        os.remove(os.path.join(Config.METRICS_DIR, f'{os.getpid()}.json'))
+    except OSError:
+        pass
+
+
+def worker_metrics_snapshots():
+    """Снимки других живых процессов из METRICS_DIR; снимки умерших удаляются"""
+    snapshots = []
+    if Config.METRICS_FLUSH_INTERVAL <= 0:
+        return snapshots
+    stale_after = max(60, Config.METRICS_FLUSH_INTERVAL * 10)
+    try:
+        entries = list(os.scandir(Config.METRICS_DIR))
+    except OSError:
+        return snapshots
+    for entry in entries:
+        name, ext = os.path.splitext(entry.name)
+        if ext != '.json' or not name.isdigit() or int(name) == os.getpid():
+            continue
+        try:
+            alive = time.time() - entry.stat().st_mtime < stale_after
+            if alive:
+                os.kill(int(name), 0)
+        except ProcessLookupError:
+            alive = False
+        except PermissionError:
+            pass
+        except OSError:
+            continue
+        try:
+            if not alive:
+                os.remove(entry.path)
+                continue
+            with open(entry.path) as f:
+                snapshots.append(load_metrics_snapshot(json.load(f)))
+        except (OSError, ValueError):
+            continue
+    return snapshots
+
+
+def record_request_metrics(route, method, status_code, seconds):
+    metrics.inc('covers_http_requests_total', (('route', route), ('method', method), ('status', str(status_code))))
+    metrics.observe('covers_http_request_duration_seconds', (('route', route), ('method', method)), seconds)
+
+
+def collect_db_metrics():
+    """Метрики из БД - считаются один раз при чтении /metrics, а не в каждом воркере"""
+    conn = get_db()
+    try:
+        marks = ','.join('?' * len(ACTIVE_STATUSES))
+        counts = dict.fromkeys(ACTIVE_STATUSES, 0)
+        for row in conn.execute(f'SELECT status, COUNT(*) FROM generations WHERE status IN ({marks}) '
+                                f'GROUP BY status', ACTIVE_STATUSES):
+            counts[row[0]] = row[1]
+        stored = conn.execute('SELECT COALESCE(SUM(bytes), 0) FROM uploads').fetchone()[0]
+    finally:
+        conn.close()
+    gauges = {('covers_generations_active', (('state', state),)): count for state, count in counts.items()}
+    gauges[('covers_uploads_stored_bytes', ())] = stored
+    return {'gauges': gauges}
+
+
+def format_metric_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+
+def render_metrics(snapshot):
+    """Текстовый формат Prometheus 0.0.4"""
+    by_name = {}
+    for kind in ('counters', 'gauges', 'histograms'):
+        for (name, labels), value in snapshot.get(kind, {}).items():
+            by_name.setdefault(name, []).append((labels, value))
+    lines = []
+    for name in sorted(by_name):
+        kind, help_text, buckets = METRICS[name]
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in sorted(by_name[name]):
+            if kind != 'histogram':
+                lines.append(f'{name}{format_metric_labels(labels)} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ['+Inf'], value[:-1]):
+                cumulative += count
+                lines.append(f'{name}_bucket{format_metric_labels(labels, [("le", bound)])} {cumulative}')
+            lines.append(f'{name}_sum{format_metric_labels(labels)} {value[-1]}')
+            lines.append(f'{name}_count{format_metric_labels(labels)} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+@bp.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    g.request_id = start_log_context(request.headers.get('X-Request-ID'), session.get('user_id'))
+
+
+@bp.after_app_request
+def record_request(response):
+    # Регистрируется раньше compress_response, поэтому выполняется после него и сжатие входит во время
+    started = g.get('request_started')
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        seconds = time.perf_counter() - started
+        record_request_metrics(route, request.method, response.status_code, seconds)
+        timings = g.get('stage_timings')
+        log_request(route, request.method, response.status_code, seconds,
+                    timings.durations() if timings is not None else None)
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+
+@bp.teardown_app_request
+def clear_log_context(error=None):
+    # Потоки gunicorn переиспользуются - контекст запроса не должен достаться следующему
+    log_context.set(None)
+
+
+def metrics_token_valid():
+    return request.headers.get('Authorization') == f'Bearer {Config.METRICS_TOKEN}'
+
+
+def operator_required(f):
+    """Служебные эндпоинты: мониторинг с Bearer METRICS_TOKEN или администратор в сессии"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if Config.METRICS_TOKEN and metrics_token_valid():
+            return f(*args, **kwargs)
+        if 'user_id' not in session:
+            return jsonify({'error': 'Нужен токен метрик или вход администратора'}), 401
+        if not is_admin(session['user_id']):
+            return jsonify({'error': 'Доступ только для администраторов'}), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+@bp.route('/metrics')
+@bp.route('/covers/metrics')
+def metrics_endpoint():
+    """Метрики всех воркеров в формате Prometheus"""
+    if Config.METRICS_TOKEN and not metrics_token_valid():
+        return jsonify({'error': 'Нужен токен метрик'}), 401
+    snapshots = [metrics.snapshot()] + worker_metrics_snapshots()
+    try:
+        snapshots.append(collect_db_metrics())
+    except sqlite3.Error as e:
+        log_event('metrics_db_failed', f"Ошибка сбора метрик БД: {e}", level=logging.WARNING)
+    return current_app.response_class(render_metrics(merge_metrics_snapshots(snapshots)),
+                                      content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+# ============ ТАЙМИНГИ ЗАПРОСОВ (Server-Timing) ============
+# Ответы flow эндпоинтов (генерации, статус, generate-prompt) несут заголовок
+# Server-Timing с разбивкой по этапам: db, prompt-fix, openai, kie-submit,
+# kie-status, render и total. Таймеры лежат в contextvar запроса: драйверы flow
+# копируют контекст в потоки, где выполняются шаги и параллельные вызовы, так что
+# SQL и вызовы внешних API находят таймеры своего запроса в любом потоке.
+# Длительность этапа - объединение интервалов: параллельные вызовы не суммируются.
+
+TIMING_STAGES = ('db', 'prompt-fix', 'openai', 'kie-submit', 'kie-status', 'render')
+KIE_TIMING_STAGES = {'createTask': 'kie-submit', 'recordInfo': 'kie-status'}
+
+
+class StageTimings:
+    """Интервалы этапов одного запроса"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.intervals = {}  # этап -> [(начало, конец)]
+
+    def add(self, stage, started, ended):
+        # list.append атомарен - параллельные вызовы пишут без блокировки
+        self.intervals.setdefault(stage, []).append((started, ended))
+
+    def durations(self):
+        """{этап: мс} в порядке TIMING_STAGES, плюс total"""
+        result = {}
+        for stage in TIMING_STAGES + tuple(s for s in self.intervals if s not in TIMING_STAGES):
+            intervals = sorted(self.intervals.get(stage, ()))
+            if not intervals:
+                continue
+            total, (start, end) = 0.0, intervals[0]
+            for next_start, next_end in intervals[1:]:
+                if next_start > end:
+                    total += end - start
+                    start, end = next_start, next_end
+                else:
+                    end = max(end, next_end)
+            result[stage] = round((total + end - start) * 1000, 1)
+        result['total'] = round((time.perf_counter() - self.started) * 1000, 1)
+        return result
+
+    def header(self):
+        return ', '.join(f'{stage};dur={ms}' for stage, ms in self.durations().items())
+
+
+request_timings = contextvars.ContextVar('request_timings', default=None)
+
+
+@contextmanager
+def timed_stage(stage):
+    """Засекает этап текущего запроса (вне flow эндпоинта ничего не делает)"""
+    timings = request_timings.get()
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(stage, started, time.perf_counter())
+
+
+def timed_response_body(body, timings):
+    """Тело ответа с полем timings, если включён DEBUG_TIMINGS"""
+    if Config.DEBUG_TIMINGS and isinstance(body, dict):
+        return dict(body, timings=timings.durations())
+    return body
+
+
+# Время SQL и ожидание блокировок: соединения get_db() создаются с busy_timeout=0,
+# и повтор при SQLITE_BUSY выполняет MeteredCursor, поэтому ожидание блокировки
+# измеряется отдельно от самого запроса. Внутри открытой транзакции BUSY не ждём:
+# отложенная транзакция со старым снимком WAL не получит запись никогда (SQLite
+# в этом случае и сам не вызывает busy handler), её надо откатить и начать заново.
+# BEGIN IMMEDIATE выполняется вне транзакции и ждёт блокировку как обычно.
+# Для SELECT учитывается шаг до первой строки.
+SQLITE_BUSY_ERRORS = ('database is locked', 'database table is locked', 'database is busy')
+SQLITE_STATEMENTS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'PRAGMA', 'CREATE', 'WITH'}
+
+
+def execute_metered(connection, method, sql, parameters):
+    first = attempt = time.perf_counter()
+    delay = 0.001
+    while True:
+        try:
+            result = method(sql, parameters)
+            break
+        except sqlite3.OperationalError as e:
+            if (not str(e).startswith(SQLITE_BUSY_ERRORS) or connection.in_transaction
+                    or attempt - first >= Config.SQLITE_BUSY_TIMEOUT):
+                raise
+        time.sleep(delay)
+        delay = min(delay * 2, 0.1)
+        attempt = time.perf_counter()
+    done = time.perf_counter()
+    timings = request_timings.get()
+    if timings is not None:
+        timings.add('db', first, done)
+    statement = sql.lstrip()[:7].split(None, 1)[0].upper() if sql.strip() else ''
+    labels = (('statement', statement if statement in SQLITE_STATEMENTS else 'OTHER'),)
+    metrics.observe('covers_sqlite_query_duration_seconds', labels, done - attempt)
+    if attempt > first:
+        metrics.observe('covers_sqlite_lock_wait_seconds', labels, attempt - first)
+    if done - first >= Config.SLOW_QUERY_SECONDS:
+        record_slow_query(method, sql, parameters, labels[0][1], attempt - first, done - attempt)
+    return result
+
+
+class MeteredCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        return execute_metered(self.connection, super().execute, sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return execute_metered(self.connection, super().executemany, sql, seq_of_parameters)
+
+
+class MeteredConnection(sqlite3.Connection):
+    def cursor(self, factory=MeteredCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+# ============ МЕДЛЕННЫЕ ЗАПРОСЫ SQLITE ============
+# Запрос дольше SLOW_QUERY_SECONDS (ожидание блокировки + выполнение) пишется в
+# лог событием slow_query: SQL без литералов, от параметров - только типы.
+# Для каждого нового медленного запроса один раз в процессе снимается EXPLAIN
+# QUERY PLAN. Сводка копится в памяти процесса, и поток метрик сбрасывает её в
+# таблицу slow_queries: писать в БД из самого запроса нельзя - он может
+# выполняться внутри транзакции, и запись ждала бы её окончания.
+
+SQL_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+SQL_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+SQL_PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+EXPLAIN_STATEMENTS = {'SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH'}
+slow_query_lock = threading.Lock()
+slow_query_pending = {}  # отпечаток -> сводка с прошлого сброса
+slow_query_plans = {}  # отпечаток -> план; есть ключ - план уже снимали
+
+
+def normalize_sql(sql):
+    """SQL без литералов и с одинаковыми списками IN (...) - один отпечаток на запрос"""
+    sql = SQL_STRING_LITERAL.sub('?', sql)
+    sql = SQL_NUMBER_LITERAL.sub('?', sql)
+    sql = SQL_PLACEHOLDER_LIST.sub('(...)', sql)
+    return ' '.join(sql.split())
+
+
+def redacted_parameters(parameters, many):
+    if many:
+        return 'batch'
+    if isinstance(parameters, dict):
+        return {name: type(value).__name__ for name, value in parameters.items()}
+    return [type(value).__name__ for value in parameters]
+
+
+def explain_query_plan(connection, sql, parameters):
+    # Обычный курсор - чтобы сам EXPLAIN не попадал в метрики и журнал
+    try:
+        rows = sqlite3.Cursor(connection).execute(f'EXPLAIN QUERY PLAN {sql}', parameters).fetchall()
+    except sqlite3.Error:
+        return None
+    return [row[3] for row in rows]
+
+
+def record_slow_query(method, sql, parameters, statement, lock_wait, execution):
+    many = method.__name__ == 'executemany'
+    normalized = normalize_sql(sql)
+    fingerprint = hashlib.sha1(normalized.encode('utf-8')).hexdigest()[:16]
+    with slow_query_lock:
+        explain = fingerprint not in slow_query_plans
+        if explain:
+            slow_query_plans[fingerprint] = None
+    plan = None
+    if explain and statement in EXPLAIN_STATEMENTS:
+        # Наборы executemany уже прочитаны - план по NULL вместо значений, он от них не зависит
+        plan = explain_query_plan(method.__self__.connection, sql,
+                                  [None] * sql.count('?') if many else parameters)
+        with slow_query_lock:
+            slow_query_plans[fingerprint] = plan
+
+    seconds = lock_wait + execution
+    with slow_query_lock:
+        entry = slow_query_pending.setdefault(fingerprint, {
+            'sql': normalized, 'plan': None, 'count': 0, 'total': 0.0, 'max': 0.0,
+            'lock_wait': 0.0, 'execution': 0.0, 'last_seen': 0.0})
+        entry['count'] += 1
+        entry['total'] += seconds
+        entry['max'] = max(entry['max'], seconds)
+        entry['lock_wait'] += lock_wait
+        entry['execution'] += execution
+        entry['last_seen'] = time.time()
+        if plan is not None:
+            entry['plan'] = plan
+    metrics.inc('covers_sqlite_slow_queries_total', (('statement', statement),))
+    log_event('slow_query', f"Медленный SQL {seconds * 1000:.0f}мс: {normalized[:200]}",
+              level=logging.WARNING, fingerprint=fingerprint, sql=normalized,
+              params=redacted_parameters(parameters, many),
+              lock_wait_ms=round(lock_wait * 1000, 1), execution_ms=round(execution * 1000, 1),
+              **({'plan': plan} if plan is not None else {}))
+
+
+def flush_slow_queries():
+    """Добавляет накопленную сводку процесса в slow_queries (общую для воркеров)"""
+    with slow_query_lock:
+        pending = list(slow_query_pending.items())
+        slow_query_pending.clear()
+    if not pending:
+        return
+    conn = get_db()
+    try:
+        conn.executemany('''
+            INSERT INTO slow_queries (fingerprint, sql, plan, count, total_seconds, max_seconds,
+                                      lock_wait_seconds, execution_seconds, last_seen)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (fingerprint) DO UPDATE SET
+                plan = COALESCE(excluded.plan, plan),
+                count = count + excluded.count,
+                total_seconds = total_seconds + excluded.total_seconds,
+                max_seconds = max(max_seconds, excluded.max_seconds),
+                lock_wait_seconds = lock_wait_seconds + excluded.lock_wait_seconds,
+                execution_seconds = execution_seconds + excluded.execution_seconds,
+                last_seen = excluded.last_seen
+        ''', [(fingerprint, entry['sql'], json.dumps(entry['plan'], ensure_ascii=False) if entry['plan'] else None,
+               entry['count'], entry['total'], entry['max'], entry['lock_wait'], entry['execution'],
+               entry['last_seen']) for fingerprint, entry in pending])
+        conn.execute('''
+            DELETE FROM slow_queries WHERE fingerprint IN (
+                SELECT fingerprint FROM slow_queries ORDER BY last_seen
+                LIMIT max(0, (SELECT COUNT(*) FROM slow_queries) - ?)
+            )
+        ''', (Config.SLOW_QUERY_MAX_ROWS,))
+    finally:
+        conn.close()
+
+
+# ============ НОРМАЛИЗАЦИЯ РЕФЕРЕНСНЫХ ФОТО ============
+# Kie.ai скачивает каждое референсное фото с нашего сервера (до 6 на кадр комикса),
+# поэтому в image_prompts отдаём уменьшенную копию без EXIF, а не 16MB оригинал.
+
+REFERENCE_SUFFIX = '.ref'
+
+normalize_stats = {'files': 0, 'original_bytes': 0, 'normalized_bytes': 0, 'seconds': 0.0}
+normalize_stats_lock = threading.Lock()
+
+
+def normalize_upload(filename):
+    """Уменьшает фото, применяет ориентацию из EXIF и пересохраняет без метаданных.
+    Возвращает имя нормализованного файла или None если оставляем оригинал."""
+    try:
+        from PIL import Image, ImageOps
+    except ImportError:
+        return None
+
+    started = time.time()
+    filepath = os.path.join(Config.UPLOAD_FOLDER, filename)
+    stem = os.path.splitext(filename)[0]
+    try:
+        with Image.open(filepath) as img:
+            if getattr(img, 'is_animated', False):
+                return None
+            img = ImageOps.exif_transpose(img)
+            img.thumbnail((Config.REFERENCE_MAX_DIMENSION, Config.REFERENCE_MAX_DIMENSION),
+                          Image.LANCZOS)
+
+            has_alpha = img.mode in ('RGBA', 'LA') or (img.mode == 'P' and 'transparency' in img.info)
+            if has_alpha:
+                # JPEG не умеет прозрачность - используем WebP
+                normalized = f"{stem}{REFERENCE_SUFFIX}.webp"
+                img.convert('RGBA').save(os.path.join(Config.UPLOAD_FOLDER, normalized),
+                                         'WEBP', quality=Config.REFERENCE_JPEG_QUALITY, method=4)
+            else:
+                normalized = f"{stem}{REFERENCE_SUFFIX}.jpg"
+                img.convert('RGB').save(os.path.join(Config.UPLOAD_FOLDER, normalized),
+                                        'JPEG', quality=Config.REFERENCE_JPEG_QUALITY,
+                                        optimize=True, progressive=True)
+    except Exception as e:
+        log_event('normalize_failed', f"Ошибка нормализации {filename}: {e}", level=logging.WARNING,
+                  filename=filename)
+        return None
+
+    original_size = os.path.getsize(filepath)
+    normalized_size = os.path.getsize(os.path.join(Config.UPLOAD_FOLDER, normalized))
+    if normalized_size >= original_size:
+        # Оригинал уже компактный - отдаём его
+        os.remove(os.path.join(Config.UPLOAD_FOLDER, normalized))
+        normalized, normalized_size = None, original_size
+
+    if normalized:
+        conn = get_db()
+        conn.execute('UPDATE uploads SET ref_filename = ?, bytes = bytes + ? WHERE filename = ?',
+                     (normalized, normalized_size, filename))
+        conn.close()
+    
+    elapsed = time.time() - started
+    with normalize_stats_lock:
+        normalize_stats['files'] += 1
+        normalize_stats['original_bytes'] += original_size
+        normalize_stats['normalized_bytes'] += normalized_size
+        normalize_stats['seconds'] += elapsed
+    log_event('upload_normalized', f"🖼️ Нормализовано {filename}: {original_size} → {normalized_size} байт",
+              filename=filename, original_bytes=original_size, normalized_bytes=normalized_size,
+              duration_ms=round(elapsed * 1000, 1))
+    return normalized
+
+
+def schedule_normalization(filename):
+    """Ставит файл в очередь пула нормализации"""
+    state = app_state()
+    with state.normalize_lock:
+        future = state.normalize_executor.submit(in_app_context(normalize_upload), filename)
+        state.normalize_jobs[filename] = future
+    future.add_done_callback(lambda f: _forget_normalize_job(state, filename, f))
+    return future
+
+
+def _forget_normalize_job(state, filename, future):
+    # Результат уже лежит на диске, держать Future в памяти больше не нужно
+    with state.normalize_lock:
+        if state.normalize_jobs.get(filename) is future:
+            del state.normalize_jobs[filename]
+
+
+def reference_filename(filename):
+    """Имя файла, которое нужно отдавать в image_prompts (нормализованное если есть)"""
+    stem = os.path.splitext(filename)[0]
+    for ext in ('.jpg', '.webp'):
+        candidate = f"{stem}{REFERENCE_SUFFIX}{ext}"
+        if os.path.exists(os.path.join(Config.UPLOAD_FOLDER, candidate)):
+            return candidate
+    return filename
+
+
+def normalization_pending(filenames):
+    state = app_state()
+    with state.normalize_lock:
+        return any(filename in state.normalize_jobs and not state.normalize_jobs[filename].done()
+                   for filename in filenames)
+
+
+def process_image_urls_flow(image_urls, limit):
+    """Чистит список ссылок на фото и превращает локальные загрузки в полные URL
+    на нормализованные копии. Если фото только что загружено и ещё нормализуется,
+    flow ждёт паузами FlowPause (драйвер не держит поток) до REFERENCE_WAIT_TIMEOUT,
+    затем отдаёт оригинал"""
+    urls = []
+    for url in image_urls:
+        url = url.strip()
+        if not url:
+            continue
+        if len(urls) >= limit:
+            break
+        urls.append(url)
+    # Локальные загрузки: /covers/uploads/<имя файла>
+    local = {url: secure_filename(url[len('/covers/uploads/'):])
+             for url in urls if url.startswith('/covers/uploads/')}
+    deadline = time.time() + Config.REFERENCE_WAIT_TIMEOUT
+    while normalization_pending(local.values()) and time.time() < deadline:
+        yield FlowPause(0.1)
+    return [f"{Config.PUBLIC_URL}/covers/uploads/{reference_filename(local[url])}" if url in local else url
+            for url in urls]
+
+# ============ ВЫЗОВЫ ВНЕШНИХ API ============
+# Логика, которая ждёт Kie.ai и OpenAI, записана генераторами (flow): вместо запроса
+# flow делает `response = yield UpstreamCall(...)`, а сам вызов выполняет драйвер.
+# run_flow() (Flask) ходит через requests в текущем потоке, asgi.py исполняет тот же
+# flow на общем aiohttp.ClientSession и не держит поток, пока ждёт ответа.
+# Если yield отдаёт список вызовов, они выполняются параллельно, а в flow
+# возвращается список ответов (или исключений) в том же порядке.
+
+class UpstreamCall:
+    """Описание HTTP запроса к внешнему API"""
+
+    def __init__(self, method, url, headers=None, json=None, params=None, timeout=30):
+        self.method = method
+        self.url = url
+        self.headers = headers or {}
+        self.json = json
+        self.params = params
+        self.timeout = timeout
+
+
+class FlowPause:
+    """Пауза внутри flow (backoff, ожидание дубликата): драйвер спит, не держа соединение с БД"""
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class UpstreamConnectError(Exception):
+    """Соединение с внешним API не установлено - запрос точно не дошёл, повтор безопасен"""
+
+
+class CircuitOpenError(Exception):
+    """Вызов не выполнен: breaker внешнего API разомкнут"""
+
+    def __init__(self, breaker, retry_after):
+        self.service = breaker.name
+        self.retry_after = max(1, int(retry_after + 0.999))
+        super().__init__(f"{breaker.label} временно недоступен, повторите через {self.retry_after} с")
+
+    def response(self):
+        return {'error': str(self), 'service': self.service, 'retry_after': self.retry_after}, 503
+
+
+class CircuitBreaker:
+    """Breaker одного внешнего API со скользящим окном ошибок и задержек.
+
+    closed    - вызовы идут, результаты копятся в окне BREAKER_WINDOW секунд;
+                при доле ошибок >= BREAKER_ERROR_RATE или медленных >= BREAKER_SLOW_RATE
+                (и хотя бы BREAKER_MIN_CALLS вызовах) размыкается;
+    open      - вызовы сразу получают CircuitOpenError, через BREAKER_OPEN_SECONDS
+                переходит в half_open;
+    half_open - пропускает один пробный вызов: успех замыкает breaker, ошибка
+                снова размыкает.
+    Состояние своё в каждом процессе."""
+
+    def __init__(self, name, label, slow_call):
+        self.name = name
+        self.label = label
+        self.slow_call = slow_call
+        self.lock = threading.Lock()
+        self.state = 'closed'
+        self.window = deque()  # (время, ошибка, медленный, длительность)
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.stats = {'calls': 0, 'failures': 0, 'rejected': 0, 'opened': 0}
+
+    def _trim(self, now):
+        while self.window and self.window[0][0] < now - Config.BREAKER_WINDOW:
+            self.window.popleft()
+
+    def before_call(self):
+        """Разрешение на вызов или CircuitOpenError"""
+        with self.lock:
+            if self.state == 'closed':
+                return
+            now = time.monotonic()
+            if self.state == 'open' and now - self.opened_at >= Config.BREAKER_OPEN_SECONDS:
+                self.state = 'half_open'
+            if self.state == 'half_open' and not self.probe_in_flight:
+                self.probe_in_flight = True
+                return
+            self.stats['rejected'] += 1
+            raise CircuitOpenError(self, self.opened_at + Config.BREAKER_OPEN_SECONDS - now)
+
+    def is_open(self):
+        """Разомкнут и пробный вызов ещё не положен - для проверки до начала работы"""
+        with self.lock:
+            return (self.state == 'open'
+                    and time.monotonic() - self.opened_at < Config.BREAKER_OPEN_SECONDS)
+
+    def check(self):
+        if self.is_open():
+            with self.lock:
+                self.stats['rejected'] += 1
+                retry_after = self.opened_at + Config.BREAKER_OPEN_SECONDS - time.monotonic()
+            raise CircuitOpenError(self, retry_after)
+
+    def record(self, ok, duration):
+        now = time.monotonic()
+        slow = duration >= self.slow_call
+        with self.lock:
+            self.stats['calls'] += 1
+            if not ok:
+                self.stats['failures'] += 1
+            if self.state == 'half_open':
+                self.probe_in_flight = False
+                if ok and not slow:
+                    self.state = 'closed'
+                    self.window.clear()
+                    log_event('breaker_closed', f"✅ Circuit breaker {self.label}: замкнут", service=self.name)
+                else:
+                    self._open(now)
+                return
+            self.window.append((now, not ok, slow, duration))
+            self._trim(now)
+            if self.state != 'closed' or len(self.window) < Config.BREAKER_MIN_CALLS:
+                return
+            errors = sum(1 for entry in self.window if entry[1])
+            slow_calls = sum(1 for entry in self.window if entry[2])
+            if (errors / len(self.window) >= Config.BREAKER_ERROR_RATE
+                    or slow_calls / len(self.window) >= Config.BREAKER_SLOW_RATE):
+                self._open(now)
+
+    def _open(self, now):
+        self.state = 'open'
+        self.opened_at = now
+        self.stats['opened'] += 1
+        log_event('breaker_opened', f"🔌 Circuit breaker {self.label}: разомкнут на {Config.BREAKER_OPEN_SECONDS} с",
+                  level=logging.WARNING, service=self.name, open_seconds=Config.BREAKER_OPEN_SECONDS)
+
+    def snapshot(self):
+        with self.lock:
+            self._trim(time.monotonic())
+            durations = sorted(entry[3] for entry in self.window)
+            total = len(self.window)
+            return {
+                'state': self.state,
+                'window_calls': total,
+                'error_rate': round(sum(1 for e in self.window if e[1]) / total, 3) if total else 0.0,
+                'slow_rate': round(sum(1 for e in self.window if e[2]) / total, 3) if total else 0.0,
+                'p95_seconds': round(durations[min(total - 1, int(total * 0.95))], 3) if total else None,
+                **self.stats,
+            }
+
+
+circuit_breakers = {
+    'kie': CircuitBreaker('kie', 'Kie.ai', Config.BREAKER_SLOW_CALL['kie']),
+    'openai': CircuitBreaker('openai', 'OpenAI', Config.BREAKER_SLOW_CALL['openai']),
+}
+
+
+def breaker_for(url):
+    if url.startswith(Config.KIE_API_URL):
+        return circuit_breakers['kie']
+    if url.startswith(Config.OPENAI_API_URL):
+        return circuit_breakers['openai']
+    return None
+
+
+def upstream_call_ok(status_code):
+    """5xx и 429 - сбой внешнего API; 4xx из-за токена или запроса - нет"""
+    return status_code < 500 and status_code != 429
+
+
+def upstream_call_labels(call, breaker):
+    """Метки метрик вызова: сервис и операция (createTask, recordInfo, completions...)"""
+    if breaker is None:
+        # Скачивание картинок (кадры комикса): в пути имя файла, метка была бы уникальной
+        return (('service', 'other'), ('operation', call.method.lower()))
+    operation = call.url.split('?', 1)[0].rstrip('/').rsplit('/', 1)[-1]
+    return (('service', breaker.name), ('operation', operation))
+
+
+def upstream_call_started(call):
+    """Разрешение breaker'а на вызов; возвращает (breaker, время начала) для upstream_call_finished"""
+    breaker = breaker_for(call.url)
+    if breaker is not None:
+        try:
+            breaker.before_call()
+        except CircuitOpenError:
+            labels = upstream_call_labels(call, breaker)
+            metrics.inc('covers_upstream_requests_total', labels + (('status', 'rejected'),))
+            metrics.inc('covers_upstream_errors_total', labels)
+            raise
+    return breaker, time.perf_counter()
+
+
+def upstream_call_finished(call, breaker, started, status_code=None):
+    """Учёт вызова в breaker, метриках и Server-Timing; status_code None - ответа нет (исключение)"""
+    ended = time.perf_counter()
+    duration = ended - started
+    ok = status_code is not None and upstream_call_ok(status_code)
+    if breaker is not None:
+        breaker.record(ok, duration)
+    labels = upstream_call_labels(call, breaker)
+    timings = request_timings.get()
+    if timings is not None and breaker is not None:
+        stage = 'openai' if breaker.name == 'openai' else KIE_TIMING_STAGES.get(labels[1][1], 'kie')
+        timings.add(stage, started, ended)
+    metrics.inc('covers_upstream_requests_total',
+                labels + (('status', str(status_code) if status_code is not None else 'exception'),))
+    if not ok:
+        metrics.inc('covers_upstream_errors_total', labels)
+    metrics.observe('covers_upstream_request_duration_seconds', labels, duration)
+
+
+def collect_upstream_metrics():
+    for name, breaker in circuit_breakers.items():
+        yield 'gauge', 'covers_upstream_breaker_open', (('service', name),), int(breaker.state != 'closed')
+        yield 'counter', 'covers_upstream_breaker_opened_total', (('service', name),), breaker.stats['opened']
+    for event, value in status_cache_stats.items():
+        yield 'counter', 'covers_status_cache_events_total', (('event', event),), value
+
+
+metrics.collectors.append(collect_upstream_metrics)
+
+
+@bp.route('/covers/api/upstream-status')
+@operator_required
+def upstream_status():
+    """Состояние circuit breaker'ов внешних API в этом процессе"""
+    return jsonify({
+        'pid': os.getpid(),
+        'breakers': {name: breaker.snapshot() for name, breaker in circuit_breakers.items()},
+        'status_cache': dict(status_cache_stats, hot_entries=len(status_cache_hot)),
+    })
+
+
+upstream_session = None
+upstream_session_pid = None
+
+
+def get_upstream_session():
+    """requests.Session с пулом keep-alive соединений, свой в каждом процессе.
+    Сокеты, открытые до fork, нельзя делить между воркерами - после fork сессия создаётся заново."""
+    global upstream_session, upstream_session_pid
+    if upstream_session is None or upstream_session_pid != os.getpid():
+        import requests
+        session_ = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=Config.UPSTREAM_POOL_SIZE)
+        session_.mount('https://', adapter)
+        session_.mount('http://', adapter)
+        upstream_session, upstream_session_pid = session_, os.getpid()
+    return upstream_session
+
+
+def request_not_sent(error):
+    """Ошибка requests возникла до отправки запроса (DNS, отказ в соединении, таймаут connect)"""
+    import requests
+    from urllib3.exceptions import NewConnectionError
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    if isinstance(error, requests.ConnectionError) and error.args:
+        return isinstance(getattr(error.args[0], 'reason', None), NewConnectionError)
+    return False
+
+
+def perform_upstream_call(call):
+    breaker, started = upstream_call_started(call)
+    try:
+        response = get_upstream_session().request(call.method, call.url, headers=call.headers,
+                                                  json=call.json, params=call.params, timeout=call.timeout)
+    except Exception as e:
+        upstream_call_finished(call, breaker, started)
+        if request_not_sent(e):
+            raise UpstreamConnectError(str(e)) from e
+        raise
+    upstream_call_finished(call, breaker, started, response.status_code)
+    return response
+
+
+def perform_upstream_call_safe(call):
+    try:
+        return perform_upstream_call(call)
+    except Exception as e:
+        return e
+
+
+def run_flow(flow):
+    """Синхронно выполняет flow и возвращает его результат"""
+    value, error = None, None
+    while True:
+        try:
+            call = flow.throw(error) if error is not None else flow.send(value)
+        except StopIteration as stop:
+            return stop.value
+        value, error = None, None
+        if isinstance(call, FlowPause):
+            time.sleep(call.seconds)
+        elif isinstance(call, list):
+            # Своя копия контекста на вызов: таймеры запроса видны в потоках пула
+            futures = [app_state().upstream_executor.submit(contextvars.copy_context().run, perform_upstream_call_safe, c)
+                       for c in call]
+            value = [future.result() for future in futures]
+        else:
+            try:
+                value = perform_upstream_call(call)
+            except Exception as e:
+                error = e
+
+
+def flow_response(flow):
+    """Выполняет flow эндпоинта, который возвращает (данные, код ответа),
+    и добавляет Server-Timing с этапами запроса"""
+    timings = StageTimings()
+    token = request_timings.set(timings)
+    try:
+        body, status = run_flow(flow)
+        with timed_stage('render'):
+            response = jsonify(timed_response_body(body, timings))
+    finally:
+        request_timings.reset(token)
+    g.stage_timings = timings  # для access лога
+    if Config.SERVER_TIMING:
+        response.headers['Server-Timing'] = timings.header()
+    return response, status
+
+
+# HTTP статусы и коды Kie.ai, при которых задача не создана: лимит запросов,
+# перегрузка, техработы. Таймаут чтения сюда не входит - задача могла создаться.
+RETRY_HTTP_STATUSES = {429, 503}
+RETRY_KIE_CODES = {429, 455}
+# Ошибки шлюза: запрос мог дойти до Kie.ai и создать задачу, поэтому повторяются
+# только под ключом идемпотентности - дубликат клиента получит сохранённый ответ
+RETRY_GATEWAY_STATUSES = {502, 504}
+
+
+def backoff_delay(attempt):
+    """Экспоненциальная пауза с полным jitter, чтобы повторы воркеров не шли залпом"""
+    return random.uniform(0, min(Config.UPSTREAM_RETRY_MAX_DELAY,
+                                 Config.UPSTREAM_RETRY_BASE_DELAY * 2 ** attempt))
+
+
+def retryable_result(result, idempotent=False):
+    if isinstance(result, UpstreamConnectError):
+        return True
+    if isinstance(result, Exception):
+        return False
+    if result.status_code in RETRY_HTTP_STATUSES:
+        return True
+    if idempotent and result.status_code in RETRY_GATEWAY_STATUSES:
+        return True
+    try:
+        return result.json().get('code') in RETRY_KIE_CODES
+    except (ValueError, AttributeError):
+        return False
+
+
+def create_tasks_flow(calls, idempotent=False):
+    """Выполняет createTask вызовы параллельно, повторяя безопасные сбои
+    (idempotent - запрос под ключом идемпотентности, см. RETRY_GATEWAY_STATUSES).
+    Возвращает ответы (или исключения) в порядке calls."""
+    results = [None] * len(calls)
+    pending = list(range(len(calls)))
+    for attempt in range(Config.UPSTREAM_RETRIES + 1):
+        if len(pending) == 1:
+            try:
+                responses = [(yield calls[pending[0]])]
+            except Exception as e:
+                responses = [e]
+        else:
+            responses = yield [calls[i] for i in pending]
+        for i, result in zip(pending, responses):
+            results[i] = result
+        pending = [i for i in pending if retryable_result(results[i], idempotent)]
+        if not pending or attempt == Config.UPSTREAM_RETRIES:
+            break
+        delay = backoff_delay(attempt)
+        log_event('create_task_retry', f"🔁 Повтор createTask ({len(pending)} шт.) через {delay:.2f}с",
+                  level=logging.WARNING, attempt=attempt + 1, calls=len(pending), delay_ms=round(delay * 1000))
+        yield FlowPause(delay)
+    return results
+
+
+def create_task_flow(call, idempotent=False):
+    """Один createTask с повторами; исключение последней попытки пробрасывается"""
+    result, = yield from create_tasks_flow([call], idempotent)
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def cleanup_expired_idempotency_keys(c):
+    cutoff = (datetime.utcnow() - Config.IDEMPOTENCY_TTL).strftime('%Y-%m-%d %H:%M:%S')
+    c.execute('DELETE FROM idempotency_keys WHERE created_at < ?', (cutoff,))
+
+
+def idempotent_flow(user_id, endpoint, key, data, make_flow):
+    """Выполняет flow генерации не больше одного раза на (пользователь, ключ).
+
+    Первый запрос с ключом занимает его (state='pending') на IDEMPOTENCY_LEASE и
+    выполняет flow. Повтор после завершения получает сохранённый ответ, а дубликат,
+    пришедший пока первый ещё выполняется (двойной клик, другой воркер), ждёт его
+    результата; если аренда истекла (воркер упал посреди генерации), дубликат
+    забирает ключ себе. Сохраняются только успешные ответы (задача создана); после
+    ошибки ключ освобождается, и повтор с исправленным токеном выполнится заново.
+    make_flow(idempotent) получает True, если запрос защищён ключом."""
+    if not key:
+        return (yield from make_flow(False))
+    key = key[:200]
+    request_hash = hashlib.sha256(
+        f"{endpoint}:{json.dumps(data, sort_keys=True, ensure_ascii=False)}".encode('utf-8')).hexdigest()
+    deadline = time.time() + Config.IDEMPOTENCY_WAIT
+
+    while True:
+        now = time.time()
+        lease = now + Config.IDEMPOTENCY_LEASE
+        conn = get_db()
+        c = conn.cursor()
+        c.execute('''
+            INSERT OR IGNORE INTO idempotency_keys (user_id, key, endpoint, request_hash, lease_until)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (user_id, key, endpoint, request_hash, lease))
+        if c.rowcount == 1:
+            cleanup_expired_idempotency_keys(c)
+            conn.close()
+            break
+        # Владелец не уложился в аренду - забираем ключ (тот же запрос, ещё pending)
+        c.execute('''
+            UPDATE idempotency_keys SET lease_until = ?
+            WHERE user_id = ? AND key = ? AND request_hash = ? AND state = 'pending' AND lease_until < ?
+        ''', (lease, user_id, key, request_hash, now))
+        if c.rowcount == 1:
+            conn.close()
+            log_event('idempotency_takeover', "♻️ Ключ идемпотентности с истёкшей арендой перехвачен",
+                      level=logging.WARNING, endpoint=endpoint)
+            break
+        c.execute('SELECT * FROM idempotency_keys WHERE user_id = ? AND key = ?', (user_id, key))
+        row = c.fetchone()
+        conn.close()
+
+        if row is None:
+            continue  # первый запрос завершился ошибкой и освободил ключ
+        if row['request_hash'] != request_hash:
+            return {'error': 'Ключ идемпотентности уже использован для другого запроса'}, 422
+        if row['state'] == 'done':
+            body = json.loads(row['response_json'])
+            body['idempotent_replay'] = True
+            return body, row['status_code']
+        if time.time() >= deadline:
+            return {'error': 'Такой же запрос ещё выполняется, повторите позже'}, 409
+        yield FlowPause(0.25)
+
+    # Аренда - ещё и метка владельца: если ключ перехватили, чужую запись не трогаем
+    release = 'DELETE FROM idempotency_keys WHERE user_id = ? AND key = ? AND lease_until = ?'
+    try:
+        body, status = yield from make_flow(True)
+    except BaseException:
+        conn = get_db()
+        conn.execute(release, (user_id, key, lease))
+        conn.close()
+        raise
+
+    conn = get_db()
+    if status < 400:
+        conn.execute('''
+            UPDATE idempotency_keys SET state = 'done', status_code = ?, response_json = ?
+            WHERE user_id = ? AND key = ? AND lease_until = ?
+        ''', (status, json.dumps(body, ensure_ascii=False), user_id, key, lease))
+    else:
+        conn.execute(release, (user_id, key, lease))
+    conn.close()
+    return body, status
+
+
+def request_idempotency_key():
+    return request.headers.get('Idempotency-Key', '').strip() or None
+
+
+def openai_fix_flow(prompt, openai_token):
     """Исправляет промпт используя OpenAI API"""
     try:
         headers = {
@@ -177,25 +1940,27 @@ def fix_prompt_with_openai(prompt, openai_token):
             "max_tokens": 500
         }
         
-        response = requests.post(
-            'https://api.openai.com/v1/chat/completions',
-            headers=headers,
-            json=payload,
-            timeout=10
-        )
+        response = yield UpstreamCall('POST', Config.OPENAI_API_URL,
+                                      headers=headers, json=payload, timeout=10)
         
         if response.status_code == 200:
             result = response.json()
             fixed_prompt = result['choices'][0]['message']['content'].strip()
             return fixed_prompt
         else:
-            print(f"OpenAI API error: {response.status_code}")
+            log_event('openai_error', f"OpenAI API error: {response.status_code}", level=logging.WARNING,
+                      status=response.status_code)
             return None
     except Exception as e:
-        print(f"OpenAI error: {e}")
+        log_event('openai_error', f"OpenAI error: {e}", level=logging.WARNING)
         return None
 
-def fix_prompt_errors(prompt, openai_token=None):
+
+def fix_prompt_with_openai(prompt, openai_token):
+    """Исправляет промпт используя OpenAI API"""
+    return run_flow(openai_fix_flow(prompt, openai_token))
+
+def fix_prompt_flow(prompt, openai_token=None):
     """
     Исправляет ошибки в промпте:
     - Сначала пытается использовать OpenAI если токен есть
@@ -204,13 +1969,22 @@ def fix_prompt_errors(prompt, openai_token=None):
     if not prompt:
         return prompt
     
-    # Пытаемся использовать OpenAI если токен есть
-    if openai_token:
-        fixed = fix_prompt_with_openai(prompt, openai_token)
-        if fixed:
-            return fixed
-    
-    # Бесплатный метод исправления
+    with timed_stage('prompt-fix'):
+        # Пытаемся использовать OpenAI если токен есть (и OpenAI не лежит)
+        if openai_token and not circuit_breakers['openai'].is_open():
+            fixed = yield from openai_fix_flow(prompt, openai_token)
+            if fixed:
+                return fixed
+        
+        return fix_prompt_locally(prompt)
+
+
+def fix_prompt_errors(prompt, openai_token=None):
+    return run_flow(fix_prompt_flow(prompt, openai_token))
+
+
+def fix_prompt_locally(prompt):
+    """Бесплатный метод исправления"""
     # Убираем лишние пробелы
     prompt = ' '.join(prompt.split())
     
@@ -303,6 +2077,25 @@ def login_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def is_admin(user_id):
+    if not Config.ADMIN_EMAILS:
+        return False
+    conn = get_db()
+    user = conn.execute('SELECT email FROM users WHERE id = ?', (user_id,)).fetchone()
+    conn.close()
+    return bool(user and user['email'] and user['email'].lower() in Config.ADMIN_EMAILS)
+
+def admin_required(f):
+    """Только для пользователей из ADMIN_EMAILS"""
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if 'user_id' not in session:
+            return redirect('/covers/login')
+        if not is_admin(session['user_id']):
+            return jsonify({'error': 'Доступ только для администраторов'}), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
 # Размеры для разных соц сетей
 SOCIAL_MEDIA_SIZES = {
     "youtube_banner": {
@@ -543,16 +2336,18 @@ PROMPT_EXAMPLES = [
 
 # ============ GOOGLE OAUTH ROUTES ============
 
-@app.route('/covers/auth/google')
+@bp.route('/covers/auth/google')
 def google_login():
+    google = get_google()
     if not google:
         return redirect('/covers/login?error=google_not_configured')
     redirect_uri = 'https://2msp.webversy.top/covers/auth/google/callback'
     return google.authorize_redirect(redirect_uri)
 
 
-@app.route('/covers/auth/google/callback')
+@bp.route('/covers/auth/google/callback')
 def google_callback():
+    google = get_google()
     if not google:
         return redirect('/covers/login?error=google_not_configured')
     
@@ -619,13 +2414,13 @@ def google_callback():
         return redirect('/covers/settings?welcome=1')
         
     except Exception as e:
-        print(f"Google OAuth error: {e}")
+        log_event('google_oauth_failed', f"Google OAuth error: {e}", level=logging.ERROR, exc_info=True)
         return redirect('/covers/login?error=google_failed')
 
 
 # ============ AUTH ROUTES ============
 
-@app.route('/covers/register', methods=['GET', 'POST'])
+@bp.route('/covers/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         data = request.form
@@ -635,10 +2430,10 @@ def register():
         api_token = data.get('api_token', '').strip()
         
         if not username or not email or not password:
-            return render_template('register.html', error='Заполните все обязательные поля', google_enabled=bool(google))
+            return render_template('register.html', error='Заполните все обязательные поля', google_enabled=google_oauth_enabled())
         
         if len(password) < 6:
-            return render_template('register.html', error='Пароль должен быть минимум 6 символов', google_enabled=bool(google))
+            return render_template('register.html', error='Пароль должен быть минимум 6 символов', google_enabled=google_oauth_enabled())
         
         try:
             conn = get_db()
@@ -661,12 +2456,12 @@ def register():
                 return redirect('/covers/settings')
                 
         except sqlite3.IntegrityError:
-            return render_template('register.html', error='Пользователь с таким именем или email уже существует', google_enabled=bool(google))
+            return render_template('register.html', error='Пользователь с таким именем или email уже существует', google_enabled=google_oauth_enabled())
     
-    return render_template('register.html', google_enabled=bool(google))
+    return render_template('register.html', google_enabled=google_oauth_enabled())
 
 
-@app.route('/covers/login', methods=['GET', 'POST'])
+@bp.route('/covers/login', methods=['GET', 'POST'])
 def login():
     error = request.args.get('error')
     error_msg = None
@@ -694,12 +2489,12 @@ def login():
             session['username'] = user['username']
             return redirect('/covers/')
         else:
-            return render_template('login.html', error='Неверный email или пароль', google_enabled=bool(google))
+            return render_template('login.html', error='Неверный email или пароль', google_enabled=google_oauth_enabled())
     
-    return render_template('login.html', error=error_msg, google_enabled=bool(google))
+    return render_template('login.html', error=error_msg, google_enabled=google_oauth_enabled())
 
 
-@app.route('/covers/logout')
+@bp.route('/covers/logout')
 def logout():
     session.clear()
     return redirect('/covers/login')
@@ -716,10 +2511,14 @@ def send_password_reset_email(email, reset_link):
         
         if not smtp_user or not smtp_password:
             # Если SMTP не настроен, логируем и возвращаем False
-            print(f"Password reset link for {email}: {reset_link}")
-            print(f"SMTP not configured. Reset link: {reset_link}")
+            log_event('password_reset_link', f"SMTP not configured. Reset link: {reset_link}",
+                      level=logging.WARNING, email=email)
             return False
         
+        import smtplib
+        from email.mime.text import MIMEText
+        from email.mime.multipart import MIMEMultipart
+
         msg = MIMEMultipart()
         msg['From'] = smtp_user
         msg['To'] = email
@@ -751,12 +2550,12 @@ def send_password_reset_email(email, reset_link):
         
         return True
     except Exception as e:
-        print(f"Email send error: {e}")
+        log_event('email_failed', f"Email send error: {e}", level=logging.ERROR, email=email)
         # В режиме разработки просто логируем
         return True
 
 
-@app.route('/covers/forgot-password', methods=['GET', 'POST'])
+@bp.route('/covers/forgot-password', methods=['GET', 'POST'])
 def forgot_password():
     if request.method == 'POST':
         email = request.form.get('email', '').strip()
@@ -802,7 +2601,7 @@ def forgot_password():
     return render_template('forgot-password.html')
 
 
-@app.route('/covers/reset-password', methods=['GET', 'POST'])
+@bp.route('/covers/reset-password', methods=['GET', 'POST'])
 def reset_password():
     token = request.args.get('token') or request.form.get('token', '')
     
@@ -853,7 +2652,7 @@ def reset_password():
     return render_template('reset-password.html', token=token)
 
 
-@app.route('/covers/settings', methods=['GET', 'POST'])
+@bp.route('/covers/settings', methods=['GET', 'POST'])
 @login_required
 def settings():
     conn = get_db()
@@ -874,123 +2673,668 @@ def settings():
                   (api_token, openai_token if openai_token else None, session['user_id']))
         conn.commit()
         conn.close()
-        return render_template('settings.html', user=user, success='Токены сохранены!', google_enabled=bool(google))
+        return render_template('settings.html', user=user, success='Токены сохранены!', google_enabled=google_oauth_enabled())
+    
+    conn.close()
+    return render_template('settings.html', user=user, success=success_msg, google_enabled=google_oauth_enabled())
+
+
+# ============ СТАТИКА И СЖАТИЕ ============
+
+def load_asset_manifest():
+    """Читает static/dist/manifest.json (один раз на приложение)"""
+    state = app_state()
+    if state.asset_manifest is None:
+        try:
+            with open(os.path.join(Config.ASSET_DIST_FOLDER, 'manifest.json'), encoding='utf-8') as f:
+                state.asset_manifest = json.load(f)
+        except (OSError, ValueError):
+            # Сборка не запускалась - отдаём исходные файлы без хэшей
+            state.asset_manifest = {}
+    return state.asset_manifest
+
+
+@bp.app_template_global()
+def asset_url(path):
+    """URL файла статики с хэшем содержимого в имени (если сборка есть)"""
+    return f"/covers/assets/{load_asset_manifest().get(path, path)}"
+
+
+def accepted_encodings():
+    """Кодировки из Accept-Encoding, которые клиент не запретил через q=0"""
+    encodings = set()
+    for part in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = part.strip().partition(';')
+        if params.strip().replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        encodings.add(name.strip().lower())
+    return encodings
+
+
+@bp.route('/covers/assets/<path:filename>')
+def static_asset(filename):
+    """Отдача статики: хэшированные файлы из static/dist кэшируются навсегда
+    и отдаются в заранее сжатом виде (br/gzip) по Accept-Encoding"""
+    hashed = filename in load_asset_manifest().values()
+    if not hashed:
+        # Сборки нет или старая ссылка - исходный файл с коротким кэшем
+        return send_from_directory(Config.STATIC_FOLDER, filename, max_age=300)
+
+    encodings = accepted_encodings()
+    variant, content_encoding = filename, None
+    for encoding, ext in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in encodings and os.path.isfile(os.path.join(Config.ASSET_DIST_FOLDER, filename + ext)):
+            variant, content_encoding = filename + ext, encoding
+            break
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    response = send_from_directory(Config.ASSET_DIST_FOLDER, variant, mimetype=mimetype,
+                                   max_age=Config.ASSET_CACHE_MAX_AGE)
+    if content_encoding:
+        response.headers['Content-Encoding'] = content_encoding
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+@bp.after_app_request
+def compress_response(response):
+    """Сжимает HTML и JSON ответы больше COMPRESS_MIN_SIZE"""
+    if (response.direct_passthrough or response.is_streamed
+            or response.status_code < 200 or response.status_code >= 300
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in Config.COMPRESS_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    data = response.get_data()
+    if len(data) < Config.COMPRESS_MIN_SIZE:
+        return response
+
+    encodings = accepted_encodings()
+    if brotli is not None and 'br' in encodings:
+        # Быстрый уровень: ответ сжимается на каждый запрос
+        response.set_data(brotli.compress(data, quality=4))
+        response.headers['Content-Encoding'] = 'br'
+    elif 'gzip' in encodings:
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        return response
+    if response.headers.get('ETag'):
+        # Другое представление - ETag должен отличаться
+        response.set_etag(response.get_etag()[0] + '-' + response.headers['Content-Encoding'])
+    return response
+
+
+# ============ КЭШ ФРАГМЕНТОВ ШАБЛОНОВ ============
+
+def render_fragment(template_name, **context):
+    """Рендерит фрагмент, не зависящий от пользователя, один раз на приложение.
+    В debug режиме кэш не используется, чтобы правки шаблонов были видны сразу."""
+    state = app_state()
+    fragment = state.fragment_cache.get(template_name)
+    if fragment is None or current_app.debug:
+        fragment = Markup(render_template(template_name, **context))
+        with state.fragment_lock:
+            state.fragment_cache[template_name] = fragment
+    return fragment
+
+
+def index_sidebar():
+    # Каталоги меняются только при деплое - берём готовый HTML из кэша
+    return render_fragment('partials/index_sidebar.html',
+                           sizes=SOCIAL_MEDIA_SIZES,
+                           styles=DESIGN_STYLES,
+                           formats=IMAGE_FORMATS,
+                           format_examples=FORMAT_EXAMPLES,
+                           examples=PROMPT_EXAMPLES)
+
+
+# ============ HELP PAGE ============
+
+@bp.route('/covers/help')
+def help_page():
+    return render_template('help.html')
+
+
+# ============ MAIN ROUTES ============
+
+@bp.route('/')
+@bp.route('/covers')
+@bp.route('/covers/')
+def index():
+    if 'user_id' not in session:
+        return redirect('/covers/login')
+    
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT api_token FROM users WHERE id = ?', (session['user_id'],))
+    user = c.fetchone()
+    conn.close()
+    
+    has_token = bool(user and user['api_token'])
+    
+    return render_template('index.html', 
+                         sidebar=index_sidebar(),
+                         username=session.get('username'),
+                         has_token=has_token)
+
+
+def store_upload(file):
+    """Сохраняет загруженный файл под уникальным именем.
+    Возвращает (ответ, код) в формате API загрузки."""
+    if not file or file.filename == '':
+        return {'error': 'Файл не выбран'}, 400
+    
+    if not allowed_file(file.filename):
+        return {'error': 'Неподдерживаемый формат файла', 'name': file.filename}, 400
+    
+    filename = secure_filename(file.filename)
+    # Добавляем уникальный ID чтобы избежать конфликтов
+    unique_filename = f"{uuid.uuid4()}_{filename}"
+    filepath = os.path.join(Config.UPLOAD_FOLDER, unique_filename)
+    # Werkzeug держит большие части multipart во временном файле, save копирует кусками
+    file.save(filepath)
+    
+    if os.path.getsize(filepath) > Config.MAX_CONTENT_LENGTH:
+        os.remove(filepath)
+        return {'error': 'Файл больше 16MB', 'name': file.filename}, 413
+    
+    register_upload(unique_filename, os.path.getsize(filepath))
+    # Готовим облегчённую копию для Kie.ai в фоне
+    schedule_normalization(unique_filename)
+    
+    # Возвращаем URL для доступа к файлу
+    file_url = f"/covers/uploads/{unique_filename}"
+    return {'success': True, 'url': file_url, 'filename': unique_filename}, 200
+
+
+@bp.route('/api/upload', methods=['POST'])
+@bp.route('/covers/api/upload', methods=['POST'])
+@login_required
+def upload_file():
+    """Загрузка файлов с компьютера"""
+    if 'file' not in request.files:
+        return jsonify({'error': 'Файл не выбран'}), 400
+    
+    result, status = store_upload(request.files['file'])
+    return jsonify(result), status
+
+
+@bp.route('/api/upload/batch', methods=['POST'])
+@bp.route('/covers/api/upload/batch', methods=['POST'])
+@login_required
+def upload_batch():
+    """Загрузка нескольких файлов одним multipart запросом (поле files)"""
+    files = [f for f in request.files.getlist('files') if f.filename]
+    if not files:
+        return jsonify({'error': 'Файлы не выбраны'}), 400
+    if len(files) > Config.MAX_BATCH_FILES:
+        return jsonify({'error': f'Можно загрузить не больше {Config.MAX_BATCH_FILES} файлов'}), 400
+    
+    results = [store_upload(f)[0] for f in files]
+    return jsonify({
+        'success': any(r.get('success') for r in results),
+        'files': results
+    })
+
+
+# ============ ДОКАЧИВАЕМАЯ ЗАГРУЗКА ============
+# Протокол для больших файлов с мобильных сетей:
+#   POST /covers/api/upload/chunked            {filename, size}  -> {upload_id, chunk_size, offset}
+#   PUT  /covers/api/upload/chunked/<id>?offset=N  тело = кусок  -> {offset}
+#   GET  /covers/api/upload/chunked/<id>                          -> {offset} (для докачки)
+#   POST /covers/api/upload/chunked/<id>/finalize {sha256}        -> как /api/upload
+
+def partial_upload_path(upload_id):
+    return os.path.join(Config.UPLOAD_FOLDER, '.partial', upload_id)
+
+
+def get_chunked_upload(c, upload_id):
+    c.execute('SELECT * FROM chunked_uploads WHERE id = ? AND user_id = ?',
+              (upload_id, session['user_id']))
+    return c.fetchone()
+
+
+def cleanup_stale_chunked_uploads(c):
+    """Удаляет брошенные незавершённые загрузки"""
+    cutoff = (datetime.utcnow() - Config.CHUNKED_UPLOAD_TTL).strftime('%Y-%m-%d %H:%M:%S')
+    c.execute('SELECT id FROM chunked_uploads WHERE created_at < ?', (cutoff,))
+    for row in c.fetchall():
+        try:
+            os.remove(partial_upload_path(row['id']))
+        except OSError:
+            pass
+        c.execute('DELETE FROM chunked_uploads WHERE id = ?', (row['id'],))
+
+
+@bp.route('/api/upload/chunked', methods=['POST'])
+@bp.route('/covers/api/upload/chunked', methods=['POST'])
+@login_required
+def chunked_upload_init():
+    data = request.json or {}
+    filename = (data.get('filename') or '').strip()
+    try:
+        size = int(data.get('size', 0))
+    except (TypeError, ValueError):
+        size = 0
+    
+    if not filename or not allowed_file(filename):
+        return jsonify({'error': 'Неподдерживаемый формат файла'}), 400
+    if size <= 0 or size > Config.MAX_CONTENT_LENGTH:
+        return jsonify({'error': 'Размер файла должен быть от 1 байта до 16MB'}), 400
+    
+    upload_id = uuid.uuid4().hex
+    conn = get_db()
+    c = conn.cursor()
+    cleanup_stale_chunked_uploads(c)
+    c.execute('INSERT INTO chunked_uploads (id, user_id, filename, size) VALUES (?, ?, ?, ?)',
+              (upload_id, session['user_id'], secure_filename(filename), size))
+    conn.close()
+    open(partial_upload_path(upload_id), 'wb').close()
+    
+    return jsonify({'success': True, 'upload_id': upload_id,
+                    'chunk_size': Config.CHUNK_SIZE, 'offset': 0})
+
+
+@bp.route('/api/upload/chunked/<upload_id>', methods=['GET', 'PUT'])
+@bp.route('/covers/api/upload/chunked/<upload_id>', methods=['GET', 'PUT'])
+@login_required
+def chunked_upload_chunk(upload_id):
+    conn = get_db()
+    upload = get_chunked_upload(conn.cursor(), upload_id)
+    conn.close()
+    path = partial_upload_path(upload_id)
+    if not upload or not os.path.exists(path):
+        return jsonify({'error': 'Загрузка не найдена'}), 404
+    
+    # Источник правды о прогрессе - размер файла на диске
+    received = os.path.getsize(path)
+    if request.method == 'GET':
+        return jsonify({'upload_id': upload_id, 'offset': received, 'size': upload['size']})
+    
+    offset = request.args.get('offset', type=int)
+    length = request.content_length
+    if offset is None or length is None:
+        return jsonify({'error': 'Нужны offset и Content-Length'}), 400
+    if offset != received:
+        # Клиент должен продолжить с того места, которое реально записано
+        return jsonify({'error': 'Неверное смещение', 'offset': received}), 409
+    if length > Config.MAX_CHUNK_SIZE or offset + length > upload['size']:
+        return jsonify({'error': 'Слишком большой кусок', 'offset': received}), 413
+    
+    with open(path, 'ab') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return jsonify({'error': 'Кусок уже загружается', 'offset': received}), 409
+        if f.tell() != offset:
+            return jsonify({'error': 'Неверное смещение', 'offset': f.tell()}), 409
+        # Пишем потоком блоками по 64KB - в памяти никогда не весь кусок
+        remaining = length
+        while remaining > 0:
+            block = request.stream.read(min(65536, remaining))
+            if not block:
+                break
+            f.write(block)
+            remaining -= len(block)
+        if remaining:
+            # Соединение оборвалось - откатываем недописанный кусок целиком
+            f.truncate(offset)
+            return jsonify({'error': 'Кусок получен не полностью', 'offset': offset}), 400
+        received = f.tell()
+    
+    return jsonify({'success': True, 'offset': received, 'size': upload['size']})
+
+
+@bp.route('/api/upload/chunked/<upload_id>/finalize', methods=['POST'])
+@bp.route('/covers/api/upload/chunked/<upload_id>/finalize', methods=['POST'])
+@login_required
+def chunked_upload_finalize(upload_id):
+    data = request.json or {}
+    expected_sha256 = (data.get('sha256') or '').strip().lower()
+    if not expected_sha256:
+        return jsonify({'error': 'Нужна контрольная сумма sha256'}), 400
+    
+    conn = get_db()
+    c = conn.cursor()
+    upload = get_chunked_upload(c, upload_id)
+    path = partial_upload_path(upload_id)
+    if not upload or not os.path.exists(path):
+        conn.close()
+        return jsonify({'error': 'Загрузка не найдена'}), 404
     
+    received = os.path.getsize(path)
+    if received != upload['size']:
+        conn.close()
+        return jsonify({'error': 'Файл загружен не полностью', 'offset': received}), 409
+    
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    if digest.hexdigest() != expected_sha256:
+        # Данные повреждены - начинать придётся заново
+        os.remove(path)
+        c.execute('DELETE FROM chunked_uploads WHERE id = ?', (upload_id,))
+        conn.close()
+        return jsonify({'error': 'Контрольная сумма не совпадает'}), 422
+    
+    unique_filename = f"{uuid.uuid4()}_{upload['filename']}"
+    os.replace(path, os.path.join(Config.UPLOAD_FOLDER, unique_filename))
+    c.execute('DELETE FROM chunked_uploads WHERE id = ?', (upload_id,))
+    conn.close()
+    
+    register_upload(unique_filename, upload['size'])
+    schedule_normalization(unique_filename)
+    return jsonify({'success': True, 'url': f"/covers/uploads/{unique_filename}",
+                    'filename': unique_filename})
+
+
+# ============ СБОРЩИК МУСОРА ЗАГРУЗОК ============
+# Каждая загрузка учитывается в таблице uploads, генерации ссылаются на фото через
+# upload_refs (триггер чистит ссылки при удалении генерации). Фото без ссылок,
+# которыми не пользовались UPLOAD_GC_GRACE секунд, удаляются; сверх квот -
+# вытесняются самые давно использованные (кроме фото идущих генераций).
+
+upload_gc_stats = {'runs': 0, 'last_run': None, 'last_reclaimed_bytes': 0,
+                   'last_deleted_files': 0, 'total_reclaimed_bytes': 0}
+
+
+def register_upload(filename, size, user_id=None):
+    """Ставит новый файл на учёт"""
+    conn = get_db()
+    conn.execute('INSERT OR REPLACE INTO uploads (filename, user_id, bytes) VALUES (?, ?, ?)',
+                 (filename, user_id if user_id is not None else session.get('user_id'), size))
     conn.close()
-    return render_template('settings.html', user=user, success=success_msg, google_enabled=bool(google))
+    metrics.inc('covers_upload_bytes_total', value=size)
 
 
-# ============ HELP PAGE ============
+def record_upload_refs(c, task_id, urls):
+    """Связывает генерацию (или пакет, task_id 'batch:<id>') с использованными
+    локальными фото и обновляет их LRU-метку. Ссылки - полные или /covers/uploads/..."""
+    public_prefix = f"{Config.PUBLIC_URL}/covers/uploads/"
+    for url in urls:
+        if url.startswith(public_prefix):
+            name = url[len(public_prefix):]
+        elif url.startswith('/covers/uploads/'):
+            name = secure_filename(url[len('/covers/uploads/'):])
+        else:
+            continue
+        c.execute('SELECT filename FROM uploads WHERE filename = ? OR ref_filename = ?', (name, name))
+        row = c.fetchone()
+        if not row:
+            continue
+        c.execute('INSERT OR IGNORE INTO upload_refs (task_id, filename) VALUES (?, ?)',
+                  (task_id, row['filename']))
+        c.execute('UPDATE uploads SET last_used_at = CURRENT_TIMESTAMP WHERE filename = ?',
+                  (row['filename'],))
 
-@app.route('/covers/help')
-def help_page():
-    return render_template('help.html')
 
+def delete_uploads(c, rows):
+    """Удаляет файлы (оригинал и нормализованную копию) и их учёт. Возвращает освобождённые байты"""
+    reclaimed = 0
+    for row in rows:
+        for name in (row['filename'], row['ref_filename']):
+            if not name:
+                continue
+            try:
+                os.remove(os.path.join(Config.UPLOAD_FOLDER, name))
+            except OSError:
+                pass
+        reclaimed += row['bytes']
+        c.execute('DELETE FROM upload_refs WHERE filename = ?', (row['filename'],))
+        c.execute('DELETE FROM uploads WHERE filename = ?', (row['filename'],))
+    return reclaimed
 
-# ============ MAIN ROUTES ============
 
-@app.route('/')
-@app.route('/covers')
-@app.route('/covers/')
-def index():
-    if 'user_id' not in session:
-        return redirect('/covers/login')
-    
+def scan_untracked_uploads(c):
+    """Ставит на учёт файлы, которых нет в таблице (загруженные до появления учёта).
+    За один вызов читает не больше UPLOAD_GC_SCAN_BATCH записей каталога и
+    продолжает с того же места в следующий раз."""
+    state = app_state()
+    if state.upload_gc_scan is None:
+        state.upload_gc_scan = os.scandir(Config.UPLOAD_FOLDER)
+
+    batch = []
+    for entry in state.upload_gc_scan:
+        if not entry.name.startswith('.') and REFERENCE_SUFFIX + '.' not in entry.name:
+            batch.append(entry)
+        if len(batch) >= Config.UPLOAD_GC_SCAN_BATCH:
+            break
+    else:
+        # Каталог пройден целиком - следующий проход начнётся сначала
+        state.upload_gc_scan.close()
+        state.upload_gc_scan = None
+
+    adopted = 0
+    for i in range(0, len(batch), 500):
+        chunk = batch[i:i + 500]
+        c.execute(f"SELECT filename FROM uploads WHERE filename IN ({','.join('?' * len(chunk))})",
+                  [e.name for e in chunk])
+        known = {row['filename'] for row in c.fetchall()}
+        for entry in chunk:
+            try:
+                if entry.name in known or not entry.is_file():
+                    continue
+                stat = entry.stat()
+            except OSError:
+                # Файл удалили, пока мы шли по каталогу
+                continue
+            stem = os.path.splitext(entry.name)[0]
+            ref = next((f"{stem}{REFERENCE_SUFFIX}{ext}" for ext in ('.jpg', '.webp')
+                        if os.path.exists(os.path.join(Config.UPLOAD_FOLDER, f"{stem}{REFERENCE_SUFFIX}{ext}"))), None)
+            ref_bytes = os.path.getsize(os.path.join(Config.UPLOAD_FOLDER, ref)) if ref else 0
+            mtime = datetime.utcfromtimestamp(stat.st_mtime).strftime('%Y-%m-%d %H:%M:%S')
+            c.execute('''
+                INSERT OR IGNORE INTO uploads (filename, user_id, ref_filename, bytes, created_at, last_used_at)
+                VALUES (?, NULL, ?, ?, ?, ?)
+            ''', (entry.name, ref, stat.st_size + ref_bytes, mtime, mtime))
+            adopted += 1
+    return adopted
+
+
+# Фото можно вытеснять, если ими не пользовались дольше grace и они не нужны идущей
+# генерации или идущему пакету
+EVICTABLE_UPLOADS_SQL = '''
+    SELECT u.filename, u.ref_filename, u.bytes FROM uploads u
+    WHERE u.last_used_at < datetime('now', ?)
+      AND NOT EXISTS (
+          SELECT 1 FROM upload_refs r JOIN generations g ON g.task_id = r.task_id
+          WHERE r.filename = u.filename AND g.status = 'processing'
+      )
+      AND NOT EXISTS (
+          SELECT 1 FROM upload_refs r WHERE r.filename = u.filename AND r.task_id LIKE 'batch:%'
+      )
+'''
+
+
+def evict_over_quota(c, quota, total, user_id=None):
+    """Вытесняет давно не использованные фото (LRU), пока объём не уложится в квоту"""
+    reclaimed = deleted = 0
+    grace = f'-{Config.UPLOAD_GC_GRACE} seconds'
+    while total - reclaimed > quota:
+        if user_id is None:
+            c.execute(EVICTABLE_UPLOADS_SQL + ' ORDER BY u.last_used_at LIMIT 100', (grace,))
+        else:
+            c.execute(EVICTABLE_UPLOADS_SQL + ' AND u.user_id = ? ORDER BY u.last_used_at LIMIT 100',
+                      (grace, user_id))
+        rows = []
+        for row in c.fetchall():
+            rows.append(row)
+            if total - reclaimed - sum(r['bytes'] for r in rows) <= quota:
+                break
+        if not rows:
+            break
+        reclaimed += delete_uploads(c, rows)
+        deleted += len(rows)
+    return reclaimed, deleted
+
+
+def collect_upload_garbage():
+    """Один проход сборщика: учёт новых файлов, удаление сирот, квоты"""
     conn = get_db()
     c = conn.cursor()
-    c.execute('SELECT api_token FROM users WHERE id = ?', (session['user_id'],))
-    user = c.fetchone()
+    started = time.time()
+    adopted = scan_untracked_uploads(c)
+
+    # Сироты: на фото не ссылается ни одна генерация и им давно не пользовались
+    c.execute('''
+        SELECT u.filename, u.ref_filename, u.bytes FROM uploads u
+        WHERE u.last_used_at < datetime('now', ?)
+          AND NOT EXISTS (SELECT 1 FROM upload_refs r WHERE r.filename = u.filename)
+        LIMIT ?
+    ''', (f'-{Config.UPLOAD_GC_GRACE} seconds', Config.UPLOAD_GC_DELETE_BATCH))
+    orphans = c.fetchall()
+    reclaimed = delete_uploads(c, orphans)
+    deleted = len(orphans)
+
+    # Квота на пользователя
+    c.execute('SELECT user_id, SUM(bytes) AS total FROM uploads WHERE user_id IS NOT NULL '
+              'GROUP BY user_id HAVING total > ?', (Config.UPLOAD_USER_QUOTA,))
+    for row in c.fetchall():
+        freed, count = evict_over_quota(c, Config.UPLOAD_USER_QUOTA, row['total'], row['user_id'])
+        reclaimed += freed
+        deleted += count
+
+    # Общая квота
+    c.execute('SELECT COALESCE(SUM(bytes), 0) AS total FROM uploads')
+    total = c.fetchone()['total']
+    if total > Config.UPLOAD_GLOBAL_QUOTA:
+        freed, count = evict_over_quota(c, Config.UPLOAD_GLOBAL_QUOTA, total)
+        reclaimed += freed
+        deleted += count
     conn.close()
-    
-    has_token = bool(user and user['api_token'])
-    
-    return render_template('index.html', 
-                         sizes=SOCIAL_MEDIA_SIZES,
-                         styles=DESIGN_STYLES,
-                         formats=IMAGE_FORMATS,
-                         format_examples=FORMAT_EXAMPLES,
-                         examples=PROMPT_EXAMPLES,
-                         username=session.get('username'),
-                         has_token=has_token)
 
+    upload_gc_stats['runs'] += 1
+    upload_gc_stats['last_run'] = datetime.now().isoformat()
+    upload_gc_stats['last_reclaimed_bytes'] = reclaimed
+    upload_gc_stats['last_deleted_files'] = deleted
+    upload_gc_stats['total_reclaimed_bytes'] += reclaimed
+    if deleted or adopted:
+        log_event('upload_gc', f"🧹 Сборщик загрузок: удалено {deleted} файлов, освобождено {reclaimed} байт, "
+                  f"поставлено на учёт {adopted}", deleted_files=deleted, reclaimed_bytes=reclaimed,
+                  adopted_files=adopted, duration_ms=round((time.time() - started) * 1000, 1))
+    return reclaimed
 
-@app.route('/api/upload', methods=['POST'])
-@app.route('/covers/api/upload', methods=['POST'])
-@login_required
-def upload_file():
-    """Загрузка файлов с компьютера"""
-    if 'file' not in request.files:
-        return jsonify({'error': 'Файл не выбран'}), 400
-    
-    file = request.files['file']
-    if file.filename == '':
-        return jsonify({'error': 'Файл не выбран'}), 400
-    
-    if file and allowed_file(file.filename):
-        filename = secure_filename(file.filename)
-        # Добавляем уникальный ID чтобы избежать конфликтов
-        unique_filename = f"{uuid.uuid4()}_{filename}"
-        filepath = os.path.join(Config.UPLOAD_FOLDER, unique_filename)
-        file.save(filepath)
-        
-        # Возвращаем URL для доступа к файлу
-        file_url = f"/covers/uploads/{unique_filename}"
-        return jsonify({'success': True, 'url': file_url, 'filename': unique_filename})
-    
-    return jsonify({'error': 'Неподдерживаемый формат файла'}), 400
+
+def upload_gc_loop():
+    lock_path = os.path.join(Config.UPLOAD_FOLDER, '.partial', 'gc.lock')
+    while not app_state().shutdown_event.wait(Config.UPLOAD_GC_INTERVAL):
+        try:
+            with open(lock_path, 'w') as lock:
+                # Между воркерами gunicorn сборщик работает только в одном
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                collect_upload_garbage()
+        except Exception as e:
+            log_event('upload_gc_failed', f"Ошибка сборщика загрузок: {e}", level=logging.ERROR, exc_info=True)
+
+
+def start_upload_gc():
+    """Запускает сборщик в текущем процессе (потоки не переживают fork, поэтому
+    в preload режиме он стартует в каждом воркере, а не в мастере)"""
+    state = app_state()
+    if Config.UPLOAD_GC_INTERVAL <= 0 or state.shutdown_event.is_set():
+        return
+    if state.upload_gc_thread is not None and state.upload_gc_thread.is_alive():
+        return
+    ensure_storage()
+    state.upload_gc_thread = threading.Thread(target=in_app_context(upload_gc_loop), name='upload-gc', daemon=True)
+    state.upload_gc_thread.start()
+
+
+@bp.before_app_request
+def ensure_initialized():
+    # Каталоги и сборщик - при первом запросе (для запуска без serve.py тоже)
+    ensure_storage()
+    start_upload_gc()
+    start_metrics_flush()
+    start_batch_scheduler()
 
 
-@app.route('/covers/uploads/<filename>')
+@bp.route('/covers/uploads/<filename>')
 def uploaded_file(filename):
-    """Отдача загруженных файлов"""
-    return send_from_directory(Config.UPLOAD_FOLDER, filename)
+    """Отдача загруженных файлов.
+    Файлы неизменяемые (UUID в имени), поэтому кэшируем навсегда. В режиме x-accel
+    сам файл отдаёт nginx, иначе send_file (ETag, Range, sendfile через wsgi.file_wrapper)."""
+    if Config.UPLOAD_SERVE_MODE == 'x-accel':
+        safe_name = secure_filename(filename)
+        if safe_name != filename or not os.path.isfile(os.path.join(Config.UPLOAD_FOLDER, safe_name)):
+            return jsonify({'error': 'Файл не найден'}), 404
+        response = current_app.response_class()
+        response.headers['X-Accel-Redirect'] = f"{Config.UPLOAD_ACCEL_PREFIX}{safe_name}"
+        # Content-Type, ETag и Range выставит nginx
+        del response.headers['Content-Type']
+    else:
+        response = send_from_directory(Config.UPLOAD_FOLDER, filename,
+                                       max_age=Config.UPLOAD_CACHE_MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.max_age = Config.UPLOAD_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
 
 
-@app.route('/api/generate', methods=['POST'])
-@app.route('/covers/api/generate', methods=['POST'])
-@login_required
-def generate_cover():
+def platform_groups(platforms):
+    """Группирует платформы по (aspect_ratio, resolution): одинаковые размеры в Kie.ai -
+    одна задача. Возвращает [(size_config группы, [платформы])] в порядке запроса."""
+    groups = OrderedDict()
+    for platform in platforms:
+        size_config = SOCIAL_MEDIA_SIZES.get(platform, SOCIAL_MEDIA_SIZES['youtube_thumbnail'])
+        groups.setdefault((size_config['aspect_ratio'], size_config['resolution']), []).append(platform)
+    result = []
+    for members in groups.values():
+        # В промпт - самый крупный размер группы, остальные платформы его уменьшат
+        size_config = max((SOCIAL_MEDIA_SIZES.get(p, SOCIAL_MEDIA_SIZES['youtube_thumbnail']) for p in members),
+                          key=lambda size: size['width'] * size['height'])
+        result.append((size_config, members))
+    return result
+
+
+def generate_cover_flow(user_id, data, idempotent=False):
     try:
         # Получаем токены пользователя
         conn = get_db()
         c = conn.cursor()
-        c.execute('SELECT api_token, openai_token FROM users WHERE id = ?', (session['user_id'],))
+        c.execute('SELECT api_token, openai_token FROM users WHERE id = ?', (user_id,))
         user = c.fetchone()
         conn.close()
         
         if not user or not user['api_token']:
-            return jsonify({'error': 'API токен не настроен. Перейдите в настройки.'}), 400
+            return {'error': 'API токен не настроен. Перейдите в настройки.'}, 400
         
         api_token = user['api_token']
         openai_token = user['openai_token'] if user and user['openai_token'] else None
         
-        data = request.json
-        platform = data.get('platform', 'youtube_thumbnail')
+        # Kie.ai лежит - отвечаем сразу, не тратя вызов OpenAI на исправление промпта
+        circuit_breakers['kie'].check()
+        
+        # platforms - список для кросспостинга, platform - одна платформа
+        platforms = data.get('platforms') or [data.get('platform', 'youtube_thumbnail')]
+        if isinstance(platforms, str):
+            platforms = [platforms]
+        if not isinstance(platforms, list) or not all(isinstance(p, str) for p in platforms):
+            return {'error': 'platforms должен быть списком платформ'}, 400
+        platforms = list(OrderedDict.fromkeys(platforms))[:len(SOCIAL_MEDIA_SIZES)]
         style = data.get('style', 'modern')
         image_format = data.get('format', 'realistic')  # realistic, cartoon, anime
         user_prompt = data.get('prompt', '')
         
         # Исправляем ошибки в промпте (используя OpenAI если токен есть)
-        user_prompt = fix_prompt_errors(user_prompt, openai_token)
+        user_prompt = (yield from fix_prompt_flow(user_prompt, openai_token))
         
         # Получаем ссылки на референсные изображения (до 5 штук)
         image_urls = data.get('image_urls', [])
-        # Фильтруем пустые ссылки и конвертируем локальные URL в полные
-        processed_urls = []
-        for url in image_urls:
-            url = url.strip()
-            if not url:
-                continue
-            # Если это локальный URL загруженного файла, конвертируем в полный
-            if url.startswith('/covers/uploads/'):
-                url = f"https://2msp.webversy.top{url}"
-            processed_urls.append(url)
-        image_urls = processed_urls[:5]  # До 5 фото
+        # Фильтруем пустые ссылки и конвертируем локальные URL в полные (до 5 фото)
+        processed_urls = yield from process_image_urls_flow(image_urls, 5)
         
         if not user_prompt:
-            return jsonify({'error': 'Опишите желаемую обложку'}), 400
+            return {'error': 'Опишите желаемую обложку'}, 400
         
-        size_config = SOCIAL_MEDIA_SIZES.get(platform, SOCIAL_MEDIA_SIZES['youtube_thumbnail'])
         style_config = DESIGN_STYLES.get(style, DESIGN_STYLES['modern'])
         format_config = IMAGE_FORMATS.get(image_format, IMAGE_FORMATS['realistic'])
         
@@ -999,175 +3343,817 @@ def generate_cover():
         if processed_urls:
             photo_info = f", using {len(processed_urls)} reference photo(s) as style and content guide"
         
-        # Собираем полный промпт с форматом (исправленный)
-        full_prompt = f"{style_config['prompt_prefix']} {user_prompt}{photo_info}, {format_config['prompt_suffix']}, high quality, professional design, {size_config['width']}x{size_config['height']} pixels"
-        
         headers = {
             'Authorization': f'Bearer {api_token}',
             'Content-Type': 'application/json'
         }
         
-        # Базовый payload для Nano Banana Pro
-        payload = {
-            "model": "nano-banana-pro",
-            "input": {
-                "prompt": full_prompt,
-                "aspect_ratio": size_config['aspect_ratio'],
-                "resolution": size_config['resolution'],
-                "output_format": "png"
+        # Платформы с одинаковыми aspect_ratio и resolution получают одну задачу
+        groups = platform_groups(platforms)
+        calls = []
+        for size_config, members in groups:
+            # Собираем полный промпт с форматом (исправленный)
+            full_prompt = f"{style_config['prompt_prefix']} {user_prompt}{photo_info}, {format_config['prompt_suffix']}, high quality, professional design, {size_config['width']}x{size_config['height']} pixels"
+            
+            # Базовый payload для Nano Banana Pro
+            payload = {
+                "model": "nano-banana-pro",
+                "input": {
+                    "prompt": full_prompt,
+                    "aspect_ratio": size_config['aspect_ratio'],
+                    "resolution": size_config['resolution'],
+                    "output_format": "png"
+                }
             }
-        }
-        
-        # Добавляем референсные изображения если есть (ОБЯЗАТЕЛЬНО!)
+            
+            # Добавляем референсные изображения если есть (ОБЯЗАТЕЛЬНО!)
+            if processed_urls:
+                payload["input"]["image_prompts"] = [
+                    {"url": url, "weight": 0.7} for url in processed_urls
+                ]
+            calls.append(UpstreamCall('POST', f"{Config.KIE_API_URL}/createTask",
+                                      headers=headers, json=payload, timeout=30))
         if processed_urls:
-            payload["input"]["image_prompts"] = [
-                {"url": url, "weight": 0.7} for url in processed_urls
-            ]
-            print(f"✅ Added {len(processed_urls)} reference images to generation")
+            log_event('reference_images', f"✅ Added {len(processed_urls)} reference images to generation",
+                      images=len(processed_urls))
         
-        response = requests.post(
-            f"{Config.KIE_API_URL}/createTask",
-            headers=headers,
-            json=payload,
-            timeout=30
-        )
+        if len(calls) == 1:
+            responses = [(yield from create_task_flow(calls[0], idempotent))]
+        else:
+            responses = yield from create_tasks_flow(calls, idempotent)
         
-        result = response.json()
+        tasks, errors = [], []
+        for (size_config, members), response in zip(groups, responses):
+            if isinstance(response, Exception):
+                result = response
+            else:
+                try:
+                    result = response.json()
+                except ValueError:
+                    result = {'msg': f'HTTP {response.status_code}'}
+            if isinstance(result, dict) and result.get('code') == 200:
+                tasks.append((result['data']['taskId'], size_config, members))
+            else:
+                errors.append((response, result, members))
         
-        if result.get('code') == 200:
-            # Сохраняем генерацию в БД
+        if tasks:
+            # Сохраняем генерацию в БД: строка на платформу, у платформ группы общий taskId
+            now = time.time()
             conn = get_db()
             c = conn.cursor()
-            c.execute('''
-                INSERT INTO generations (user_id, task_id, platform, style, prompt, status)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (session['user_id'], result['data']['taskId'], platform, style, user_prompt, 'processing'))
-            c.execute('UPDATE users SET generations_count = generations_count + 1 WHERE id = ?', (session['user_id'],))
+            for task_id, size_config, members in tasks:
+                c.executemany('''
+                    INSERT INTO generations (user_id, task_id, platform, style, prompt, status, resolution, submitted_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', [(user_id, task_id, platform, style, user_prompt, 'processing', size_config['resolution'], now)
+                      for platform in members])
+                record_upload_refs(c, task_id, processed_urls)
+            # Счётчик генераций - по задачам Kie.ai, а не по строкам платформ
+            c.execute('UPDATE users SET generations_count = generations_count + ? WHERE id = ?',
+                      (len(tasks), user_id))
             conn.commit()
             conn.close()
+            for task_id, size_config, members in tasks:
+                log_event('task_created', 'Задача обложки создана', task_id=task_id,
+                          platform=','.join(members), style=style)
             
+            task_id, size_config, members = tasks[0]
             response_data = {
                 'success': True,
-                'taskId': result['data']['taskId'],
-                'platform': platform,
+                'taskId': task_id,
+                'platform': members[0],
                 'images_used': len(processed_urls) if processed_urls else 0,
                 'image_urls': processed_urls if processed_urls else [],
                 'size': f"{size_config['width']}x{size_config['height']}",
                 'message': f'Задача создана! Генерация началась... {"✅ Используется " + str(len(processed_urls)) + " фото" if processed_urls else ""}'
             }
-            return jsonify(response_data)
-        else:
-            error_msg = result.get('msg', 'API Error')
-            if result.get('code') == 401:
-                error_msg = 'Неверный API токен. Проверьте настройки.'
-            elif result.get('code') == 402:
-                error_msg = 'Недостаточно кредитов на аккаунте Kie.ai'
-            return jsonify({'error': error_msg, 'code': result.get('code')}), 400
+            if len(platforms) > 1:
+                response_data['tasks'] = [{
+                    'taskId': task_id,
+                    'platforms': members,
+                    'aspect_ratio': size_config['aspect_ratio'],
+                    'resolution': size_config['resolution'],
+                    'size': f"{size_config['width']}x{size_config['height']}",
+                } for task_id, size_config, members in tasks]
+                response_data['platforms'] = {platform: task_id for task_id, _, members in tasks
+                                              for platform in members}
+                if errors:
+                    response_data['failed_platforms'] = [platform for _, _, members in errors for platform in members]
+                response_data['message'] = (f'Создано задач: {len(tasks)} для {len(response_data["platforms"])} '
+                                            f'платформ')
+            return response_data, 200
+
+        # Ни одна задача не создана - ответ по первой ошибке. retryable - задача
+        # точно не создана и повтор безопасен (лимит запросов, техработы Kie.ai)
+        response, error, _ = errors[0]
+        if isinstance(error, Exception):
+            raise error
+        error_msg = error.get('msg', 'API Error')
+        if error.get('code') == 401:
+            error_msg = 'Неверный API токен. Проверьте настройки.'
+        elif error.get('code') == 402:
+            error_msg = 'Недостаточно кредитов на аккаунте Kie.ai'
+        return {'error': error_msg, 'code': error.get('code'), 'retryable': retryable_result(response)}, 400
             
+    except CircuitOpenError as e:
+        return e.response()
+    except UpstreamConnectError as e:
+        return {'error': f'Kie.ai недоступен: {e}', 'retryable': True}, 503
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return {'error': str(e)}, 500
 
 
-@app.route('/api/stop/<task_id>', methods=['POST'])
-@app.route('/covers/api/stop/<task_id>', methods=['POST'])
+@bp.route('/api/generate', methods=['POST'])
+@bp.route('/covers/api/generate', methods=['POST'])
 @login_required
-def stop_generation(task_id):
-    """Остановка генерации (помечает задачу как отменённую)"""
+def generate_cover():
+    user_id, data = session['user_id'], request.get_json(silent=True) or {}
+    return flow_response(idempotent_flow(user_id, 'generate_cover', request_idempotency_key(), data,
+                                         lambda idempotent: generate_cover_flow(user_id, data, idempotent)))
+
+
+# ============ АНАЛИТИКА ГЕНЕРАЦИЙ ============
+# У генерации записываются моменты submitted_at (задача создана), running_at
+# (первый ответ Kie.ai 'generating'), completed_at и время работы задачи по
+# данным Kie.ai (upstream_seconds). При завершении генерация ровно один раз
+# попадает в почасовые агрегаты generation_rollups по (платформа, разрешение,
+# стиль) и в гистограмму длительностей generation_latency. Статистика читает
+# только агрегаты: их размер зависит от окна и числа сочетаний, а не от generations.
+
+ROLLUP_BUCKET = 3600  # секунд в одной строке агрегатов
+# Границы корзин гистограммы длительности от создания до готовности, секунд
+GENERATION_LATENCY_BUCKETS = (5, 10, 15, 20, 30, 45, 60, 90, 120, 180, 240, 300, 450, 600, 900, 1800, 3600, float('inf'))
+RUNNING_STATES = ('generating',)
+STATS_DIMENSIONS = ('platform', 'resolution', 'style')
+
+
+def generation_resolution(platform):
+    """Разрешение генерации платформы (комиксы и карикатуры - 2K)"""
+    size = SOCIAL_MEDIA_SIZES.get(platform)
+    return size['resolution'] if size else '2K'
+
+
+def upstream_duration(data):
+    """Время работы задачи в Kie.ai, секунд: costTime или completeTime - createTime (мс)"""
     try:
-        conn = get_db()
-        c = conn.cursor()
-        # Проверяем что задача принадлежит пользователю
-        c.execute('SELECT * FROM generations WHERE task_id = ? AND user_id = ?', (task_id, session['user_id']))
-        generation = c.fetchone()
-        
-        if generation:
-            # Обновляем статус на cancelled
-            c.execute('UPDATE generations SET status = ? WHERE task_id = ?', ('cancelled', task_id))
-            conn.commit()
-            conn.close()
-            return jsonify({'success': True, 'message': 'Генерация остановлена'})
+        if data.get('costTime'):
+            return float(data['costTime']) / 1000
+        if data.get('createTime') and data.get('completeTime'):
+            return (float(data['completeTime']) - float(data['createTime'])) / 1000
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+def mark_generation_running(c, task_id):
+    c.execute('UPDATE generations SET running_at = ? WHERE task_id = ? AND running_at IS NULL',
+              (time.time(), task_id))
+
+
+def finish_generation(c, task_id, status, image_url=None, upstream_seconds=None, user_id=None):
+    """Переводит активную генерацию в конечный статус и добавляет её в агрегаты.
+    False, если генерация уже завершена (другим запросом или отменой)."""
+    now = time.time()
+    status_marks = ','.join('?' * len(ACTIVE_STATUSES))
+    owner = ' AND user_id = ?' if user_id is not None else ''
+    c.execute('BEGIN IMMEDIATE')
+    try:
+        c.execute(f'UPDATE generations SET status = ?, image_url = COALESCE(?, image_url), completed_at = ?, '
+                  f'upstream_seconds = ? WHERE task_id = ? AND status IN ({status_marks}){owner}',
+                  (status, image_url, now, upstream_seconds, task_id, *ACTIVE_STATUSES,
+                   *((user_id,) if user_id is not None else ())))
+        finished = c.rowcount > 0
+        if finished:
+            # У кросспостинга одна задача на несколько платформ: в агрегаты она идёт
+            # один раз, под первой платформой группы (разрешение у группы общее)
+            c.execute('SELECT platform, style, resolution, submitted_at, running_at FROM generations '
+                      'WHERE task_id = ? AND completed_at = ? ORDER BY id LIMIT 1', (task_id, now))
+            record_generation_rollup(c, c.fetchone(), status, now, upstream_seconds)
+        c.execute('COMMIT')
+    except BaseException:
+        c.execute('ROLLBACK')
+        raise
+    if finished:
+        comic_panel_finished(c, task_id)
+    return finished
+
+
+def record_generation_rollup(c, generation, status, completed_at, upstream_seconds):
+    platform = generation['platform'] or ''
+    key = (int(completed_at // ROLLUP_BUCKET * ROLLUP_BUCKET), platform,
+           generation['resolution'] or generation_resolution(platform), generation['style'] or '')
+    submitted, running = generation['submitted_at'], generation['running_at']
+    # Длительность считаем только для готовых: ошибки и отмены быстрые и исказили бы перцентили
+    latency = completed_at - submitted if submitted and status == 'success' else None
+    queued = running - submitted if submitted and running else None
+    c.execute('''
+        INSERT INTO generation_rollups (bucket, platform, resolution, style, total, success, failed, cancelled,
+                                        latency_sum, latency_count, queue_sum, queue_count,
+                                        upstream_sum, upstream_count)
+        VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (bucket, platform, resolution, style) DO UPDATE SET
+            total = total + 1,
+            success = success + excluded.success,
+            failed = failed + excluded.failed,
+            cancelled = cancelled + excluded.cancelled,
+            latency_sum = latency_sum + excluded.latency_sum,
+            latency_count = latency_count + excluded.latency_count,
+            queue_sum = queue_sum + excluded.queue_sum,
+            queue_count = queue_count + excluded.queue_count,
+            upstream_sum = upstream_sum + excluded.upstream_sum,
+            upstream_count = upstream_count + excluded.upstream_count
+    ''', (*key, int(status == 'success'), int(status == 'failed'), int(status == 'cancelled'),
+          latency or 0, int(latency is not None), queued or 0, int(queued is not None),
+          upstream_seconds or 0, int(upstream_seconds is not None)))
+    if latency is not None:
+        c.execute('''
+            INSERT INTO generation_latency (bucket, platform, resolution, style, le_index, count)
+            VALUES (?, ?, ?, ?, ?, 1)
+            ON CONFLICT (bucket, platform, resolution, style, le_index) DO UPDATE SET count = count + 1
+        ''', (*key, bisect.bisect_left(GENERATION_LATENCY_BUCKETS, latency)))
+
+
+def histogram_percentile(counts, q):
+    """Перцентиль по корзинам GENERATION_LATENCY_BUCKETS (линейно внутри корзины)"""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    seen = 0
+    for index, count in enumerate(counts):
+        if count and seen + count >= rank:
+            lower = GENERATION_LATENCY_BUCKETS[index - 1] if index else 0
+            upper = GENERATION_LATENCY_BUCKETS[index]
+            if upper == float('inf'):
+                return lower
+            return lower + (upper - lower) * (rank - seen) / count
+        seen += count
+    return None
+
+
+def generation_stats(hours=24, dimensions=STATS_DIMENSIONS):
+    """Статистика завершённых генераций за последние hours часов по агрегатам"""
+    since = int(time.time() // ROLLUP_BUCKET * ROLLUP_BUCKET) - (hours - 1) * ROLLUP_BUCKET
+    conn = get_db()
+    rollups = conn.execute('SELECT * FROM generation_rollups WHERE bucket >= ?', (since,)).fetchall()
+    latency = conn.execute('SELECT platform, resolution, style, le_index, count FROM generation_latency '
+                           'WHERE bucket >= ?', (since,)).fetchall()
+    conn.close()
+
+    fields = ('total', 'success', 'failed', 'cancelled', 'latency_sum', 'latency_count',
+              'queue_sum', 'queue_count', 'upstream_sum', 'upstream_count')
+    groups = {}
+    for row in rollups:
+        group = groups.setdefault(tuple(row[d] for d in dimensions),
+                                  {'sums': dict.fromkeys(fields, 0), 'histogram': [0] * len(GENERATION_LATENCY_BUCKETS)})
+        for field in fields:
+            group['sums'][field] += row[field]
+    for row in latency:
+        group = groups.get(tuple(row[d] for d in dimensions))
+        if group is not None:
+            group['histogram'][row['le_index']] += row['count']
+
+    def rounded(value):
+        return round(value, 1) if value is not None else None
+
+    result = []
+    for key, group in sorted(groups.items(), key=lambda item: -item[1]['sums']['total']):
+        sums, histogram = group['sums'], group['histogram']
+        finished = sums['success'] + sums['failed']
+        entry = dict(zip(dimensions, key))
+        entry.update({
+            'count': sums['total'],
+            'success': sums['success'],
+            'failed': sums['failed'],
+            'cancelled': sums['cancelled'],
+            'success_rate': round(sums['success'] / finished, 3) if finished else None,
+            'latency_seconds': {
+                'mean': rounded(sums['latency_sum'] / sums['latency_count'] if sums['latency_count'] else None),
+                'p50': rounded(histogram_percentile(histogram, 0.5)),
+                'p90': rounded(histogram_percentile(histogram, 0.9)),
+                'p99': rounded(histogram_percentile(histogram, 0.99)),
+            },
+            'queue_seconds_mean': rounded(sums['queue_sum'] / sums['queue_count'] if sums['queue_count'] else None),
+            'upstream_seconds_mean': rounded(sums['upstream_sum'] / sums['upstream_count']
+                                             if sums['upstream_count'] else None),
+        })
+        result.append(entry)
+    return result
+
+
+@bp.route('/api/admin/generation-stats')
+@bp.route('/covers/api/admin/generation-stats')
+@admin_required
+def generation_stats_api():
+    """Статистика генераций: ?hours=24&by=platform,resolution,style"""
+    hours = max(1, min(request.args.get('hours', 24, type=int), Config.STATS_MAX_HOURS))
+    dimensions = tuple(d for d in request.args.get('by', ','.join(STATS_DIMENSIONS)).split(',')
+                       if d in STATS_DIMENSIONS) or STATS_DIMENSIONS
+    return jsonify({'hours': hours, 'by': list(dimensions), 'groups': generation_stats(hours, dimensions)})
+
+
+# ============ ПРОФИЛИРОВАНИЕ ЗАПРОСОВ ============
+# По заголовку X-Profile от администратора или случайной доле PROFILE_SAMPLE_RATE
+# запрос профилируется. По умолчанию это выборочный профайлер: фоновый поток
+# раз в PROFILE_INTERVAL снимает стек потока запроса (sys._current_frames), и
+# результат сохраняется в формате collapsed stacks (.folded) для flamegraph.pl и
+# speedscope. X-Profile: pstats включает cProfile и сохраняет .pstats. Файлы
+# лежат в PROFILE_DIR/<маршрут>/, на маршрут хранятся последние PROFILE_MAX_FILES.
+# Если профилирование не запрошено, хук только проверяет заголовок.
+# Flow эндпоинты в ASGI режиме (asgi.py) идут мимо Flask хуков и не профилируются.
+
+class StackSampler:
+    """Снимает стеки потоков с открытым профилем; поток живёт, пока есть профили"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.captures = {}  # id потока -> Counter свёрнутых стеков
+        self.thread = None
+
+    def start(self, thread_id):
+        capture = Counter()
+        with self.lock:
+            self.captures[thread_id] = capture
+            if self.thread is None:
+                self.thread = threading.Thread(target=in_app_context(self.run), name='stack-sampler', daemon=True)
+                self.thread.start()
+        return capture
+
+    def stop(self, thread_id):
+        with self.lock:
+            self.captures.pop(thread_id, None)
+
+    def reset(self):
+        # После fork потока сэмплера в дочернем процессе нет
+        self.lock = threading.Lock()
+        self.captures = {}
+        self.thread = None
+
+    def run(self):
+        while True:
+            time.sleep(Config.PROFILE_INTERVAL)
+            with self.lock:
+                if not self.captures:
+                    self.thread = None
+                    return
+                targets = list(self.captures.items())
+            # Кадры сразу сворачиваем в строки и отпускаем: удерживаемый кадр держит и
+            # его локальные переменные (курсоры SQLite), а закрытое соединение с живым
+            # курсором остаётся открытым в SQLite и блокирует запись
+            frames = sys._current_frames()
+            stacks = [(capture, collapse_stack(frames[thread_id])) for thread_id, capture in targets
+                      if thread_id in frames]
+            del frames
+            for capture, stack in stacks:
+                capture[stack] += 1
+
+
+stack_sampler = StackSampler()
+os.register_at_fork(after_in_child=stack_sampler.reset)
+
+
+def collapse_stack(frame):
+    """Стек в строку 'внешняя;...;внутренняя' формата collapsed stacks"""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def profile_route_dir(rule):
+    return re.sub(r'[^A-Za-z0-9]+', '_', rule).strip('_') or 'root'
+
+
+@bp.before_app_request
+def start_profile():
+    if Config.PROFILE_SAMPLE_RATE <= 0 and Config.PROFILE_HEADER not in request.headers:
+        return
+    mode = request.headers.get(Config.PROFILE_HEADER)
+    if mode is not None:
+        if 'user_id' not in session or not is_admin(session['user_id']):
+            return
+    elif random.random() >= Config.PROFILE_SAMPLE_RATE:
+        return
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    name = f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{request.method}-{g.request_id[:16]}"
+    if mode == 'pstats':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+        g.profile = ('pstats', profiler, route, name)
+    else:
+        g.profile = ('folded', stack_sampler.start(threading.get_ident()), route, name)
+
+
+@bp.after_app_request
+def profile_header(response):
+    profile = g.get('profile')
+    if profile is not None and Config.PROFILE_HEADER in request.headers:
+        kind, _, route, name = profile
+        response.headers['X-Profile-Capture'] = f"{profile_route_dir(route)}/{name}.{kind}"
+    return response
+
+
+def rotate_profiles(directory):
+    """Оставляет в каталоге маршрута PROFILE_MAX_FILES самых свежих профилей (по mtime),
+    но не меньше одного: на только что сохранённый ссылается X-Profile-Capture"""
+    files = []
+    for entry in os.scandir(directory):
+        try:
+            files.append((entry.stat().st_mtime_ns, entry.name))
+        except FileNotFoundError:
+            continue  # удалил другой воркер
+    files.sort()
+    for _, name in files[:-max(1, Config.PROFILE_MAX_FILES)]:
+        try:
+            os.remove(os.path.join(directory, name))
+        except FileNotFoundError:
+            pass
+
+
+@bp.teardown_app_request
+def finish_profile(error=None):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return
+    kind, profiler, route, name = profile
+    if kind == 'pstats':
+        profiler.disable()
+    else:
+        stack_sampler.stop(threading.get_ident())
+    try:
+        directory = os.path.join(Config.PROFILE_DIR, profile_route_dir(route))
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{name}.{kind}")
+        if kind == 'pstats':
+            profiler.dump_stats(path)
         else:
-            conn.close()
-            return jsonify({'error': 'Задача не найдена'}), 404
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+            with open(path, 'w', encoding='utf-8') as f:
+                f.writelines(f"{stack} {count}\n" for stack, count in profiler.most_common())
+        rotate_profiles(directory)
+        log_event('profile_saved', f"Профиль {route} сохранён", route=route, file=path)
+    except OSError as e:
+        log_event('profile_save_failed', f"Не удалось сохранить профиль: {e}", level=logging.WARNING)
+
+
+@bp.route('/api/admin/profiles')
+@bp.route('/covers/api/admin/profiles')
+@admin_required
+def list_profiles():
+    """Сохранённые профили, новые первыми"""
+    profiles = []
+    if os.path.isdir(Config.PROFILE_DIR):
+        for route_dir in os.listdir(Config.PROFILE_DIR):
+            directory = os.path.join(Config.PROFILE_DIR, route_dir)
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                stat = os.stat(os.path.join(directory, name))
+                profiles.append({'route': route_dir, 'file': name, 'bytes': stat.st_size,
+                                 'created_at': datetime.fromtimestamp(stat.st_mtime).isoformat(timespec='seconds'),
+                                 'url': f"/covers/api/admin/profiles/{route_dir}/{name}"})
+    profiles.sort(key=lambda p: p['created_at'], reverse=True)
+    return jsonify({'profiles': profiles})
+
+
+@bp.route('/api/admin/profiles/<route_dir>/<name>')
+@bp.route('/covers/api/admin/profiles/<route_dir>/<name>')
+@admin_required
+def download_profile(route_dir, name):
+    return send_from_directory(os.path.join(Config.PROFILE_DIR, secure_filename(route_dir)), name,
+                               as_attachment=True, mimetype='application/octet-stream')
+
+
+SLOW_QUERY_SORTS = {'total': 'total_seconds', 'count': 'count', 'max': 'max_seconds',
+                    'lock_wait': 'lock_wait_seconds', 'last_seen': 'last_seen'}
+
+
+@bp.route('/api/admin/slow-queries')
+@bp.route('/covers/api/admin/slow-queries')
+@admin_required
+def slow_queries_api():
+    """Самые дорогие SQL запросы всех воркеров: ?sort=total|count|max|lock_wait|last_seen&limit=50"""
+    flush_slow_queries()
+    order = SLOW_QUERY_SORTS.get(request.args.get('sort'), 'total_seconds')
+    limit = max(1, min(request.args.get('limit', 50, type=int), Config.SLOW_QUERY_MAX_ROWS))
+    conn = get_db()
+    rows = conn.execute(f'SELECT * FROM slow_queries ORDER BY {order} DESC LIMIT ?', (limit,)).fetchall()
+    conn.close()
+    return jsonify({'threshold_ms': Config.SLOW_QUERY_SECONDS * 1000, 'queries': [{
+        'fingerprint': row['fingerprint'],
+        'sql': row['sql'],
+        'plan': json.loads(row['plan']) if row['plan'] else None,
+        'count': row['count'],
+        'total_ms': round(row['total_seconds'] * 1000, 1),
+        'avg_ms': round(row['total_seconds'] * 1000 / row['count'], 1),
+        'max_ms': round(row['max_seconds'] * 1000, 1),
+        'lock_wait_ms': round(row['lock_wait_seconds'] * 1000, 1),
+        'execution_ms': round(row['execution_seconds'] * 1000, 1),
+        'last_seen': datetime.fromtimestamp(row['last_seen']).isoformat(timespec='seconds'),
+    } for row in rows]})
+
 
+# ============ ОТМЕНА ГЕНЕРАЦИЙ ============
+# cancelled - конечное состояние: check_status отвечает им сразу, не обращаясь
+# к Kie.ai, и результат опроса, пришедший после отмены, его не перезаписывает.
 
-@app.route('/api/status/<task_id>')
-@app.route('/covers/api/status/<task_id>')
+ACTIVE_STATUSES = ('processing',)
+FINISHED_STATUSES = ('success', 'failed', 'cancelled')  # конечные - их удаляет cleanup_old_history
+
+
+def cancel_tasks_flow(user_id, task_ids=None):
+    """Отменяет активные задачи пользователя (все или из task_ids).
+    Возвращает список отменённых task_id."""
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT api_token FROM users WHERE id = ?', (user_id,))
+    user = c.fetchone()
+    status_marks = ','.join('?' * len(ACTIVE_STATUSES))
+    if task_ids is None:
+        c.execute(f'SELECT task_id FROM generations WHERE user_id = ? AND status IN ({status_marks})',
+                  (user_id, *ACTIVE_STATUSES))
+    else:
+        task_ids = [str(t) for t in task_ids][:100]
+        id_marks = ','.join('?' * len(task_ids)) or "''"
+        c.execute(f'SELECT task_id FROM generations WHERE user_id = ? AND status IN ({status_marks}) '
+                  f'AND task_id IN ({id_marks})', (user_id, *ACTIVE_STATUSES, *task_ids))
+    cancelled = [row['task_id'] for row in c.fetchall()
+                 if finish_generation(c, row['task_id'], 'cancelled', user_id=user_id)]
+    conn.close()
+
+    if cancelled and Config.KIE_CANCEL_PATH and user and user['api_token']:
+        headers = {'Authorization': f'Bearer {user["api_token"]}', 'Content-Type': 'application/json'}
+        responses = yield [UpstreamCall('POST', f"{Config.KIE_API_URL}{Config.KIE_CANCEL_PATH}",
+                                        headers=headers, json={'taskId': task_id}, timeout=10)
+                           for task_id in cancelled]
+        # Отмена у Kie.ai - по возможности: у нас задача отменена в любом случае
+        for task_id, response in zip(cancelled, responses):
+            if isinstance(response, Exception) or response.status_code != 200:
+                log_event('kie_cancel_failed', f"Kie.ai cancel failed for {task_id}: {response}",
+                          level=logging.WARNING, task_id=task_id)
+    return cancelled
+
+
+def stop_generation_flow(user_id, task_id):
+    conn = get_db()
+    generation = conn.execute('SELECT status FROM generations WHERE task_id = ? AND user_id = ?',
+                              (task_id, user_id)).fetchone()
+    conn.close()
+    if not generation:
+        return {'error': 'Задача не найдена'}, 404
+    cancelled = yield from cancel_tasks_flow(user_id, [task_id])
+    if cancelled or generation['status'] == 'cancelled':
+        return {'success': True, 'state': 'cancelled', 'message': 'Генерация остановлена'}, 200
+    # Задача уже завершилась - отменять нечего
+    return {'success': True, 'state': generation['status'], 'message': 'Генерация уже завершена'}, 200
+
+
+def stop_all_generations_flow(user_id, data):
+    task_ids = data.get('task_ids')
+    if task_ids is not None and not isinstance(task_ids, list):
+        return {'error': 'task_ids должен быть списком'}, 400
+    cancelled = yield from cancel_tasks_flow(user_id, task_ids)
+    return {'success': True, 'cancelled': cancelled, 'count': len(cancelled),
+            'message': f'Остановлено генераций: {len(cancelled)}'}, 200
+
+
+@bp.route('/api/stop/<task_id>', methods=['POST'])
+@bp.route('/covers/api/stop/<task_id>', methods=['POST'])
 @login_required
-def check_status(task_id):
+def stop_generation(task_id):
+    """Остановка генерации"""
+    return flow_response(stop_generation_flow(session['user_id'], task_id))
+
+
+@bp.route('/api/stop-all', methods=['POST'])
+@bp.route('/covers/api/stop-all', methods=['POST'])
+@login_required
+def stop_all_generations():
+    """Остановка всех активных генераций пользователя (или только task_ids из тела)"""
+    return flow_response(stop_all_generations_flow(session['user_id'], request.get_json(silent=True) or {}))
+
+
+# ============ КЭШ СТАТУСОВ ЗАДАЧ ============
+# Одну задачу опрашивают несколько вкладок, панели комикса и разные воркеры.
+# Ответ recordInfo кэшируется на STATUS_CACHE_TTL секунд (завершённые задачи -
+# до вытеснения) в таблице status_cache, а последние записи ещё и в памяти
+# процесса. Если записи нет, в Kie.ai идёт только владелец аренды (lease_until),
+# остальные ждут его результат - один вызов на задачу, сколько бы ни было опросов.
+# Ключ включает хэш токена: чужой токен не получит результат из кэша.
+
+TERMINAL_STATES = ('success', 'fail')
+status_cache_hot = OrderedDict()  # cache_key -> (result, terminal, fetched_at)
+status_cache_lock = threading.Lock()
+status_cache_stats = {'hot_hits': 0, 'shared_hits': 0, 'upstream_calls': 0, 'coalesced_waits': 0}
+status_cache_writes = 0
+
+
+def status_cache_key(task_id, api_token):
+    return f"{task_id}:{hashlib.sha256(api_token.encode('utf-8')).hexdigest()[:16]}"
+
+
+def compact_record_info(result):
+    """Оставляет из ответа recordInfo только то, что читает check_status"""
+    data = result.get('data') or {}
+    return {'code': result.get('code'),
+            'data': {k: data[k] for k in ('state', 'resultJson', 'failMsg', 'costTime', 'createTime',
+                                          'completeTime') if k in data}}
+
+
+def status_cache_hot_put(key, result, terminal, fetched_at):
+    with status_cache_lock:
+        status_cache_hot[key] = (result, terminal, fetched_at)
+        status_cache_hot.move_to_end(key)
+        while len(status_cache_hot) > Config.STATUS_CACHE_HOT_SIZE:
+            status_cache_hot.popitem(last=False)
+
+
+def status_cache_get(key):
+    """Свежий результат из памяти или SQLite, иначе None"""
+    now = time.time()
+    with status_cache_lock:
+        entry = status_cache_hot.get(key)
+        if entry is not None and (entry[1] or now - entry[2] < Config.STATUS_CACHE_TTL):
+            status_cache_hot.move_to_end(key)
+            status_cache_stats['hot_hits'] += 1
+            return entry[0]
+
+    conn = get_db()
+    row = conn.execute('SELECT payload, terminal, fetched_at FROM status_cache WHERE cache_key = ?',
+                       (key,)).fetchone()
+    conn.close()
+    if row is None or row['payload'] is None:
+        return None
+    if not row['terminal'] and now - row['fetched_at'] >= Config.STATUS_CACHE_TTL:
+        return None
+    result = json.loads(row['payload'])
+    status_cache_hot_put(key, result, bool(row['terminal']), row['fetched_at'])
+    with status_cache_lock:
+        status_cache_stats['shared_hits'] += 1
+    return result
+
+
+def acquire_status_lease(key):
+    """True, если этот запрос будет опрашивать Kie.ai за всех"""
+    now = time.time()
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('''
+        INSERT INTO status_cache (cache_key, lease_until) VALUES (?, ?)
+        ON CONFLICT (cache_key) DO UPDATE SET lease_until = excluded.lease_until
+        WHERE status_cache.lease_until < ?
+    ''', (key, now + Config.STATUS_CACHE_LEASE, now))
+    acquired = c.rowcount == 1
+    conn.close()
+    return acquired
+
+
+def release_status_lease(key):
+    conn = get_db()
+    conn.execute('UPDATE status_cache SET lease_until = 0 WHERE cache_key = ?', (key,))
+    conn.close()
+
+
+def status_cache_put(key, result):
+    """Сохраняет ответ и снимает аренду"""
+    global status_cache_writes
+    result = compact_record_info(result)
+    terminal = result['data'].get('state') in TERMINAL_STATES
+    now = time.time()
+    status_cache_hot_put(key, result, terminal, now)
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('UPDATE status_cache SET payload = ?, terminal = ?, fetched_at = ?, lease_until = 0 '
+              'WHERE cache_key = ?', (json.dumps(result, ensure_ascii=False), int(terminal), now, key))
+    status_cache_writes += 1
+    if status_cache_writes % 100 == 0:
+        # Ограничиваем размер таблицы: вытесняем самые давно обновлённые записи
+        c.execute('''
+            DELETE FROM status_cache WHERE cache_key IN (
+                SELECT cache_key FROM status_cache ORDER BY fetched_at
+                LIMIT max(0, (SELECT COUNT(*) FROM status_cache) - ?)
+            )
+        ''', (Config.STATUS_CACHE_MAX_ROWS,))
+    conn.close()
+
+
+def record_info_flow(task_id, api_token):
+    """Ответ recordInfo через кэш: в Kie.ai идёт только владелец аренды"""
+    key = status_cache_key(task_id, api_token)
+    deadline = time.time() + Config.STATUS_CACHE_LEASE
+    waited = False
+    while True:
+        result = status_cache_get(key)
+        if result is not None:
+            return result
+        if acquire_status_lease(key) or time.time() >= deadline:
+            break
+        if not waited:
+            waited = True
+            with status_cache_lock:
+                status_cache_stats['coalesced_waits'] += 1
+        yield FlowPause(0.1)
+
+    with status_cache_lock:
+        status_cache_stats['upstream_calls'] += 1
+    try:
+        response = yield UpstreamCall('GET', f"{Config.KIE_API_URL}/recordInfo",
+                                      params={'taskId': task_id},
+                                      headers={'Authorization': f'Bearer {api_token}'}, timeout=30)
+        result = response.json()
+    except BaseException:
+        release_status_lease(key)
+        raise
+    if result.get('code') == 200:
+        status_cache_put(key, result)
+    else:
+        # Ошибки (неверный токен и т.п.) не кэшируем
+        release_status_lease(key)
+    return result
+
+
+def check_status_flow(user_id, task_id):
     try:
         conn = get_db()
         c = conn.cursor()
-        c.execute('SELECT api_token FROM users WHERE id = ?', (session['user_id'],))
+        c.execute('SELECT api_token FROM users WHERE id = ?', (user_id,))
         user = c.fetchone()
+        c.execute('SELECT status FROM generations WHERE task_id = ? AND user_id = ?', (task_id, user_id))
+        generation = c.fetchone()
+        conn.close()
         
-        if not user or not user['api_token']:
-            conn.close()
-            return jsonify({'error': 'API токен не настроен'}), 400
-        
-        headers = {'Authorization': f'Bearer {user["api_token"]}'}
+        # Отменённую задачу у Kie.ai больше не опрашиваем
+        if generation and generation['status'] == 'cancelled':
+            return {'state': 'cancelled', 'taskId': task_id, 'message': 'Генерация остановлена'}, 200
         
-        response = requests.get(
-            f"{Config.KIE_API_URL}/recordInfo",
-            params={'taskId': task_id},
-            headers=headers,
-            timeout=30
-        )
+        if not user or not user['api_token']:
+            return {'error': 'API токен не настроен'}, 400
         
-        result = response.json()
+        # Соединение с БД не держим, пока ждём Kie.ai (или другой запрос к той же задаче)
+        result = yield from record_info_flow(task_id, user['api_token'])
+        # generations обновляет любой опрос, увидевший итог, а не только владелец аренды:
+        # если тот упадёт после записи в кэш, строка иначе навсегда останется processing.
+        # finish_generation идемпотентна, а уже завершённые строки даже не трогаем
+        active = generation is not None and generation['status'] in ACTIVE_STATUSES
         
         if result.get('code') == 200:
+            conn = get_db()
+            c = conn.cursor()
             data = result['data']
             state = data.get('state', 'waiting')
             
             response_data = {'state': state, 'taskId': task_id}
             
             if state == 'success':
-                import json
                 result_json = json.loads(data.get('resultJson', '{}'))
                 urls = result_json.get('resultUrls', [])
                 if urls:
                     response_data['imageUrl'] = urls[0]
                     response_data['message'] = 'Обложка готова!'
                     
-                    # Обновляем статус в БД
-                    c.execute('UPDATE generations SET status = ?, image_url = ? WHERE task_id = ?',
-                              ('success', urls[0], task_id))
-                    conn.commit()
+                    if active and finish_generation(c, task_id, 'success', urls[0], upstream_duration(data)):
+                        log_event('task_finished', 'Генерация готова', task_id=task_id, state='success')
             elif state == 'fail':
                 response_data['error'] = data.get('failMsg', 'Generation failed')
-                c.execute('UPDATE generations SET status = ? WHERE task_id = ?', ('failed', task_id))
-                conn.commit()
+                if active and finish_generation(c, task_id, 'failed', upstream_seconds=upstream_duration(data)):
+                    log_event('task_finished', 'Генерация не удалась', level=logging.WARNING,
+                              task_id=task_id, state='fail', reason=response_data['error'])
             else:
                 response_data['message'] = 'Генерация в процессе...'
+                if active and state in RUNNING_STATES:
+                    mark_generation_running(c, task_id)
             
             conn.close()
-            return jsonify(response_data)
+            return response_data, 200
         else:
-            conn.close()
-            return jsonify({'error': 'Failed to check status'}), 400
+            return {'error': 'Failed to check status'}, 400
             
+    except CircuitOpenError as e:
+        return e.response()
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return {'error': str(e)}, 500
 
 
-@app.route('/api/generate-prompt', methods=['POST'])
-@app.route('/covers/api/generate-prompt', methods=['POST'])
+@bp.route('/api/status/<task_id>')
+@bp.route('/covers/api/status/<task_id>')
 @login_required
-def generate_prompt():
+def check_status(task_id):
+    return flow_response(check_status_flow(session['user_id'], task_id))
+
+
+def generate_prompt_flow(user_id, data):
     """Генератор профессиональных промптов на основе темы и желаний пользователя"""
     try:
         # Получаем OpenAI токен пользователя
         conn = get_db()
         c = conn.cursor()
-        c.execute('SELECT openai_token FROM users WHERE id = ?', (session['user_id'],))
+        c.execute('SELECT openai_token FROM users WHERE id = ?', (user_id,))
         user = c.fetchone()
         openai_token = user['openai_token'] if user and user['openai_token'] else None
         conn.close()
         
-        data = request.json
         topic = data.get('topic', '').strip()
         description = data.get('description', '').strip()
         platform = data.get('platform', 'youtube_banner')
@@ -1175,7 +4161,7 @@ def generate_prompt():
         image_format = data.get('format', 'realistic')
         
         if not topic:
-            return jsonify({'error': 'Укажите тему обложки'}), 400
+            return {'error': 'Укажите тему обложки'}, 400
         
         # Получаем конфигурации
         size_config = SOCIAL_MEDIA_SIZES.get(platform, SOCIAL_MEDIA_SIZES['youtube_banner'])
@@ -1183,8 +4169,8 @@ def generate_prompt():
         format_config = IMAGE_FORMATS.get(image_format, IMAGE_FORMATS['realistic'])
         
         # Сначала исправляем тему и описание (русские слова)
-        fixed_topic = fix_prompt_errors(topic, openai_token)
-        fixed_description = fix_prompt_errors(description, openai_token) if description else ""
+        fixed_topic = (yield from fix_prompt_flow(topic, openai_token))
+        fixed_description = (yield from fix_prompt_flow(description, openai_token)) if description else ""
         
         # Генерируем профессиональный промпт
         prompt_parts = []
@@ -1209,9 +4195,9 @@ def generate_prompt():
         generated_prompt = ", ".join(prompt_parts)
         
         # Исправляем ошибки в финальном промпте (используя OpenAI если токен есть)
-        generated_prompt = fix_prompt_errors(generated_prompt, openai_token)
+        generated_prompt = (yield from fix_prompt_flow(generated_prompt, openai_token))
         
-        return jsonify({
+        return {
             'success': True,
             'prompt': generated_prompt,
             'suggestions': [
@@ -1219,14 +4205,22 @@ def generate_prompt():
                 f"Укажите цветовую гамму",
                 f"Опишите настроение (энергичное, спокойное, драматичное)"
             ]
-        })
+        }, 200
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return {'error': str(e)}, 500
+
+
+@bp.route('/api/generate-prompt', methods=['POST'])
+@bp.route('/covers/api/generate-prompt', methods=['POST'])
+@login_required
+def generate_prompt():
+    """Генератор профессиональных промптов на основе темы и желаний пользователя"""
+    return flow_response(generate_prompt_flow(session['user_id'], request.get_json(silent=True) or {}))
 
 
-@app.route('/api/fix-prompt', methods=['POST'])
-@app.route('/covers/api/fix-prompt', methods=['POST'])
+@bp.route('/api/fix-prompt', methods=['POST'])
+@bp.route('/covers/api/fix-prompt', methods=['POST'])
 @login_required
 def fix_prompt_api():
     """API для исправления промпта с помощью OpenAI"""
@@ -1275,23 +4269,41 @@ def cleanup_old_history():
         c = conn.cursor()
         # Удаляем записи старше 3 дней
         cutoff_date = datetime.now() - timedelta(days=3)
-        c.execute('''
+        c.execute(f'''
             DELETE FROM generations 
-            WHERE created_at < ? AND status IN ('completed', 'failed')
-        ''', (cutoff_date.isoformat(),))
+            WHERE created_at < ? AND status IN ({','.join('?' * len(FINISHED_STATUSES))})
+        ''', (cutoff_date.isoformat(), *FINISHED_STATUSES))
         deleted_count = c.rowcount
+        # Собранные комиксы живут столько же, сколько история; ещё не собранные
+        # (кадры генерируются или идёт сборка) не трогаем
+        c.execute("SELECT id, filename FROM comics WHERE created_at < ? AND status NOT IN ('pending', 'composing')",
+                  (cutoff_date.timestamp(),))
+        for comic in c.fetchall():
+            if comic['filename']:
+                try:
+                    os.remove(os.path.join(Config.COMIC_FOLDER, comic['filename']))
+                except FileNotFoundError:
+                    pass
+            c.execute('DELETE FROM comic_panels WHERE comic_id = ?', (comic['id'],))
+            c.execute('DELETE FROM comics WHERE id = ?', (comic['id'],))
+        # Агрегаты статистики храним дольше истории, но не бесконечно
+        c.execute('DELETE FROM generation_rollups WHERE bucket < ?',
+                  (time.time() - Config.ROLLUP_RETENTION.total_seconds(),))
+        c.execute('DELETE FROM generation_latency WHERE bucket < ?',
+                  (time.time() - Config.ROLLUP_RETENTION.total_seconds(),))
         conn.commit()
         conn.close()
         if deleted_count > 0:
-            print(f"🧹 Удалено {deleted_count} записей истории старше 3 дней")
+            log_event('history_cleanup', f"🧹 Удалено {deleted_count} записей истории старше 3 дней",
+                      deleted=deleted_count)
         return deleted_count
     except Exception as e:
-        print(f"Ошибка при очистке истории: {e}")
+        log_event('history_cleanup_failed', f"Ошибка при очистке истории: {e}", level=logging.ERROR)
         return 0
 
 
-@app.route('/api/clear-history', methods=['POST'])
-@app.route('/covers/api/clear-history', methods=['POST'])
+@bp.route('/api/clear-history', methods=['POST'])
+@bp.route('/covers/api/clear-history', methods=['POST'])
 @login_required
 def clear_history():
     """Очистка истории генераций пользователя"""
@@ -1308,7 +4320,268 @@ def clear_history():
         return jsonify({'error': str(e)}), 500
 
 
-@app.route('/covers/history')
+# ============ ПОИСК ПО ИСТОРИИ ============
+# generations_fts - contentless FTS5 индекс по промпту, платформе и стилю; его
+# синхронизируют триггеры init_db. user_id лежит в индексе отдельной колонкой:
+# условие user_id:N пересекается со словами запроса внутри FTS, и работа зависит
+# от истории пользователя, а не от всей таблицы. Слова запроса ищутся по
+# префиксу не длиннее префиксного индекса (одно чтение списка вместо сборки в
+# памяти списков всех подходящих слов), а точное совпадение префикса и
+# релевантность проверяются уже на найденных записях пользователя. bm25 не
+# используем: для IDF он читает списки слова по всем пользователям.
+
+SEARCH_MAX_TERMS = 8
+SEARCH_MAX_LIMIT = 50
+SEARCH_PREFIX_INDEX = 4  # самый длинный префиксный индекс generations_fts
+SEARCH_MAX_CANDIDATES = 2000  # ранжируются последние совпадения пользователя
+# Вес совпадения по колонкам; целое слово весит вдвое больше префикса
+SEARCH_WEIGHTS = (('prompt', 10.0), ('platform', 2.0), ('style', 2.0))
+# Слова как у unicode61: буквы и цифры, подчёркивание - разделитель (youtube_thumbnail)
+search_term_re = re.compile(r'[^\W_]+')
+
+
+search_fold_table = str.maketrans(dict(SEARCH_FOLD_CHARS))
+
+
+def search_fold(text):
+    """Текст так, как его видит индекс: замены SEARCH_FOLD_CHARS (ё -> е), нижний
+    регистр и, как unicode61 remove_diacritics, без диакритик только у латиницы
+    (café -> cafe, а й остаётся й). Одна свёртка для индекса, запроса FTS и
+    history_search_score - иначе кандидаты и ранжирование расходятся"""
+    folded = []
+    for ch in unicodedata.normalize('NFD', text.translate(search_fold_table).lower()):
+        if unicodedata.combining(ch) and folded and unicodedata.name(folded[-1], '').startswith('LATIN'):
+            continue
+        folded.append(ch)
+    return unicodedata.normalize('NFC', ''.join(folded))
+
+
+def history_search_query(text, user_id):
+    """FTS5 запрос кандидатов из текста пользователя"""
+    # Однобуквенные слова без префиксного индекса дороги для FTS, их проверит
+    # только history_search_score
+    prefixes = sorted({term[:SEARCH_PREFIX_INDEX] for term in
+                       search_term_re.findall(search_fold(text))[:SEARCH_MAX_TERMS] if len(term) > 1})
+    query = f'user_id : "{int(user_id)}"'
+    if prefixes:
+        # В кавычках слово не разбирается как синтаксис FTS5 (AND, NEAR, column:)
+        query += ' AND {prompt platform style} : (' + ' AND '.join(f'"{prefix}"*' for prefix in prefixes) + ')'
+    return query
+
+
+def history_search_score(row, terms):
+    """Релевантность записи или None, если какое-то слово запроса не префикс её слов"""
+    columns = [(search_term_re.findall(search_fold(row[name] or '')), weight) for name, weight in SEARCH_WEIGHTS]
+    score = 0.0
+    for term in terms:
+        best = max((weight * (2 if token == term else 1) for tokens, weight in columns
+                    for token in tokens if token.startswith(term)), default=0)
+        if not best:
+            return None
+        score += best
+    return score
+
+
+@bp.route('/api/history/search')
+@bp.route('/covers/api/history/search')
+@login_required
+def search_history():
+    """Поиск по истории генераций: ?q=неон игр&offset=0&limit=20, лучшие совпадения первыми"""
+    text = request.args.get('q', '')
+    terms = search_term_re.findall(search_fold(text))[:SEARCH_MAX_TERMS]
+    if not terms:
+        return jsonify({'error': 'Введите слова для поиска'}), 400
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = max(1, min(request.args.get('limit', 20, type=int), SEARCH_MAX_LIMIT))
+    conn = get_db()
+    try:
+        rows = conn.execute('''
+            SELECT id, task_id, platform, style, prompt, status, image_url, created_at FROM generations
+            WHERE id IN (
+                SELECT rowid FROM generations_fts WHERE generations_fts MATCH ? ORDER BY rowid DESC LIMIT ?
+            )
+        ''', (history_search_query(text, session['user_id']), SEARCH_MAX_CANDIDATES)).fetchall()
+    except sqlite3.OperationalError as e:
+        if 'generations_fts' not in str(e):
+            raise
+        return jsonify({'error': 'Поиск недоступен: SQLite собран без FTS5'}), 503
+    finally:
+        conn.close()
+    scored = []
+    for row in rows:
+        score = history_search_score(row, terms)
+        if score is not None:
+            scored.append((score, row))
+    # При равной релевантности - сначала новые
+    scored.sort(key=lambda item: (-item[0], -item[1]['id']))
+    return jsonify({
+        'results': [dict(row, score=score) for score, row in scored[offset:offset + limit]],
+        'total': len(scored),
+        'offset': offset,
+        'limit': limit,
+        'has_more': offset + limit < len(scored),
+    })
+
+
+# ============ ЭКСПОРТ ИСТОРИИ В ZIP ============
+# /covers/api/history/export собирает ZIP выбранных генераций (ids) или генераций
+# за период (from/to) прямо в ответ: zipfile пишет в ZipStream, а генератор
+# ответа отдаёт накопленное после каждого файла - архив целиком не лежит ни в
+# памяти, ни на диске. Картинки скачиваются в пуле приложения (export_executor) не больше
+# чем по EXPORT_PREFETCH вперёд; одинаковая картинка (кросспостинг - общий
+# taskId) скачивается и кладётся в архив один раз. В конце - manifest.json.
+
+EXPORT_IMAGE_TYPES = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/webp': 'webp'}
+
+
+class ZipStream:
+    """Файловый объект для zipfile без seek: записанное забирает генератор ответа"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def fetch_export_image(url):
+    """(байты, расширение) картинки: локальная загрузка с диска, иначе по URL"""
+    if url.startswith('/covers/uploads/'):
+        path = os.path.join(Config.UPLOAD_FOLDER, secure_filename(url[len('/covers/uploads/'):]))
+        with open(path, 'rb') as f:
+            return f.read(), os.path.splitext(path)[1].lstrip('.') or 'png'
+    response = perform_upstream_call(UpstreamCall('GET', url, timeout=Config.EXPORT_FETCH_TIMEOUT))
+    if response.status_code != 200:
+        raise RuntimeError(f"HTTP {response.status_code}")
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+    extension = EXPORT_IMAGE_TYPES.get(content_type)
+    if extension is None:
+        extension = os.path.splitext(url.split('?', 1)[0])[1].lstrip('.').lower() or 'png'
+    return response.content, extension
+
+
+def prefetch_export_images(urls):
+    """Выдаёт (url, (байты, расширение) или исключение) по порядку, скачивая до EXPORT_PREFETCH вперёд"""
+    urls = iter(urls)
+    pending = deque()
+    try:
+        for url in urls:
+            pending.append((url, app_state().export_executor.submit(in_app_context(fetch_export_image), url)))
+            if len(pending) < Config.EXPORT_PREFETCH:
+                continue
+            url, future = pending.popleft()
+            yield url, future.exception() or future.result()
+        while pending:
+            url, future = pending.popleft()
+            yield url, future.exception() or future.result()
+    finally:
+        # Клиент оборвал скачивание - то, что ещё не началось, не качаем
+        for _, future in pending:
+            future.cancel()
+
+
+def export_selection(user_id, values):
+    """Готовые генерации пользователя по ids (через запятую) или периоду from/to (YYYY-MM-DD)"""
+    conditions, parameters = ["user_id = ?", "status = 'success'", "image_url IS NOT NULL"], [user_id]
+    ids = values.get('ids')
+    if ids:
+        if isinstance(ids, str):
+            ids = ids.split(',')
+        try:
+            ids = [int(value) for value in ids][:Config.EXPORT_MAX_ITEMS]
+        except (TypeError, ValueError):
+            raise ValueError('ids - номера генераций через запятую')
+        conditions.append(f"id IN ({','.join('?' * len(ids))})")
+        parameters += ids
+    for name, operator, shift in (('from', '>=', timedelta(0)), ('to', '<', timedelta(days=1))):
+        if values.get(name):
+            try:
+                day = datetime.strptime(values[name], '%Y-%m-%d') + shift
+            except (TypeError, ValueError):
+                raise ValueError(f'{name} - дата в формате ГГГГ-ММ-ДД')
+            conditions.append(f"created_at {operator} ?")
+            parameters.append(day.strftime('%Y-%m-%d %H:%M:%S'))
+    conn = get_db()
+    rows = conn.execute(f'''
+        SELECT id, task_id, platform, style, prompt, image_url, created_at FROM generations
+        WHERE {' AND '.join(conditions)} ORDER BY created_at DESC, id DESC LIMIT ?
+    ''', (*parameters, Config.EXPORT_MAX_ITEMS)).fetchall()
+    conn.close()
+    return rows
+
+
+def export_archive(rows):
+    """Генератор байтов ZIP: картинки по мере скачивания, затем manifest.json"""
+    images = OrderedDict()
+    for row in rows:
+        images.setdefault(row['image_url'], []).append(row)
+    stream = ZipStream()
+    manifest = []
+    with zipfile.ZipFile(stream, 'w') as archive:
+        for number, (url, result) in enumerate(prefetch_export_images(images), 1):
+            generations = images[url]
+            first = generations[0]
+            entry = {
+                'file': None,
+                'prompt': first['prompt'],
+                'style': first['style'],
+                'platforms': [row['platform'] for row in generations],
+                'generation_ids': [row['id'] for row in generations],
+                'task_id': first['task_id'],
+                'created_at': first['created_at'],
+                'image_url': url,
+            }
+            if isinstance(result, Exception):
+                entry['error'] = str(result)
+                log_event('export_fetch_failed', f"Картинка для экспорта не скачана: {result}",
+                          level=logging.WARNING, task_id=first['task_id'])
+            else:
+                data, extension = result
+                entry['file'] = f"{number:03d}-{secure_filename(first['platform'] or 'cover')}-{first['task_id'][:8]}.{extension}"
+                # PNG и JPEG уже сжаты - кладём без сжатия
+                archive.writestr(zipfile.ZipInfo(entry['file'], date_time=time.localtime()[:6]), data,
+                                 compress_type=zipfile.ZIP_STORED)
+                del data, result
+            manifest.append(entry)
+            chunk = stream.drain()
+            if chunk:
+                yield chunk
+        archive.writestr('manifest.json', json.dumps({'generations': manifest}, ensure_ascii=False, indent=2),
+                         compress_type=zipfile.ZIP_DEFLATED)
+    yield stream.drain()
+
+
+@bp.route('/api/history/export', methods=['GET', 'POST'])
+@bp.route('/covers/api/history/export', methods=['GET', 'POST'])
+@login_required
+def export_history():
+    """ZIP с картинками истории: ?ids=1,2,3 или ?from=2026-01-01&to=2026-01-31 (без параметров - вся история)"""
+    values = request.get_json(silent=True) if request.is_json else None
+    try:
+        rows = export_selection(session['user_id'], values or request.values)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not rows:
+        return jsonify({'error': 'Нет готовых генераций для экспорта'}), 404
+    log_event('history_export', f"📦 Экспорт {len(rows)} генераций", generations=len(rows))
+    response = current_app.response_class(stream_with_context(export_archive(rows)), mimetype='application/zip')
+    response.headers['Content-Disposition'] = \
+        f"attachment; filename=covers-{datetime.now().strftime('%Y%m%d-%H%M')}.zip"
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.cache_control.no_store = True
+    return response
+
+
+@bp.route('/covers/history')
 @login_required
 def history():
     # Автоматическая очистка старых записей
@@ -1320,10 +4593,11 @@ def history():
     # Проверяем есть ли записи которые скоро будут удалены (через 3 дня)
     warning_date = datetime.now() - timedelta(days=2)  # Предупреждение за день до удаления
     cutoff_date = datetime.now() - timedelta(days=3)
-    c.execute('''
+    c.execute(f'''
         SELECT COUNT(*) as count FROM generations 
-        WHERE user_id = ? AND created_at < ? AND created_at > ? AND status IN ('completed', 'failed')
-    ''', (session['user_id'], warning_date.isoformat(), cutoff_date.isoformat()))
+        WHERE user_id = ? AND created_at < ? AND created_at > ?
+        AND status IN ({','.join('?' * len(FINISHED_STATUSES))})
+    ''', (session['user_id'], warning_date.isoformat(), cutoff_date.isoformat(), *FINISHED_STATUSES))
     warning_row = c.fetchone()
     warning_count = warning_row['count'] if warning_row else 0
     
@@ -1357,19 +4631,19 @@ def history():
                          oldest_warning=oldest_warning)
 
 
-@app.route('/api/sizes')
-@app.route('/covers/api/sizes')
+@bp.route('/api/sizes')
+@bp.route('/covers/api/sizes')
 def get_sizes():
     return jsonify(SOCIAL_MEDIA_SIZES)
 
 
-@app.route('/api/styles')
-@app.route('/covers/api/styles')
+@bp.route('/api/styles')
+@bp.route('/covers/api/styles')
 def get_styles():
     return jsonify(DESIGN_STYLES)
 
 
-@app.route('/covers/comics')
+@bp.route('/covers/comics')
 @login_required
 def comics_page():
     """Страница генерации комиксов"""
@@ -1384,10 +4658,10 @@ def comics_page():
     return render_template('comics.html',
                          username=session.get('username'),
                          has_token=has_token,
-                         google_enabled=bool(google))
+                         google_enabled=google_oauth_enabled())
 
 
-@app.route('/covers/caricature')
+@bp.route('/covers/caricature')
 @login_required
 def caricature_page():
     """Страница генерации карикатур"""
@@ -1402,48 +4676,41 @@ def caricature_page():
     return render_template('caricature.html',
                          username=session.get('username'),
                          has_token=has_token,
-                         google_enabled=bool(google))
+                         google_enabled=google_oauth_enabled())
 
 
-@app.route('/api/generate-comics', methods=['POST'])
-@app.route('/covers/api/generate-comics', methods=['POST'])
-@login_required
-def generate_comics():
+def generate_comics_flow(user_id, data, idempotent=False):
     """Генерация комиксов (1-6 блоков)"""
     try:
         # Получаем токены пользователя
         conn = get_db()
         c = conn.cursor()
-        c.execute('SELECT api_token, openai_token FROM users WHERE id = ?', (session['user_id'],))
+        c.execute('SELECT api_token, openai_token FROM users WHERE id = ?', (user_id,))
         user = c.fetchone()
         conn.close()
         
         if not user or not user['api_token']:
-            return jsonify({'error': 'API токен не настроен. Перейдите в настройки.'}), 400
+            return {'error': 'API токен не настроен. Перейдите в настройки.'}, 400
         
         api_token = user['api_token']
         openai_token = user['openai_token'] if user and user['openai_token'] else None
         
-        data = request.json
+        circuit_breakers['kie'].check()
+        
         blocks_count = int(data.get('blocks', 3))  # 1-6 блоков
         style = data.get('style', 'cartoon')  # cartoon или realistic
+        layout = data.get('layout', 'grid')  # раскладка собранного комикса
+        if layout not in COMIC_LAYOUTS:
+            return {'error': f"Раскладка комикса: {', '.join(COMIC_LAYOUTS)}"}, 400
         topic = data.get('topic', '').strip()
         description = data.get('description', '').strip()
         image_urls = data.get('image_urls', [])
         
         # Обрабатываем image_urls
-        processed_urls = []
-        for url in image_urls:
-            url = url.strip()
-            if not url:
-                continue
-            if url.startswith('/covers/uploads/'):
-                url = f"https://2msp.webversy.top{url}"
-            processed_urls.append(url)
-        processed_urls = processed_urls[:6]
+        processed_urls = yield from process_image_urls_flow(image_urls, 6)
         
         if not topic:
-            return jsonify({'error': 'Введите тему комикса'}), 400
+            return {'error': 'Введите тему комикса'}, 400
         
         # Генерируем промпты для каждого блока
         comics_prompts = []
@@ -1473,19 +4740,15 @@ def generate_comics():
                     "max_tokens": 500
                 }
                 
-                response = requests.post(
-                    'https://api.openai.com/v1/chat/completions',
-                    headers=headers,
-                    json=payload,
-                    timeout=15
-                )
+                response = yield UpstreamCall('POST', Config.OPENAI_API_URL,
+                                              headers=headers, json=payload, timeout=15)
                 
                 if response.status_code == 200:
                     result = response.json()
                     generated_text = result['choices'][0]['message']['content'].strip()
                     comics_prompts = [p.strip() for p in generated_text.split('\n') if p.strip()][:blocks_count]
             except Exception as e:
-                print(f"OpenAI error for comics: {e}")
+                log_event('openai_error', f"OpenAI error for comics: {e}", level=logging.WARNING)
         
         # Если OpenAI не сработал, генерируем простые промпты
         if not comics_prompts or len(comics_prompts) < blocks_count:
@@ -1511,10 +4774,11 @@ def generate_comics():
             final_prompts.append(final_prompt)
         
         # Генерируем изображения для каждого блока
-        task_ids = []
+        calls = []
+        block_prompts = []
         for i, prompt in enumerate(final_prompts):
             # Исправляем промпт
-            fixed_prompt = fix_prompt_errors(prompt, openai_token)
+            fixed_prompt = (yield from fix_prompt_flow(prompt, openai_token))
             
             # Создаём задачу генерации (используем тот же формат что и для обложек)
             payload = {
@@ -1532,20 +4796,27 @@ def generate_comics():
                 payload["input"]["image_prompts"] = [
                     {"url": url, "weight": 0.7} for url in processed_urls
                 ]
-                print(f"✅ Added {len(processed_urls)} reference images to comics generation block {i+1}")
+                log_event('reference_images', f"✅ Added {len(processed_urls)} reference images to comics block {i+1}",
+                          images=len(processed_urls), block=i + 1)
             
             headers = {
                 "Authorization": f"Bearer {api_token}",
                 "Content-Type": "application/json"
             }
             
+            calls.append(UpstreamCall('POST', f"{Config.KIE_API_URL}/createTask",
+                                      headers=headers, json=payload, timeout=30))
+            block_prompts.append(fixed_prompt)
+        
+        # Задачи для всех блоков создаём параллельно
+        responses = yield from create_tasks_flow(calls, idempotent)
+        
+        task_ids = []
+        for i, response in enumerate(responses):
+            fixed_prompt = block_prompts[i]
             try:
-                response = requests.post(
-                    f"{Config.KIE_API_URL}/createTask",
-                    headers=headers,
-                    json=payload,
-                    timeout=30
-                )
+                if isinstance(response, Exception):
+                    raise response
                 
                 result = response.json()
                 
@@ -1557,67 +4828,343 @@ def generate_comics():
                         'prompt': fixed_prompt
                     })
                 else:
-                    print(f"Error creating task for block {i+1}: {result}")
+                    log_event('create_task_failed', f"Error creating task for block {i+1}: {result}",
+                              level=logging.WARNING, block=i + 1)
             except Exception as e:
-                print(f"Exception creating task for block {i+1}: {e}")
+                log_event('create_task_failed', f"Exception creating task for block {i+1}: {e}",
+                          level=logging.WARNING, block=i + 1)
         
         if not task_ids:
-            return jsonify({
+            rejected = [r for r in responses if isinstance(r, CircuitOpenError)]
+            if rejected:
+                raise rejected[0]
+            return {
                 'error': 'Не удалось создать задачи генерации. Проверьте API токен и баланс кредитов на Kie.ai.',
                 'details': 'Возможно, проблема с API токеном или недостаточно кредитов'
-            }), 500
+            }, 500
         
         # Сохраняем в БД
         conn = get_db()
         c = conn.cursor()
         for task_info in task_ids:
             c.execute('''
-                INSERT INTO generations (user_id, task_id, platform, style, prompt, status)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (session['user_id'], task_info['task_id'], 'comics', style, task_info['prompt'], 'processing'))
+                INSERT INTO generations (user_id, task_id, platform, style, prompt, status, resolution, submitted_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, task_info['task_id'], 'comics', style, task_info['prompt'], 'processing',
+                  '2K', time.time()))
+            record_upload_refs(c, task_info['task_id'], processed_urls)
+        comic_id = create_comic(c, user_id, layout, task_ids)
         conn.commit()
         conn.close()
+        for task_info in task_ids:
+            log_event('task_created', 'Задача блока комикса создана', task_id=task_info['task_id'],
+                      platform='comics', style=style)
         
-        return jsonify({
+        return {
             'success': True,
             'blocks': blocks_count,
             'task_ids': task_ids,
+            'comicId': comic_id,
             'images_used': len(processed_urls) if processed_urls else 0,
             'message': f'Генерация комикса из {blocks_count} блоков начата! {"✅ Используется " + str(len(processed_urls)) + " фото" if processed_urls else ""}'
-        })
+        }, 200
         
+    except CircuitOpenError as e:
+        return e.response()
     except Exception as e:
-        print(f"Exception in generate_comics: {e}")
-        import traceback
-        traceback.print_exc()
-        return jsonify({'error': f'Ошибка при генерации комикса: {str(e)}'}), 500
+        log_event('generate_comics_failed', f"Exception in generate_comics: {e}", level=logging.ERROR, exc_info=True)
+        return {'error': f'Ошибка при генерации комикса: {str(e)}'}, 500
 
 
-@app.route('/api/generate-caricature', methods=['POST'])
-@app.route('/covers/api/generate-caricature', methods=['POST'])
+@bp.route('/api/generate-comics', methods=['POST'])
+@bp.route('/covers/api/generate-comics', methods=['POST'])
 @login_required
-def generate_caricature():
+def generate_comics():
+    """Генерация комиксов (1-6 блоков)"""
+    user_id, data = session['user_id'], request.get_json(silent=True) or {}
+    return flow_response(idempotent_flow(user_id, 'generate_comics', request_idempotency_key(), data,
+                                         lambda idempotent: generate_comics_flow(user_id, data, idempotent)))
+
+
+# ============ СБОРКА КОМИКСОВ ============
+# Кадры комикса - отдельные задачи Kie.ai (comic_panels связывает комикс с их
+# task_id). Когда последний кадр переходит в success (finish_generation, из
+# любого пути: опрос статуса, пакеты), комикс уходит в пул сборки: кадры
+# скачиваются параллельно (список UpstreamCall в run_flow), уменьшаются до
+# COMIC_PANEL_MAX и раскладываются сеткой или лентой с отступами на белом фоне.
+# Результат - один прогрессивный JPEG в COMIC_FOLDER, имя с id комикса не меняется.
+
+COMIC_LAYOUTS = ('grid', 'strip', 'column')
+COMIC_BACKGROUND = (255, 255, 255)
+
+
+def comic_grid(count, layout):
+    """(колонок, строк) раскладки: лента - в ряд, column - друг под другом, сетка - в 2 строки"""
+    if layout == 'strip':
+        return count, 1
+    if layout == 'column':
+        return 1, count
+    columns = count if count <= 3 else (count + 1) // 2
+    return columns, (count + columns - 1) // columns
+
+
+def comic_filename(comic_id):
+    return f"{comic_id}.jpg"
+
+
+def create_comic(c, user_id, layout, task_ids):
+    """Запись комикса и его кадров; task_ids - [{'block', 'task_id'}] из generate_comics_flow"""
+    comic_id = uuid.uuid4().hex
+    c.execute('INSERT INTO comics (id, user_id, layout, status, panels, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+              (comic_id, user_id, layout, 'pending', len(task_ids), time.time()))
+    c.executemany('INSERT INTO comic_panels (comic_id, block, task_id) VALUES (?, ?, ?)',
+                  [(comic_id, task['block'], task['task_id']) for task in task_ids])
+    return comic_id
+
+
+def comic_panel_finished(c, task_id):
+    """Вызывается после завершения генерации: если это кадр комикса - проверяем комикс"""
+    c.execute('SELECT comic_id FROM comic_panels WHERE task_id = ?', (task_id,))
+    row = c.fetchone()
+    if row is not None:
+        schedule_comic_composition(row['comic_id'])
+
+
+def schedule_comic_composition(comic_id):
+    """Ставит комикс в пул сборки, когда все кадры готовы (ровно один раз);
+    если какой-то кадр не удался - комикс не собирается"""
+    now = time.time()
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT g.status FROM comic_panels p LEFT JOIN generations g ON g.task_id = p.task_id '
+              'WHERE p.comic_id = ?', (comic_id,))
+    statuses = [row['status'] for row in c.fetchall()]
+    if any(status not in ACTIVE_STATUSES + ('success',) for status in statuses):
+        c.execute("UPDATE comics SET status = 'failed', error = ? WHERE id = ? AND status = 'pending'",
+                  ('Не все кадры комикса сгенерированы', comic_id))
+        conn.close()
+        return False
+    if not statuses or any(status != 'success' for status in statuses):
+        conn.close()
+        return False
+    # Сборку, зависшую дольше COMIC_COMPOSE_TIMEOUT (воркер умер), можно начать заново
+    c.execute("UPDATE comics SET status = 'composing', claimed_at = ? WHERE id = ? AND "
+              "(status = 'pending' OR (status = 'composing' AND claimed_at < ?))",
+              (now, comic_id, now - Config.COMIC_COMPOSE_TIMEOUT))
+    claimed = c.rowcount > 0
+    conn.close()
+    if claimed:
+        app_state().comic_executor.submit(in_app_context(compose_comic), comic_id)
+    return claimed
+
+
+def compose_comic(comic_id):
+    """Сборка комикса в потоке comic_executor"""
+    started = time.time()
+    try:
+        result = run_flow(compose_comic_flow(comic_id))
+        error = None
+    except Exception as e:
+        result, error = None, str(e)
+        log_event('comic_compose_failed', f"Ошибка сборки комикса {comic_id}: {e}", level=logging.WARNING,
+                  exc_info=True, comic_id=comic_id)
+    conn = get_db()
+    if result is not None:
+        width, height, size = result
+        conn.execute("UPDATE comics SET status = 'ready', filename = ?, width = ?, height = ?, bytes = ?, "
+                     "composed_at = ?, error = NULL WHERE id = ?",
+                     (comic_filename(comic_id), width, height, size, time.time(), comic_id))
+        log_event('comic_composed', f"🗞️ Комикс {comic_id} собран: {width}x{height}, {size} байт",
+                  comic_id=comic_id, width=width, height=height, bytes=size,
+                  duration_ms=round((time.time() - started) * 1000, 1))
+    else:
+        conn.execute("UPDATE comics SET status = 'failed', error = ? WHERE id = ?", (error, comic_id))
+    conn.close()
+
+
+def comic_panel_size(width, height):
+    """Размер кадра на холсте: длинная сторона не больше COMIC_PANEL_MAX"""
+    scale = min(1.0, Config.COMIC_PANEL_MAX / max(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def compose_comic_flow(comic_id):
+    """Скачивает кадры, раскладывает и сохраняет комикс; возвращает (ширина, высота, байт)"""
+    try:
+        from PIL import Image
+    except ImportError:
+        raise RuntimeError('Для сборки комиксов нужен Pillow')
+
+    conn = get_db()
+    comic = conn.execute('SELECT user_id, layout FROM comics WHERE id = ?', (comic_id,)).fetchone()
+    panels = conn.execute('SELECT p.block, g.image_url FROM comic_panels p JOIN generations g ON g.task_id = p.task_id '
+                          'WHERE p.comic_id = ? ORDER BY p.block', (comic_id,)).fetchall()
+    conn.close()
+    start_log_context(None, comic['user_id'])
+
+    # Кадры скачиваются параллельно, а распаковываются по одному: в памяти холст,
+    # сжатые ответы и один кадр, а не все кадры в полном размере сразу
+    responses = list((yield [UpstreamCall('GET', panel['image_url'], timeout=60) for panel in panels]))
+    sizes = []
+    for panel, response in zip(panels, responses):
+        if isinstance(response, Exception):
+            raise RuntimeError(f"Кадр {panel['block']} не скачан: {response}")
+        if response.status_code != 200:
+            raise RuntimeError(f"Кадр {panel['block']} не скачан: HTTP {response.status_code}")
+        with Image.open(io.BytesIO(response.content)) as image:  # читается только заголовок
+            sizes.append(comic_panel_size(*image.size))
+
+    gutter = Config.COMIC_GUTTER
+    columns, rows = comic_grid(len(sizes), comic['layout'])
+    cell_width = max(size[0] for size in sizes)
+    cell_height = max(size[1] for size in sizes)
+    width = columns * cell_width + (columns + 1) * gutter
+    height = rows * cell_height + (rows + 1) * gutter
+    canvas = Image.new('RGB', (width, height), COMIC_BACKGROUND)
+    try:
+        for index, size in enumerate(sizes):
+            with Image.open(io.BytesIO(responses[index].content)) as image:
+                image.draft('RGB', size)  # JPEG распаковывается сразу в уменьшенном масштабе
+                tile = image.convert('RGB').resize(size, Image.LANCZOS)
+            responses[index] = None
+            column, row = index % columns, index // columns
+            # Кадр другого размера - по центру своей ячейки
+            canvas.paste(tile, (gutter + column * (cell_width + gutter) + (cell_width - size[0]) // 2,
+                                gutter + row * (cell_height + gutter) + (cell_height - size[1]) // 2))
+            tile.close()
+    except BaseException:
+        canvas.close()
+        raise
+
+    os.makedirs(Config.COMIC_FOLDER, exist_ok=True)
+    path = os.path.join(Config.COMIC_FOLDER, comic_filename(comic_id))
+    # Пишем во временный файл: читатели видят либо старый файл, либо готовый новый
+    partial = f"{path}.{os.getpid()}.part"
+    try:
+        canvas.save(partial, 'JPEG', quality=Config.COMIC_JPEG_QUALITY, optimize=True, progressive=True)
+        os.replace(partial, path)
+    finally:
+        canvas.close()
+        if os.path.exists(partial):
+            os.remove(partial)
+    return width, height, os.path.getsize(path)
+
+
+def get_user_comic(comic_id, user_id):
+    conn = get_db()
+    comic = conn.execute('SELECT * FROM comics WHERE id = ? AND user_id = ?', (comic_id, user_id)).fetchone()
+    conn.close()
+    return comic
+
+
+@bp.route('/api/comics/<comic_id>')
+@bp.route('/covers/api/comics/<comic_id>')
+@login_required
+def comic_status(comic_id):
+    """Состояние комикса, кадры и ссылка на собранное изображение"""
+    comic = get_user_comic(comic_id, session['user_id'])
+    if not comic:
+        return jsonify({'error': 'Комикс не найден'}), 404
+    if comic['status'] in ('pending', 'composing'):
+        # Сборка могла потеряться вместе с воркером - проверяем кадры заново
+        if schedule_comic_composition(comic_id):
+            comic = get_user_comic(comic_id, session['user_id'])
+    conn = get_db()
+    panels = conn.execute('SELECT p.block, p.task_id, g.status, g.image_url FROM comic_panels p '
+                          'LEFT JOIN generations g ON g.task_id = p.task_id WHERE p.comic_id = ? ORDER BY p.block',
+                          (comic_id,)).fetchall()
+    conn.close()
+    body = {
+        'comicId': comic_id,
+        'status': comic['status'],
+        'layout': comic['layout'],
+        'panels': [{'block': panel['block'], 'taskId': panel['task_id'], 'status': panel['status'],
+                    'imageUrl': panel['image_url']} for panel in panels],
+        'error': comic['error'],
+    }
+    if comic['status'] == 'ready':
+        body.update(imageUrl=f"/covers/api/comics/{comic_id}/image", streamUrl=f"/covers/api/comics/{comic_id}/stream",
+                    width=comic['width'], height=comic['height'], bytes=comic['bytes'])
+    return jsonify(body)
+
+
+def ready_comic_path(comic_id):
+    """Путь к собранному комиксу пользователя или None"""
+    comic = get_user_comic(comic_id, session['user_id'])
+    if not comic or comic['status'] != 'ready':
+        return None
+    path = os.path.join(Config.COMIC_FOLDER, comic['filename'])
+    return path if os.path.isfile(path) else None
+
+
+@bp.route('/api/comics/<comic_id>/image')
+@bp.route('/covers/api/comics/<comic_id>/image')
+@login_required
+def comic_image(comic_id):
+    """Собранный комикс: ETag, Range и кэш браузера (файл после сборки не меняется)"""
+    path = ready_comic_path(comic_id)
+    if path is None:
+        return jsonify({'error': 'Комикс ещё не собран'}), 404
+    response = send_from_directory(Config.COMIC_FOLDER, os.path.basename(path), max_age=Config.UPLOAD_CACHE_MAX_AGE,
+                                   as_attachment=request.args.get('download') == '1',
+                                   download_name=f"comic-{comic_id}.jpg")
+    # За логином - только кэш браузера, не общих прокси
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.immutable = True
+    return response
+
+
+@bp.route('/api/comics/<comic_id>/stream')
+@bp.route('/covers/api/comics/<comic_id>/stream')
+@login_required
+def comic_stream(comic_id):
+    """Собранный комикс порциями по COMIC_STREAM_CHUNK без буферизации в nginx: большая
+    раскладка (лента из 6 кадров) начинает показываться до окончания загрузки"""
+    path = ready_comic_path(comic_id)
+    if path is None:
+        return jsonify({'error': 'Комикс ещё не собран'}), 404
+
+    def generate(f):
+        with f:
+            while True:
+                chunk = f.read(Config.COMIC_STREAM_CHUNK)
+                if not chunk:
+                    break
+                yield chunk
+
+    f = open(path, 'rb')
+    response = current_app.response_class(stream_with_context(generate(f)), mimetype='image/jpeg', direct_passthrough=True)
+    response.headers['Content-Length'] = str(os.fstat(f.fileno()).st_size)
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.cache_control.private = True
+    response.cache_control.no_store = True
+    return response
+
+
+def generate_caricature_flow(user_id, data, idempotent=False):
     """Генерация карикатуры"""
     try:
         # Получаем токены пользователя
         conn = get_db()
         c = conn.cursor()
-        c.execute('SELECT api_token, openai_token FROM users WHERE id = ?', (session['user_id'],))
+        c.execute('SELECT api_token, openai_token FROM users WHERE id = ?', (user_id,))
         user = c.fetchone()
         conn.close()
         
         if not user or not user['api_token']:
-            return jsonify({'error': 'API токен не настроен. Перейдите в настройки.'}), 400
+            return {'error': 'API токен не настроен. Перейдите в настройки.'}, 400
         
         api_token = user['api_token']
         openai_token = user['openai_token'] if user and user['openai_token'] else None
         
-        data = request.json
+        circuit_breakers['kie'].check()
+        
         prompt = data.get('prompt', '').strip()
         image_urls = data.get('image_urls', [])
         
         if not prompt:
-            return jsonify({'error': 'Введите описание карикатуры'}), 400
+            return {'error': 'Введите описание карикатуры'}, 400
         
         # Формируем промпт для карикатуры
         caricature_prompt = f"caricature style, {prompt}, exaggerated features, humorous, cartoon portrait, single character, full body or portrait"
@@ -1629,18 +5176,10 @@ def generate_caricature():
                 caricature_prompt += f", {photo_refs}, use these reference images to create caricature"
         
         # Исправляем промпт
-        fixed_prompt = fix_prompt_errors(caricature_prompt, openai_token)
+        fixed_prompt = (yield from fix_prompt_flow(caricature_prompt, openai_token))
         
         # Обрабатываем image_urls
-        processed_urls = []
-        for url in image_urls:
-            url = url.strip()
-            if not url:
-                continue
-            if url.startswith('/covers/uploads/'):
-                url = f"https://2msp.webversy.top{url}"
-            processed_urls.append(url)
-        processed_urls = processed_urls[:6]
+        processed_urls = yield from process_image_urls_flow(image_urls, 6)
         
         # Создаём задачу генерации (используем тот же формат что и для обложек)
         payload = {
@@ -1658,7 +5197,8 @@ def generate_caricature():
             payload["input"]["image_prompts"] = [
                 {"url": url, "weight": 0.7} for url in processed_urls
             ]
-            print(f"✅ Added {len(processed_urls)} reference images to caricature generation")
+            log_event('reference_images', f"✅ Added {len(processed_urls)} reference images to caricature generation",
+                      images=len(processed_urls))
         
         headers = {
             "Authorization": f"Bearer {api_token}",
@@ -1666,12 +5206,9 @@ def generate_caricature():
         }
         
         try:
-            response = requests.post(
-                f"{Config.KIE_API_URL}/createTask",
-                headers=headers,
-                json=payload,
-                timeout=30
-            )
+            response = yield from create_task_flow(UpstreamCall('POST', f"{Config.KIE_API_URL}/createTask",
+                                                                headers=headers, json=payload, timeout=30),
+                                                   idempotent)
             
             result = response.json()
             
@@ -1682,39 +5219,578 @@ def generate_caricature():
                 conn = get_db()
                 c = conn.cursor()
                 c.execute('''
-                    INSERT INTO generations (user_id, task_id, platform, style, prompt, status)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (session['user_id'], task_id, 'caricature', 'caricature', fixed_prompt, 'processing'))
+                    INSERT INTO generations (user_id, task_id, platform, style, prompt, status,
+                                             resolution, submitted_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', (user_id, task_id, 'caricature', 'caricature', fixed_prompt, 'processing',
+                      '2K', time.time()))
+                record_upload_refs(c, task_id, processed_urls)
                 conn.commit()
                 conn.close()
+                log_event('task_created', 'Задача карикатуры создана', task_id=task_id, platform='caricature')
                 
-                return jsonify({
+                return {
                     'success': True,
                     'taskId': task_id,
                     'prompt': fixed_prompt,
                     'images_used': len(processed_urls) if processed_urls else 0,
                     'message': f'Генерация карикатуры начата! {"✅ Используется " + str(len(processed_urls)) + " фото" if processed_urls else ""}'
-                })
+                }, 200
             else:
                 error_msg = result.get('msg', 'API Error')
                 if result.get('code') == 401:
                     error_msg = 'Неверный API токен. Проверьте настройки.'
                 elif result.get('code') == 402:
                     error_msg = 'Недостаточно кредитов на аккаунте Kie.ai'
-                return jsonify({'error': error_msg, 'code': result.get('code')}), 400
+                return {'error': error_msg, 'code': result.get('code')}, 400
                 
+        except CircuitOpenError:
+            raise
         except Exception as e:
-            print(f"Exception creating caricature task: {e}")
-            return jsonify({'error': f'Ошибка при создании задачи: {str(e)}'}), 500
+            log_event('create_task_failed', f"Exception creating caricature task: {e}", level=logging.ERROR,
+                      exc_info=True)
+            return {'error': f'Ошибка при создании задачи: {str(e)}'}, 500
         
+    except CircuitOpenError as e:
+        return e.response()
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return {'error': str(e)}, 500
+
+
+@bp.route('/api/generate-caricature', methods=['POST'])
+@bp.route('/covers/api/generate-caricature', methods=['POST'])
+@login_required
+def generate_caricature():
+    """Генерация карикатуры"""
+    user_id, data = session['user_id'], request.get_json(silent=True) or {}
+    return flow_response(idempotent_flow(user_id, 'generate_caricature', request_idempotency_key(), data,
+                                         lambda idempotent: generate_caricature_flow(user_id, data, idempotent)))
+
+
+# ============ ПАКЕТНАЯ ГЕНЕРАЦИЯ ============
+# POST /covers/api/batches принимает список обложек (JSON или CSV) и сразу
+# отвечает 202: пакет и его элементы лежат в batches / batch_items, а задачи в
+# Kie.ai создаёт фоновый планировщик. Раз в BATCH_TICK секунд один из воркеров
+# (flock, как у сборщика загрузок) опрашивает статусы отправленных элементов и
+# отправляет новые: не больше concurrency одновременно на пакет и не больше
+# BATCH_SUBMIT_RATE задач в секунду на всех; пока breaker Kie.ai разомкнут,
+# новые не отправляются. Элемент проходит queued -> submitting -> processing ->
+# success / failed / cancelled; задача создаётся и опрашивается тем же
+# generate_cover_flow / check_status_flow, что и у обычной генерации.
+
+BATCH_ITEM_ACTIVE = ('submitting', 'processing')
+BATCH_ITEM_TERMINAL = ('success', 'failed', 'cancelled')
+BATCH_CSV_FIELDS = ('prompt', 'platform', 'style', 'format', 'image_urls')
+
+
+def parse_batch_items(rows):
+    """Проверяет элементы пакета: (items, ошибки по строкам)"""
+    items, errors = [], []
+    for number, row in enumerate(rows, 1):
+        if not isinstance(row, dict):
+            errors.append({'row': number, 'error': 'Элемент должен быть объектом'})
+            continue
+        prompt = str(row.get('prompt') or '').strip()
+        platform = row.get('platform') or 'youtube_thumbnail'
+        style = row.get('style') or 'modern'
+        image_format = row.get('format') or 'realistic'
+        image_urls = row.get('image_urls') or []
+        if isinstance(image_urls, str):
+            # В CSV ссылки через пробел или |
+            image_urls = image_urls.replace('|', ' ').split()
+        if not prompt:
+            errors.append({'row': number, 'error': 'Нет промпта'})
+        elif platform not in SOCIAL_MEDIA_SIZES:
+            errors.append({'row': number, 'error': f'Неизвестная платформа {platform}'})
+        elif style not in DESIGN_STYLES:
+            errors.append({'row': number, 'error': f'Неизвестный стиль {style}'})
+        elif image_format not in IMAGE_FORMATS:
+            errors.append({'row': number, 'error': f'Неизвестный формат {image_format}'})
+        elif not isinstance(image_urls, list):
+            errors.append({'row': number, 'error': 'image_urls должен быть списком'})
+        else:
+            items.append((prompt, platform, style, image_format, json.dumps([str(u) for u in image_urls[:5]])))
+    return items, errors
+
+
+def batch_request_rows():
+    """Элементы из JSON {"items": [...]} или CSV (тело text/csv или файл file)"""
+    upload = request.files.get('file')
+    if upload is not None or request.mimetype == 'text/csv':
+        text = (upload.read() if upload is not None else request.get_data()).decode('utf-8-sig', errors='replace')
+        return list(csv.DictReader(io.StringIO(text))), request.form.get('concurrency', request.args.get('concurrency'))
+    data = request.get_json(silent=True) or {}
+    rows = data.get('items') if isinstance(data, dict) else None
+    return rows, data.get('concurrency') if isinstance(data, dict) else None
+
+
+@bp.route('/api/batches', methods=['POST'])
+@bp.route('/covers/api/batches', methods=['POST'])
+@login_required
+def create_batch():
+    """Создание пакета генераций"""
+    user_id = session['user_id']
+    rows, concurrency = batch_request_rows()
+    if not isinstance(rows, list) or not rows:
+        return jsonify({'error': 'Передайте items (JSON) или CSV с колонкой prompt'}), 400
+    if len(rows) > Config.BATCH_MAX_ITEMS:
+        return jsonify({'error': f'Не больше {Config.BATCH_MAX_ITEMS} элементов в пакете'}), 400
+    items, errors = parse_batch_items(rows)
+    if errors:
+        return jsonify({'error': 'Ошибки в элементах пакета', 'details': errors[:20],
+                        'invalid': len(errors)}), 400
+    try:
+        concurrency = int(concurrency or Config.BATCH_DEFAULT_CONCURRENCY)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'concurrency должен быть числом'}), 400
+    concurrency = max(1, min(concurrency, Config.BATCH_MAX_CONCURRENCY))
+
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT api_token FROM users WHERE id = ?', (user_id,))
+    user = c.fetchone()
+    if not user or not user['api_token']:
+        conn.close()
+        return jsonify({'error': 'API токен не настроен. Перейдите в настройки.'}), 400
+    batch_id = uuid.uuid4().hex
+    c.execute('BEGIN IMMEDIATE')
+    c.execute('INSERT INTO batches (id, user_id, status, total, concurrency, created_at) VALUES (?, ?, ?, ?, ?, ?)',
+              (batch_id, user_id, 'running', len(items), concurrency, time.time()))
+    c.executemany('''
+        INSERT INTO batch_items (batch_id, position, prompt, platform, style, format, image_urls, status)
+        VALUES (?, ?, ?, ?, ?, ?, ?, 'queued')
+    ''', [(batch_id, position, *item) for position, item in enumerate(items, 1)])
+    # Фото элементов не должен удалить сборщик загрузок, пока пакет не отправлен
+    record_upload_refs(c, f"batch:{batch_id}", {url for item in items for url in json.loads(item[4])})
+    c.execute('COMMIT')
+    conn.close()
+    start_batch_scheduler()
+    log_event('batch_created', f"Пакет из {len(items)} генераций", batch_id=batch_id, items=len(items),
+              concurrency=concurrency)
+    return jsonify({'success': True, 'batchId': batch_id, 'total': len(items), 'concurrency': concurrency,
+                    'message': f'Пакет принят: {len(items)} обложек'}), 202
+
+
+def batch_counts(c, batch_ids):
+    """{batch_id: {статус элемента: число}}"""
+    counts = {batch_id: {} for batch_id in batch_ids}
+    if batch_ids:
+        marks = ','.join('?' * len(batch_ids))
+        c.execute(f'SELECT batch_id, status, COUNT(*) AS n FROM batch_items WHERE batch_id IN ({marks}) '
+                  f'GROUP BY batch_id, status', batch_ids)
+        for row in c.fetchall():
+            counts[row['batch_id']][row['status']] = row['n']
+    return counts
+
+
+def batch_summary(batch, counts):
+    done = sum(counts.get(status, 0) for status in BATCH_ITEM_TERMINAL)
+    return {
+        'batchId': batch['id'],
+        'status': batch['status'],
+        'total': batch['total'],
+        'concurrency': batch['concurrency'],
+        'counts': counts,
+        'progress': round(done / batch['total'], 3) if batch['total'] else 1.0,
+        'created_at': datetime.fromtimestamp(batch['created_at']).isoformat(timespec='seconds'),
+        'finished_at': (datetime.fromtimestamp(batch['finished_at']).isoformat(timespec='seconds')
+                        if batch['finished_at'] else None),
+    }
+
+
+def get_user_batch(c, batch_id, user_id):
+    c.execute('SELECT * FROM batches WHERE id = ? AND user_id = ?', (batch_id, user_id))
+    return c.fetchone()
+
+
+@bp.route('/api/batches')
+@bp.route('/covers/api/batches')
+@login_required
+def list_batches():
+    conn = get_db()
+    c = conn.cursor()
+    c.execute('SELECT * FROM batches WHERE user_id = ? ORDER BY created_at DESC LIMIT 50', (session['user_id'],))
+    batches = c.fetchall()
+    counts = batch_counts(c, [batch['id'] for batch in batches])
+    conn.close()
+    return jsonify({'batches': [batch_summary(batch, counts[batch['id']]) for batch in batches]})
+
+
+@bp.route('/api/batches/<batch_id>')
+@bp.route('/covers/api/batches/<batch_id>')
+@login_required
+def batch_status(batch_id):
+    """Прогресс пакета и страница элементов (?offset=0&limit=100&status=failed)"""
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+    status = request.args.get('status')
+    conn = get_db()
+    c = conn.cursor()
+    batch = get_user_batch(c, batch_id, session['user_id'])
+    if not batch:
+        conn.close()
+        return jsonify({'error': 'Пакет не найден'}), 404
+    counts = batch_counts(c, [batch_id])[batch_id]
+    if status:
+        c.execute('SELECT * FROM batch_items WHERE batch_id = ? AND status = ? ORDER BY position LIMIT ? OFFSET ?',
+                  (batch_id, status, limit, offset))
+    else:
+        c.execute('SELECT * FROM batch_items WHERE batch_id = ? ORDER BY position LIMIT ? OFFSET ?',
+                  (batch_id, limit, offset))
+    items = [{'position': row['position'], 'prompt': row['prompt'], 'platform': row['platform'],
+              'style': row['style'], 'status': row['status'], 'taskId': row['task_id'],
+              'imageUrl': row['image_url'], 'error': row['error']} for row in c.fetchall()]
+    conn.close()
+    return jsonify(dict(batch_summary(batch, counts), items=items, offset=offset, limit=limit))
+
+
+@bp.route('/api/batches/<batch_id>/results.csv')
+@bp.route('/covers/api/batches/<batch_id>/results.csv')
+@login_required
+def batch_results(batch_id):
+    """Результаты пакета в CSV; строки читаются из БД порциями по мере отправки"""
+    conn = get_db()
+    batch = get_user_batch(conn.cursor(), batch_id, session['user_id'])
+    conn.close()
+    if not batch:
+        return jsonify({'error': 'Пакет не найден'}), 404
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(('position', *BATCH_CSV_FIELDS[:4], 'status', 'task_id', 'image_url', 'error'))
+        position = 0
+        while True:
+            conn = get_db()
+            rows = conn.execute('SELECT * FROM batch_items WHERE batch_id = ? AND position > ? '
+                                'ORDER BY position LIMIT 500', (batch_id, position)).fetchall()
+            conn.close()
+            if not rows:
+                break
+            for row in rows:
+                writer.writerow((row['position'], row['prompt'], row['platform'], row['style'], row['format'],
+                                 row['status'], row['task_id'] or '', row['image_url'] or '', row['error'] or ''))
+            position = rows[-1]['position']
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    return current_app.response_class(stream_with_context(generate()), mimetype='text/csv', headers={
+        'Content-Disposition': f'attachment; filename=batch-{batch_id}.csv'})
+
+
+def cancel_batch_flow(user_id, batch_id):
+    conn = get_db()
+    c = conn.cursor()
+    batch = get_user_batch(c, batch_id, user_id)
+    if not batch:
+        conn.close()
+        return {'error': 'Пакет не найден'}, 404
+    c.execute('BEGIN IMMEDIATE')
+    c.execute("UPDATE batches SET status = 'cancelled', finished_at = ? WHERE id = ? AND status = 'running'",
+              (time.time(), batch_id))
+    c.execute("UPDATE batch_items SET status = 'cancelled' WHERE batch_id = ? AND status = 'queued'", (batch_id,))
+    skipped = c.rowcount
+    c.execute("SELECT task_id FROM batch_items WHERE batch_id = ? AND status = 'processing'", (batch_id,))
+    task_ids = [row['task_id'] for row in c.fetchall()]
+    c.execute("UPDATE batch_items SET status = 'cancelled' WHERE batch_id = ? AND status = 'processing'",
+              (batch_id,))
+    c.execute('COMMIT')
+    conn.close()
+    # Элементы в submitting отменит планировщик, когда получит их taskId
+    cancelled = []
+    for start in range(0, len(task_ids), 100):
+        cancelled += yield from cancel_tasks_flow(user_id, task_ids[start:start + 100])
+    return {'success': True, 'state': 'cancelled', 'skipped': skipped, 'cancelled': len(cancelled),
+            'message': 'Пакет остановлен'}, 200
+
+
+@bp.route('/api/batches/<batch_id>/cancel', methods=['POST'])
+@bp.route('/covers/api/batches/<batch_id>/cancel', methods=['POST'])
+@login_required
+def cancel_batch(batch_id):
+    return flow_response(cancel_batch_flow(session['user_id'], batch_id))
+
+
+def batch_item_retryable(body, status):
+    """Повторять ли элемент: только если задача точно не создана - соединение не
+    установлено, breaker разомкнут, HTTP 429/503 или коды Kie.ai 429/455. Прочие
+    ошибки (в т.ч. 500 после таймаута чтения) повторно списали бы кредиты"""
+    # 503 с retry_after - ответ разомкнутого breaker, вызова не было
+    return bool(body.get('retryable')) or (status == 503 and 'retry_after' in body)
+
+
+def submit_batch_item(item):
+    """Создаёт задачу элемента пакета (в потоке batch_executor)"""
+    start_log_context(item['batch_id'], item['user_id'])
+    data = {'prompt': item['prompt'], 'platform': item['platform'], 'style': item['style'],
+            'format': item['format'], 'image_urls': json.loads(item['image_urls'] or '[]')}
+    # Ключ идемпотентности элемента: если воркер умер после createTask, повторная
+    # отправка (BATCH_SUBMIT_TIMEOUT) получит ту же задачу, а не создаст вторую
+    idempotency_key = f"batch:{item['batch_id']}:{item['position']}"
+    try:
+        body, status = run_flow(idempotent_flow(
+            item['user_id'], 'generate_cover', idempotency_key, data,
+            lambda idempotent: generate_cover_flow(item['user_id'], data, idempotent)))
+    except Exception as e:
+        body, status = {'error': str(e)}, 500
+    key = (item['batch_id'], item['position'])
+    conn = get_db()
+    c = conn.cursor()
+    if status == 200:
+        c.execute("UPDATE batch_items SET status = 'processing', task_id = ?, polled_at = ? "
+                  "WHERE batch_id = ? AND position = ? AND status = 'submitting'", (body['taskId'], time.time(), *key))
+        if c.rowcount == 0:
+            # Пакет отменили, пока создавалась задача
+            conn.execute("UPDATE batch_items SET task_id = ? WHERE batch_id = ? AND position = ?",
+                         (body['taskId'], *key))
+            conn.close()
+            run_flow(cancel_tasks_flow(item['user_id'], [body['taskId']]))
+            return
+    elif batch_item_retryable(body, status) and item['attempts'] + 1 < Config.BATCH_MAX_ATTEMPTS:
+        # Задача точно не создана - элемент вернётся в очередь
+        c.execute("UPDATE batch_items SET status = 'queued', attempts = attempts + 1, error = ? "
+                  "WHERE batch_id = ? AND position = ? AND status = 'submitting'", (body.get('error'), *key))
+    else:
+        c.execute("UPDATE batch_items SET status = 'failed', attempts = attempts + 1, error = ? "
+                  "WHERE batch_id = ? AND position = ? AND status = 'submitting'", (body.get('error'), *key))
+    conn.close()
+
+
+def poll_batch_item(item):
+    """Опрашивает задачу элемента через check_status_flow (с общим кэшем статусов)"""
+    start_log_context(item['batch_id'], item['user_id'])
+    try:
+        body, status = run_flow(check_status_flow(item['user_id'], item['task_id']))
+    except Exception as e:
+        body, status = {'error': str(e)}, 500
+    state = body.get('state') if status == 200 else None
+    key = (item['batch_id'], item['position'])
+    conn = get_db()
+    if state == 'success' and body.get('imageUrl'):
+        conn.execute("UPDATE batch_items SET status = 'success', image_url = ?, error = NULL "
+                     "WHERE batch_id = ? AND position = ? AND status = 'processing'", (body['imageUrl'], *key))
+    elif state in ('fail', 'cancelled'):
+        conn.execute("UPDATE batch_items SET status = ?, error = ? "
+                     "WHERE batch_id = ? AND position = ? AND status = 'processing'",
+                     ('failed' if state == 'fail' else 'cancelled', body.get('error'), *key))
+    else:
+        conn.execute('UPDATE batch_items SET polled_at = ? WHERE batch_id = ? AND position = ?',
+                     (time.time(), *key))
+    conn.close()
+
+
+def run_batch_tick():
+    """Один проход планировщика: опрос отправленных, отправка новых, завершение пакетов"""
+    now = time.time()
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT id, user_id, concurrency FROM batches WHERE status = 'running' ORDER BY created_at")
+    batches = c.fetchall()
+    if not batches:
+        conn.close()
+        return
+
+    # Элементы, застрявшие в submitting (воркер умер во время отправки), - снова в очередь
+    c.execute("UPDATE batch_items SET status = 'queued', attempts = attempts + 1 "
+              "WHERE status = 'submitting' AND claimed_at < ?", (now - Config.BATCH_SUBMIT_TIMEOUT,))
+
+    c.execute('''
+        SELECT i.batch_id, i.position, i.task_id, b.user_id FROM batch_items i
+        JOIN batches b ON b.id = i.batch_id
+        WHERE i.status = 'processing' AND i.polled_at < ? ORDER BY i.polled_at LIMIT ?
+    ''', (now - Config.BATCH_POLL_INTERVAL, Config.BATCH_POLL_LIMIT))
+    executor = app_state().batch_executor
+    jobs = [executor.submit(in_app_context(poll_batch_item), row) for row in c.fetchall()]
+
+    # Бюджет отправки: BATCH_SUBMIT_RATE в секунду, поровну между пакетами
+    budget = 0 if circuit_breakers['kie'].is_open() else max(1, int(Config.BATCH_SUBMIT_RATE * Config.BATCH_TICK))
+    claimed = []
+    for batch in batches:
+        if budget <= 0:
+            break
+        c.execute(f"SELECT COUNT(*) FROM batch_items WHERE batch_id = ? "
+                  f"AND status IN ({','.join('?' * len(BATCH_ITEM_ACTIVE))})", (batch['id'], *BATCH_ITEM_ACTIVE))
+        free = min(batch['concurrency'] - c.fetchone()[0], budget)
+        if free <= 0:
+            continue
+        c.execute('BEGIN IMMEDIATE')
+        c.execute("SELECT * FROM batch_items WHERE batch_id = ? AND status = 'queued' ORDER BY position LIMIT ?",
+                  (batch['id'], free))
+        items = [dict(row, user_id=batch['user_id']) for row in c.fetchall()]
+        c.executemany("UPDATE batch_items SET status = 'submitting', claimed_at = ? WHERE batch_id = ? AND position = ?",
+                      [(now, item['batch_id'], item['position']) for item in items])
+        c.execute('COMMIT')
+        claimed += items
+        budget -= len(items)
+    jobs += [executor.submit(in_app_context(submit_batch_item), item) for item in claimed]
+    wait(jobs)
+
+    # Пакеты, где не осталось незавершённых элементов
+    statuses = ','.join('?' * len(BATCH_ITEM_TERMINAL))
+    c.execute(f'''
+        UPDATE batches SET status = 'done', finished_at = ?
+        WHERE status = 'running' AND NOT EXISTS (
+            SELECT 1 FROM batch_items i WHERE i.batch_id = batches.id AND i.status NOT IN ({statuses}))
+    ''', (time.time(), *BATCH_ITEM_TERMINAL))
+    if c.rowcount:
+        log_event('batch_finished', f"Завершено пакетов: {c.rowcount}", batches=c.rowcount)
+    conn.close()
+
+
+def batch_scheduler_loop():
+    lock_path = os.path.join(Config.OUTPUT_FOLDER, 'batch-scheduler.lock')
+    while not app_state().shutdown_event.wait(Config.BATCH_TICK):
+        try:
+            with open(lock_path, 'w') as lock:
+                # Планировщик работает в одном воркере за раз - лимиты общие
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue
+                run_batch_tick()
+        except Exception as e:
+            log_event('batch_scheduler_failed', f"Ошибка планировщика пакетов: {e}", level=logging.ERROR,
+                      exc_info=True)
+
+
+def start_batch_scheduler():
+    """Запускает планировщик пакетов в текущем процессе (как start_upload_gc)"""
+    state = app_state()
+    if Config.BATCH_TICK <= 0 or state.shutdown_event.is_set():
+        return
+    if state.batch_scheduler_thread is not None and state.batch_scheduler_thread.is_alive():
+        return
+    ensure_storage()
+    state.batch_scheduler_thread = threading.Thread(target=in_app_context(batch_scheduler_loop),
+                                                    name='batch-scheduler', daemon=True)
+    state.batch_scheduler_thread.start()
+
+
+# ============ ПРОГРЕВ И ОСТАНОВКА ВОРКЕРОВ ============
+# serve.py загружает приложение один раз в мастере gunicorn (preload), затем
+# каждый воркер после fork вызывает warmup_worker(), а при остановке -
+# drain_background_jobs(), чтобы не терять начатую работу.
+
+def warm_upstream_connections():
+    """Заранее открывает TLS соединения к Kie.ai и OpenAI в пуле сессии"""
+    session_ = get_upstream_session()
+    for url in (Config.KIE_API_URL, Config.OPENAI_API_URL):
+        try:
+            session_.head(url, timeout=5)
+        except OSError as e:
+            log_event('warmup_failed', f"⚠️ Прогрев соединения с {url} не удался: {e}", level=logging.WARNING)
+
+
+def warmup_worker(flask_app=None):
+    """Прогрев воркера после fork: кэши, фоновые потоки, соединения.
+    flask_app - приложение, которое обслуживает воркер (по умолчанию модульное app)"""
+    flask_app = flask_app or app
+    started = time.time()
+    with flask_app.app_context():
+        ensure_storage()
+        ensure_db()
+        load_asset_manifest()
+        with flask_app.test_request_context('/covers/'):
+            index_sidebar()
+        start_upload_gc()
+        start_metrics_flush()
+        start_batch_scheduler()
+        # Сеть не должна задерживать начало обслуживания запросов
+        threading.Thread(target=in_app_context(warm_upstream_connections), name='upstream-warmup',
+                         daemon=True).start()
+    log_event('worker_ready', f"🔥 Воркер {os.getpid()} прогрет",
+              duration_ms=round((time.time() - started) * 1000, 1))
+
+
+def drain_background_jobs(timeout=None):
+    """Дожидается фоновых задач приложения перед выходом воркера (не дольше timeout секунд)"""
+    timeout = Config.DRAIN_TIMEOUT if timeout is None else timeout
+    deadline = time.time() + timeout
+    state = app_state()
+    with state.init_lock:
+        # Второй вызов (хук gunicorn после lifespan ASGI) ничего не ждёт повторно
+        if state.shutdown_event.is_set():
+            return
+        state.shutdown_event.set()
+
+    with state.normalize_lock:
+        pending = list(state.normalize_jobs.values())
+    if pending:
+        done, not_done = wait(pending, timeout=max(0, deadline - time.time()))
+        if not_done:
+            log_event('drain_timeout', f"⚠️ Не дождались нормализации {len(not_done)} фото",
+                      level=logging.WARNING, pending=len(not_done))
+    state.normalize_executor.shutdown(wait=False, cancel_futures=True)
+
+    # Параллельные вызовы внешних API принадлежат запросам, которые gunicorn уже дождался
+    state.upstream_executor.shutdown(wait=False)
+
+    if state.upload_gc_thread is not None and state.upload_gc_thread.is_alive():
+        # Сборщик выйдет после текущего прохода
+        state.upload_gc_thread.join(max(0, deadline - time.time()))
+    if state.batch_scheduler_thread is not None and state.batch_scheduler_thread.is_alive():
+        # Планировщик выйдет после текущего прохода; недоотправленное продолжит другой воркер
+        state.batch_scheduler_thread.join(max(0, deadline - time.time()))
+    state.batch_executor.shutdown(wait=False)
+    state.comic_executor.shutdown(wait=False)
+    state.export_executor.shutdown(wait=False)
+    forget_metrics_snapshot()
+    try:
+        flush_slow_queries()
+    except sqlite3.Error as e:
+        log_event('metrics_flush_failed', f"Ошибка записи медленных запросов: {e}", level=logging.WARNING)
+    log_event('worker_drained', f"🛑 Воркер {os.getpid()}: фоновые задачи завершены")
+    # Последним - дописываем очередь логов
+    log_handler.stop()
+
+
+# ============ СОЗДАНИЕ ПРИЛОЖЕНИЯ ============
+
+def create_app(config=None):
+    """Создаёт Flask приложение со всеми маршрутами.
+    config - dict или класс с переопределениями Config (DATABASE, UPLOAD_FOLDER...).
+    Переопределения живут в самом приложении: два приложения в одном процессе
+    не делят настройки. Ни диск, ни сеть здесь не трогаются."""
+    overrides = {}
+    if config is not None:
+        items = config.items() if isinstance(config, dict) else vars(config).items()
+        overrides = {key: value for key, value in items if key.isupper()}
+
+    def setting(name):
+        return overrides.get(name, getattr(DefaultConfig, name))
+
+    flask_app = Flask(__name__)
+    flask_app.extensions['covers_config'] = overrides
+    flask_app.extensions['covers_state'] = AppState(setting)
+    flask_app.secret_key = setting('SECRET_KEY')
+    flask_app.config['PERMANENT_SESSION_LIFETIME'] = 86400 * 30  # 30 дней
+    flask_app.config['SESSION_COOKIE_HTTPONLY'] = True  # Защита от XSS
+    flask_app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'  # Защита от CSRF
+    # SESSION_COOKIE_SECURE только если не localhost
+    import socket
+    hostname = socket.gethostname()
+    if 'localhost' not in hostname and '127.0.0.1' not in hostname:
+        flask_app.config['SESSION_COOKIE_SECURE'] = True
+
+    flask_app.config['UPLOAD_FOLDER'] = setting('UPLOAD_FOLDER')
+    flask_app.config['MAX_CONTENT_LENGTH'] = setting('MAX_CONTENT_LENGTH')
+    # Apache mod_xsendfile / lighttpd отдают файл сами по заголовку X-Sendfile
+    flask_app.config['USE_X_SENDFILE'] = setting('UPLOAD_SERVE_MODE') == 'x-sendfile'
+    flask_app.request_class = UploadRequest
+
+    CORS(flask_app)
+    flask_app.register_blueprint(bp)
+    return flask_app
+
+
+app = create_app()
 
 
 if __name__ == '__main__':
     print("🎨 Starting AI Cover Generator...")
     print("📍 URL: http://localhost:5002")
-    print(f"🔑 Google OAuth: {'Enabled' if google else 'Disabled'}")
+    print(f"🔑 Google OAuth: {'Enabled' if google_oauth_enabled() else 'Disabled'}")
     
     # Автоматическая очистка истории при запуске
     deleted = cleanup_old_history()
@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+⚡ ASGI точка входа AI Cover Generator
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5002
+
+Эндпоинты, которые почти всё время ждут Kie.ai и OpenAI (generate_cover,
+check_status, generate_prompt, generate_comics, generate_caricature, остановка
+генераций), выполняются
+здесь корутинами на общем aiohttp.ClientSession: пока запрос ждёт внешний API, он не
+занимает поток, и один процесс держит тысячи генераций в полёте. Логика та же,
+что и у Flask версии (flow из app.py), короткие шаги между вызовами (SQLite,
+сборка промптов) выполняются в пуле потоков. Остальные маршруты обслуживает то же
+Flask приложение, каждый запрос в пуле потоков (ThreadPoolWsgiToAsgi).
+"""
+
+import asyncio
+import contextvars
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+import aiohttp
+from asgiref.sync import AsyncToSync, sync_to_async
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import parse_cookie
+
+from app import (app, Config, FlowPause, StageTimings, UpstreamConnectError, check_status_flow,
+                 drain_background_jobs, generate_caricature_flow, generate_comics_flow, generate_cover_flow,
+                 generate_prompt_flow, idempotent_flow, in_app_context, log_context, log_request,
+                 record_request_metrics, request_timings, start_batch_scheduler, start_log_context,
+                 start_metrics_flush, start_upload_gc, stop_all_generations_flow, stop_generation_flow, timed_response_body,
+                 timed_stage, upstream_call_finished, upstream_call_started)
+
+# endpoint Flask -> фабрика flow(user_id, аргументы маршрута, JSON тело, Idempotency-Key)
+ASYNC_FLOWS = {
+    'covers.generate_cover': lambda user_id, args, data, key: idempotent_flow(
+        user_id, 'generate_cover', key, data, lambda idempotent: generate_cover_flow(user_id, data, idempotent)),
+    'covers.check_status': lambda user_id, args, data, key: check_status_flow(user_id, args['task_id']),
+    'covers.generate_prompt': lambda user_id, args, data, key: generate_prompt_flow(user_id, data),
+    'covers.generate_comics': lambda user_id, args, data, key: idempotent_flow(
+        user_id, 'generate_comics', key, data, lambda idempotent: generate_comics_flow(user_id, data, idempotent)),
+    'covers.generate_caricature': lambda user_id, args, data, key: idempotent_flow(
+        user_id, 'generate_caricature', key, data, lambda idempotent: generate_caricature_flow(user_id, data, idempotent)),
+    'covers.stop_generation': lambda user_id, args, data, key: stop_generation_flow(user_id, args['task_id']),
+    'covers.stop_all_generations': lambda user_id, args, data, key: stop_all_generations_flow(user_id, data),
+}
+
+
+class UpstreamResponse:
+    """Прочитанный ответ внешнего API с интерфейсом requests.Response, который нужен flow"""
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class ThreadPoolWsgiToAsgi:
+    """Flask приложение под ASGI, каждый запрос - в пуле потоков
+    (sync_to_async(thread_sensitive=False)). Готовый asgiref WsgiToAsgi выполняет
+    все запросы в одном thread-sensitive потоке: Flask маршруты шли бы строго по
+    одному. Потоковые ответы (ZIP, CSV, комикс) отдаются по мере готовности кусков"""
+
+    def __init__(self, wsgi_application):
+        self.wsgi_application = wsgi_application
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            raise ValueError(f"Flask обслуживает только HTTP, а не {scope['type']}")
+        with SpooledTemporaryFile(max_size=65536) as body:
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                body.write(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            await sync_to_async(self.run_wsgi, thread_sensitive=False)(wsgi_environ(scope, body),
+                                                                        AsyncToSync(send))
+
+    def run_wsgi(self, environ, sync_send):
+        start = {}
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and start.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            start['message'] = {'type': 'http.response.start', 'status': int(status.split(' ', 1)[0]),
+                                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                            for name, value in headers]}
+
+        def send_start():
+            if not start.get('sent'):
+                start['sent'] = True
+                sync_send(start['message'])
+
+        result = self.wsgi_application(environ, start_response)
+        try:
+            for chunk in result:
+                if chunk:
+                    send_start()
+                    sync_send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        send_start()
+        sync_send({'type': 'http.response.body'})
+
+
+def wsgi_environ(scope, body):
+    """WSGI environ по ASGI scope (PEP 3333)"""
+    script_name = scope.get('root_path', '').encode('utf-8').decode('latin-1')
+    path_info = scope['path'].encode('utf-8').decode('latin-1')
+    if path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': script_name,
+        'PATH_INFO': path_info,
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': body,
+        'wsgi.input_terminated': True,  # тело уже прочитано целиком, даже без Content-Length
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        value = value.decode('latin-1')
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+    return environ
+
+
+def advance_flow(flow, value, error):
+    """Один синхронный шаг flow до следующего внешнего вызова (выполняется в потоке)"""
+    try:
+        call = flow.throw(error) if error is not None else flow.send(value)
+    except StopIteration as stop:
+        return True, stop.value
+    return False, call
+
+
+class AsyncCoverApp:
+    """ASGI приложение: async пути для внешних вызовов, остальное - Flask"""
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+        self.wsgi = ThreadPoolWsgiToAsgi(flask_app)
+        self.url_adapter = flask_app.url_map.bind('localhost')
+        self.serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+        self.client = None
+        self.executor = None
+
+    async def startup(self):
+        if self.client is None:
+            self.client = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+                limit=Config.ASYNC_MAX_CONNECTIONS, ttl_dns_cache=300))
+            self.executor = ThreadPoolExecutor(max_workers=Config.ASYNC_STEP_WORKERS,
+                                               thread_name_prefix='async-step')
+        start_upload_gc()
+        start_metrics_flush()
+        start_batch_scheduler()
+
+    async def shutdown(self):
+        if self.client is not None:
+            await self.client.close()
+            self.executor.shutdown(wait=False)
+            self.client = None
+        # uvicorn уже дождался начатых запросов, остались фоновые задачи
+        await asyncio.get_running_loop().run_in_executor(None, in_app_context(drain_background_jobs))
+
+    async def __call__(self, scope, receive, send):
+        # Контекст приложения кладётся в контекст корутины запроса: его видят Config
+        # и app_state() здесь, а копию получает каждый шаг flow в пуле (run_flow)
+        if scope['type'] == 'lifespan':
+            with self.flask_app.app_context():
+                return await self.lifespan(receive, send)
+
+        if scope['type'] == 'http' and scope['method'] in ('GET', 'POST'):
+            try:
+                rule, args = self.url_adapter.match(scope['path'], method=scope['method'], return_rule=True)
+            except HTTPException:
+                rule = None
+            if rule is not None and rule.endpoint in ASYNC_FLOWS:
+                started = time.perf_counter()
+                with self.flask_app.app_context():
+                    status, timings = await self.handle_flow(rule.endpoint, args, scope, receive, send)
+                seconds = time.perf_counter() - started
+                record_request_metrics(rule.rule, scope['method'], status, seconds)
+                log_request(rule.rule, scope['method'], status, seconds,
+                            timings.durations() if timings is not None else None)
+                return
+
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def session_user_id(self, scope):
+        """user_id из подписанной cookie сессии Flask"""
+        headers = dict(scope['headers'])
+        cookies = parse_cookie(headers.get(b'cookie', b'').decode('latin-1'))
+        value = cookies.get(self.flask_app.config['SESSION_COOKIE_NAME'])
+        if not value:
+            return None
+        try:
+            data = self.serializer.loads(
+                value, max_age=int(self.flask_app.permanent_session_lifetime.total_seconds()))
+        except Exception:
+            return None
+        return data.get('user_id')
+
+    async def read_body(self, receive):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if len(body) > Config.MAX_CONTENT_LENGTH:
+                return None
+            if not message.get('more_body'):
+                return body
+
+    async def handle_flow(self, endpoint, args, scope, receive, send):
+        """Выполняет flow эндпоинта, возвращает (код ответа, таймеры этапов)"""
+        user_id = self.session_user_id(scope)
+        request_id = dict(scope['headers']).get(b'x-request-id', b'').decode('latin-1')
+        # Контекст логов этой корутины; шаги flow получают его копию вместе с таймерами
+        start_log_context(request_id, user_id)
+        if user_id is None:
+            # Как login_required
+            await self.respond(send, 302, b'', [(b'location', b'/covers/login')])
+            return 302, None
+
+        data = {}
+        if scope['method'] == 'POST':
+            body = await self.read_body(receive)
+            if body is None:
+                await self.respond_json(send, 413, {'error': 'Слишком большой запрос'})
+                return 413, None
+            try:
+                data = self.flask_app.json.loads(body) if body else {}
+            except ValueError:
+                data = {}
+            if not isinstance(data, dict):
+                data = {}
+
+        key = dict(scope['headers']).get(b'idempotency-key', b'').decode('latin-1').strip() or None
+        # Таймеры в контексте этой корутины; шаги flow получают его копию (run_flow)
+        timings = StageTimings()
+        request_timings.set(timings)
+        body, status = await self.run_flow(ASYNC_FLOWS[endpoint](user_id, args, data, key))
+        with timed_stage('render'):
+            data = self.flask_app.json.dumps(timed_response_body(body, timings)).encode('utf-8')
+        headers = [(b'content-type', b'application/json')]
+        if Config.SERVER_TIMING:
+            headers.append((b'server-timing', timings.header().encode('latin-1')))
+        await self.respond(send, status, data, headers)
+        return status, timings
+
+    async def run_flow(self, flow):
+        """Асинхронный драйвер flow: шаги в пуле потоков, вызовы - корутины"""
+        if self.client is None:
+            await self.startup()
+        loop = asyncio.get_running_loop()
+        value, error = None, None
+        while True:
+            done, result = await loop.run_in_executor(self.executor, contextvars.copy_context().run,
+                                                      advance_flow, flow, value, error)
+            if done:
+                return result
+            value, error = None, None
+            if isinstance(result, FlowPause):
+                await asyncio.sleep(result.seconds)
+            elif isinstance(result, list):
+                value = list(await asyncio.gather(*(self.perform(call) for call in result),
+                                                  return_exceptions=True))
+            else:
+                try:
+                    value = await self.perform(result)
+                except Exception as e:
+                    error = e
+
+    async def perform(self, call):
+        breaker, started = upstream_call_started(call)
+        try:
+            async with self.client.request(call.method, call.url, headers=call.headers, json=call.json,
+                                           params=call.params,
+                                           timeout=aiohttp.ClientTimeout(total=call.timeout)) as response:
+                result = UpstreamResponse(response.status, await response.read())
+        except Exception as e:
+            upstream_call_finished(call, breaker, started)
+            if isinstance(e, aiohttp.ClientConnectorError):
+                raise UpstreamConnectError(str(e)) from e
+            raise
+        upstream_call_finished(call, breaker, started, result.status_code)
+        return result
+
+    async def respond_json(self, send, status, body):
+        data = self.flask_app.json.dumps(body).encode('utf-8')
+        await self.respond(send, status, data, [(b'content-type', b'application/json')])
+
+    async def respond(self, send, status, data, headers):
+        headers = headers + [(b'content-length', str(len(data)).encode()),
+                             (b'access-control-allow-origin', b'*'),
+                             (b'x-request-id', log_context.get()['request_id'].encode('latin-1'))]
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        await send({'type': 'http.response.body', 'body': data})
+
+
+application = AsyncCoverApp(app)
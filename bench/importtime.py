@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+⏱️ Проверка бюджета времени импорта app.py
+
+    python bench/importtime.py              # медиана 5 запусков, код 1 при превышении
+    python bench/importtime.py --ratio 0.5 --runs 9
+
+Запускает `python -X importtime -c "import app"` в чистом процессе и считает,
+сколько app добавляет поверх импорта Flask (который app.py всё равно тянет и
+на который мы не влияем). Бюджет задан долей от времени импорта Flask в том же
+запуске, поэтому не зависит от скорости машины: на медленном CI растут обе
+величины. Перед замером обновляется кэш байткода app.py: иначе (например, при
+PYTHONDONTWRITEBYTECODE) каждый запуск заново компилирует ~5000 строк, а в
+production это разовая цена первого старта. Дополнительно проверяет, что импорт
+не подтягивает тяжёлые модули, которые app.py загружает лениво. Запускается из
+tests/test_importtime.py.
+"""
+
+import argparse
+import os
+import py_compile
+import statistics
+import subprocess
+import sys
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Сейчас app добавляет ~30% к импорту Flask, больше половины - регистрация маршрутов
+# (werkzeug компилирует функцию сборки URL для каждого правила)
+DEFAULT_RATIO = 0.5
+LAZY_MODULES = ('authlib', 'requests', 'PIL', 'smtplib', 'aiohttp')
+
+
+def measure():
+    """(время импорта app в мс, из них импорт flask в мс, множество модулей верхнего уровня)"""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                            cwd=BASE_DIR, capture_output=True, text=True, check=True)
+    cumulative_us, modules = {}, set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line.split('|')
+        name = name.strip()
+        modules.add(name.split('.')[0])
+        if name in ('app', 'flask'):
+            cumulative_us[name] = int(cumulative)
+    if 'app' not in cumulative_us or 'flask' not in cumulative_us:
+        raise RuntimeError('в выводе -X importtime нет модулей app и flask')
+    return cumulative_us['app'] / 1000, cumulative_us['flask'] / 1000, modules
+
+
+def check(ratio=DEFAULT_RATIO, runs=5):
+    """(список ошибок, строка отчёта)"""
+    py_compile.compile(os.path.join(BASE_DIR, 'app.py'), doraise=True)
+    totals, own, loaded = [], [], set()
+    for _ in range(runs):
+        total_ms, flask_ms, modules = measure()
+        totals.append(total_ms)
+        own.append((total_ms - flask_ms) / flask_ms)
+        loaded |= modules
+    median = statistics.median(own)
+    report = (f"import app: медиана {statistics.median(totals):.1f}мс, поверх Flask "
+              f"{median:.0%} от импорта Flask, бюджет {ratio:.0%}")
+    errors = []
+    if median > ratio:
+        errors.append("Бюджет времени импорта превышен")
+    eager = [name for name in LAZY_MODULES if name in loaded]
+    if eager:
+        errors.append(f"При импорте загружены модули, которые должны импортироваться лениво: {', '.join(eager)}")
+    return errors, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бюджет времени импорта app.py')
+    parser.add_argument('--ratio', type=float,
+                        default=float(os.environ.get('IMPORT_BUDGET_RATIO', DEFAULT_RATIO)),
+                        help='доля от импорта Flask, по умолчанию IMPORT_BUDGET_RATIO или %(default)s')
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    errors, report = check(args.ratio, args.runs)
+    print(report)
+    for error in errors:
+        print(f"❌ {error}")
+    if not errors:
+        print("✅ OK")
+    sys.exit(1 if errors else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,462 @@
+#!/usr/bin/env python3
+"""
+📊 Нагрузочный тест AI Cover Generator на пользовательских сессиях
+
+    python bench/loadtest.py --users 50 --duration 60
+    python bench/loadtest.py --server asgi --workers 2 --latency 0.3 --jitter 0.5 \\
+        --op-latency createTask=1.5 --op-failure createTask=0.05
+    python bench/loadtest.py --compare bench/results/old.json bench/results/new.json
+
+    # threaded=True против ASGI при 500 одновременных пользователях без пауз
+    python bench/loadtest.py --server flask --users 500 --think-time 0 --output bench/results/threaded.json
+    python bench/loadtest.py --server asgi --workers 1 --users 500 --think-time 0 --output bench/results/asgi.json
+    python bench/loadtest.py --compare bench/results/threaded.json bench/results/asgi.json
+
+Поднимает bench/standins.py (Kie.ai и OpenAI) и приложение через serve.py
+(или `app.run(threaded=True)` для --server flask) на отдельной БД и каталогах во
+временной папке. Затем каждый виртуальный пользователь проходит сценарий как в
+браузере: вход, главная страница, обложка с опросом статуса, комикс из 6 блоков
+с опросом всех панелей, история, пауза на раздумья - и так по кругу до конца теста.
+
+Печатает req/s, p50/p95/p99 по шагам сценария и загрузку воркеров:
+- busy - среднее число одновременно обрабатываемых запросов (из /metrics);
+- utilization - busy относительно workers x threads (для sync/gthread);
+- cpu - процессорное время сервера в процентах одного ядра.
+Результат сохраняется в JSON (--output), два файла сравнивает --compare (в том
+числе пиковое число потоков и CPU - так сравниваются threaded и ASGI режимы).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+
+import aiohttp
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+STEPS = ('login', 'index', 'generate', 'status', 'comics', 'comics_status', 'history')
+PASSWORD = 'loadtest-password'
+
+
+class StepStats:
+    def __init__(self):
+        self.latencies = {step: [] for step in STEPS}
+        self.errors = {step: 0 for step in STEPS}
+        self.completed = {'covers': 0, 'comics': 0, 'timeouts': 0}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def create_users(count):
+    """Пользователи с паролем и токенами во временной БД (Config уже из окружения)"""
+    import app as cover_app
+    conn = cover_app.get_db()
+    for i in range(count):
+        conn.execute('INSERT OR IGNORE INTO users (username, email, password_hash, api_token, openai_token) '
+                     'VALUES (?, ?, ?, ?, ?)',
+                     (f'loadtest{i}', f'loadtest{i}@example.com', cover_app.hash_password(PASSWORD),
+                      f'kie-token-{i}', f'openai-token-{i}'))
+    conn.close()
+
+
+class VirtualUser:
+    """Сценарий одного пользователя; cookie сессии передаём сами - она Secure, а тест идёт по http"""
+
+    def __init__(self, number, client, base, stats, args):
+        self.number = number
+        self.client = client
+        self.base = base
+        self.stats = stats
+        self.args = args
+        self.cookie = None
+
+    async def request(self, step, method, path, expect=200, **kwargs):
+        headers = {'Cookie': f'session={self.cookie}'} if self.cookie else {}
+        started = time.perf_counter()
+        try:
+            async with self.client.request(method, self.base + path, headers=headers,
+                                           allow_redirects=False, **kwargs) as r:
+                body = await r.read()
+                if 'session' in r.cookies:
+                    self.cookie = r.cookies['session'].value
+                ok = r.status == expect
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            body, ok = b'', False
+        self.stats.latencies[step].append(time.perf_counter() - started)
+        if not ok:
+            self.stats.errors[step] += 1
+            return None
+        if body[:1] in (b'{', b'['):
+            return json.loads(body)
+        return body
+
+    async def login(self):
+        await self.request('login', 'POST', '/covers/login', expect=302,
+                           data={'email': f'loadtest{self.number}@example.com', 'password': PASSWORD})
+        await self.request('index', 'GET', '/covers/')
+        return self.cookie is not None
+
+    async def poll(self, step, task_ids):
+        """Опрашивает задачи как фронтенд, пока все не завершатся"""
+        deadline = time.time() + self.args.poll_timeout
+        pending = set(task_ids)
+        while pending and time.time() < deadline:
+            await asyncio.sleep(self.args.poll_interval)
+            polled = list(pending)
+            results = await asyncio.gather(*(self.request(step, 'GET', f'/covers/api/status/{task_id}')
+                                             for task_id in polled))
+            for task_id, result in zip(polled, results):
+                if result and result.get('state') in ('success', 'fail', 'cancelled'):
+                    pending.discard(task_id)
+        if pending:
+            self.stats.completed['timeouts'] += 1
+        return not pending
+
+    async def cover(self):
+        result = await self.request('generate', 'POST', '/covers/api/generate', json={
+            'prompt': f'Обложка для видео про котов #{random.randint(1, 10000)}',
+            'platform': random.choice(['youtube_thumbnail', 'instagram_post', 'telegram_post']),
+        })
+        if result and result.get('taskId') and await self.poll('status', [result['taskId']]):
+            self.stats.completed['covers'] += 1
+
+    async def comics(self):
+        result = await self.request('comics', 'POST', '/covers/api/generate-comics', json={
+            'topic': 'Кот спасает город', 'description': 'весёлая история', 'blocks': 6,
+        })
+        task_ids = [task['task_id'] for task in (result or {}).get('task_ids', [])]
+        if task_ids and await self.poll('comics_status', task_ids):
+            self.stats.completed['comics'] += 1
+
+    async def run(self, deadline):
+        await asyncio.sleep(random.uniform(0, self.args.ramp_up))
+        if not await self.login():
+            return
+        while time.time() < deadline:
+            await self.cover()
+            if random.random() < self.args.comics_share and time.time() < deadline:
+                await self.comics()
+            await self.request('history', 'GET', '/covers/history')
+            await asyncio.sleep(random.uniform(0, 2 * self.args.think_time))
+
+
+async def drive(args, base):
+    stats = StepStats()
+    connector = aiohttp.TCPConnector(limit=0)
+    async with aiohttp.ClientSession(connector=connector, cookie_jar=aiohttp.DummyCookieJar(),
+                                     timeout=aiohttp.ClientTimeout(total=120)) as client:
+        deadline = time.time() + args.duration
+        users = [VirtualUser(i, client, base, stats, args) for i in range(args.users)]
+        started = time.perf_counter()
+        await asyncio.gather(*(user.run(deadline) for user in users))
+        elapsed = time.perf_counter() - started
+    return stats, elapsed
+
+
+# ============ ЗАГРУЗКА СЕРВЕРА ============
+
+def process_tree(pid):
+    """pid сервера и всех его потомков (воркеры gunicorn)"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, ()))
+    return tree
+
+
+def cpu_seconds(pids):
+    ticks = os.sysconf('SC_CLK_TCK')
+    total = 0.0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / ticks  # utime + stime
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+
+def thread_count(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('Threads:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+def request_seconds(port):
+    """Сумма covers_http_request_duration_seconds по всем маршрутам и воркерам"""
+    try:
+        text = urllib.request.urlopen(f'http://127.0.0.1:{port}/metrics', timeout=10).read().decode()
+    except OSError:
+        return None
+    return sum(float(value) for value in
+               re.findall(r'^covers_http_request_duration_seconds_sum\{[^}]*\} (\S+)$', text, re.M))
+
+
+def upstream_calls(port):
+    try:
+        return json.loads(urllib.request.urlopen(f'http://127.0.0.1:{port}/_stats', timeout=5).read())
+    except OSError:
+        return None
+
+
+def wait_for_port(port, path, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}{path}', timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f'сервер на порту {port} не поднялся')
+
+
+def server_command(args):
+    if args.server == 'flask':
+        return [sys.executable, '-c',
+                f'import app; app.app.run(host="127.0.0.1", port={args.app_port}, threaded=True)']
+    return [sys.executable, os.path.join(BASE_DIR, 'serve.py'), '--bind', f'127.0.0.1:{args.app_port}',
+            '--workers', str(args.workers), '--worker-class', args.server, '--threads', str(args.threads)]
+
+
+def capacity(args):
+    """Сколько запросов сервер обрабатывает одновременно (None - не ограничено потоками)"""
+    if args.server == 'gthread':
+        return args.workers * args.threads
+    if args.server == 'sync':
+        return args.workers
+    return None
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ============ ОТЧЁТ ============
+
+def summarize(args, stats, elapsed, saturation, upstream):
+    steps = {}
+    total_requests = total_errors = 0
+    for step in STEPS:
+        latencies = stats.latencies[step]
+        total_requests += len(latencies)
+        total_errors += stats.errors[step]
+        steps[step] = {
+            'requests': len(latencies),
+            'errors': stats.errors[step],
+            'rps': round(len(latencies) / elapsed, 2),
+            'p50_ms': round(percentile(latencies, 50) * 1000, 1),
+            'p95_ms': round(percentile(latencies, 95) * 1000, 1),
+            'p99_ms': round(percentile(latencies, 99) * 1000, 1),
+        }
+    everything = [value for step in STEPS for value in stats.latencies[step]]
+    return {
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('compare', 'output')},
+        'elapsed_seconds': round(elapsed, 2),
+        'requests': total_requests,
+        'errors': total_errors,
+        'rps': round(total_requests / elapsed, 2),
+        'p50_ms': round(percentile(everything, 50) * 1000, 1),
+        'p95_ms': round(percentile(everything, 95) * 1000, 1),
+        'p99_ms': round(percentile(everything, 99) * 1000, 1),
+        'completed': stats.completed,
+        'steps': steps,
+        'saturation': saturation,
+        'upstream': upstream,
+    }
+
+
+def print_report(report):
+    print(f"{'шаг':<15}{'запросов':>10}{'ошибок':>8}{'req/s':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for step, s in report['steps'].items():
+        print(f"{step:<15}{s['requests']:>10}{s['errors']:>8}{s['rps']:>9.1f}"
+              f"{s['p50_ms']:>10.0f}{s['p95_ms']:>10.0f}{s['p99_ms']:>10.0f}")
+    print(f"{'всего':<15}{report['requests']:>10}{report['errors']:>8}{report['rps']:>9.1f}"
+          f"{report['p50_ms']:>10.0f}{report['p95_ms']:>10.0f}{report['p99_ms']:>10.0f}")
+    sat = report['saturation']
+    utilization = f", utilization {sat['utilization']:.0%}" if sat.get('utilization') is not None else ''
+    busy = f"busy {sat['busy']:.1f}" if sat.get('busy') is not None else 'busy ?'
+    print(f"воркеры: {busy}{utilization}, cpu {sat['cpu_percent']:.0f}%, "
+          f"потоков до {sat['peak_threads']}")
+    print(f"готово: обложек {report['completed']['covers']}, комиксов {report['completed']['comics']}, "
+          f"не дождались {report['completed']['timeouts']}")
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old_path} ({old.get('commit')}) -> {new_path} ({new.get('commit')})")
+    print(f"{'шаг':<15}{'req/s':>20}{'p50 ms':>20}{'p95 ms':>20}{'p99 ms':>20}")
+
+    def cell(a, b):
+        change = f"{(b - a) / a:+.0%}" if a else ''
+        return f"{a:.0f}->{b:.0f} {change}".rjust(20)
+
+    rows = [('всего', old, new)] + [(step, old['steps'].get(step), new['steps'].get(step)) for step in STEPS]
+    for name, a, b in rows:
+        if not a or not b:
+            continue
+        print(f"{name:<15}{cell(a['rps'], b['rps'])}{cell(a['p50_ms'], b['p50_ms'])}"
+              f"{cell(a['p95_ms'], b['p95_ms'])}{cell(a['p99_ms'], b['p99_ms'])}")
+    old_sat, new_sat = old.get('saturation') or {}, new.get('saturation') or {}
+    for key, label in (('peak_threads', 'потоков'), ('cpu_percent', 'cpu %')):
+        if old_sat.get(key) is not None and new_sat.get(key) is not None:
+            print(f"{label:<15}{cell(old_sat[key], new_sat[key])}")
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='cover-loadtest-')
+    env = dict(os.environ,
+               KIE_API_URL=f'http://127.0.0.1:{args.standin_port}/api/v1/jobs',
+               OPENAI_API_URL=f'http://127.0.0.1:{args.standin_port}/v1/chat/completions',
+               DATABASE=os.path.join(workdir, 'users.db'),
+               UPLOAD_FOLDER=os.path.join(workdir, 'uploads'),
+               OUTPUT_FOLDER=os.path.join(workdir, 'output'),
+               METRICS_DIR=os.path.join(workdir, 'metrics'),
+               METRICS_FLUSH_INTERVAL='1',
+               METRICS_TOKEN='',
+               UPLOAD_GC_INTERVAL='0')
+    # uvicorn заглушек читает WEB_CONCURRENCY, воркеры serve.py задаются аргументом
+    env.pop('WEB_CONCURRENCY', None)
+    os.environ.update(env)
+    create_users(args.users)
+
+    standin_cmd = [sys.executable, os.path.join(BASE_DIR, 'bench', 'standins.py'),
+                   '--port', str(args.standin_port), '--latency', str(args.latency),
+                   '--jitter', str(args.jitter), '--distribution', args.distribution,
+                   '--failure-rate', str(args.failure_rate), '--task-duration', str(args.task_duration)]
+    for item in args.op_latency or ():
+        standin_cmd += ['--op-latency', item]
+    for item in args.op_failure or ():
+        standin_cmd += ['--op-failure', item]
+    standin = subprocess.Popen(standin_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server = None
+    try:
+        wait_for_port(args.standin_port, '/_stats')
+        server = subprocess.Popen(server_command(args), cwd=BASE_DIR, env=env,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for_port(args.app_port, '/covers/api/sizes')
+
+        pids = process_tree(server.pid)
+        busy_before, cpu_before = request_seconds(args.app_port), cpu_seconds(pids)
+        peak_threads = 0
+
+        async def sample_threads():
+            nonlocal peak_threads
+            while True:
+                peak_threads = max(peak_threads, thread_count(process_tree(server.pid)))
+                await asyncio.sleep(0.5)
+
+        async def main():
+            sampler = asyncio.create_task(sample_threads())
+            result = await drive(args, f'http://127.0.0.1:{args.app_port}')
+            sampler.cancel()
+            return result
+
+        stats, elapsed = asyncio.run(main())
+        cpu_after = cpu_seconds(process_tree(server.pid))
+        time.sleep(1.5)  # воркеры сбрасывают снимки метрик раз в секунду
+        busy_after = request_seconds(args.app_port)
+        upstream = upstream_calls(args.standin_port)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+        standin.terminate()
+        standin.wait()
+
+    busy = (busy_after - busy_before) / elapsed if busy_before is not None and busy_after is not None else None
+    slots = capacity(args)
+    saturation = {
+        'busy': round(busy, 2) if busy is not None else None,
+        'capacity': slots,
+        'utilization': round(busy / slots, 3) if busy is not None and slots else None,
+        'cpu_percent': round((cpu_after - cpu_before) / elapsed * 100, 1),
+        'peak_threads': peak_threads,
+    }
+    return summarize(args, stats, elapsed, saturation, upstream)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нагрузочный тест на пользовательских сессиях')
+    parser.add_argument('--users', type=int, default=50, help='виртуальных пользователей')
+    parser.add_argument('--duration', type=float, default=60, help='секунд')
+    parser.add_argument('--ramp-up', type=float, default=5, help='пользователи входят в течение N секунд')
+    parser.add_argument('--think-time', type=float, default=1.0, help='средняя пауза между сценариями, с')
+    parser.add_argument('--comics-share', type=float, default=0.3, help='доля итераций с комиксом')
+    parser.add_argument('--poll-interval', type=float, default=2.0, help='как у фронтенда, с')
+    parser.add_argument('--poll-timeout', type=float, default=120.0)
+    parser.add_argument('--server', choices=('gthread', 'sync', 'asgi', 'flask'), default='gthread')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.3, help='базовая задержка заглушек, с')
+    parser.add_argument('--jitter', type=float, default=0.2)
+    parser.add_argument('--distribution', choices=('fixed', 'uniform', 'exponential', 'lognormal'),
+                        default='lognormal')
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--op-latency', action='append', metavar='OP=SECONDS')
+    parser.add_argument('--op-failure', action='append', metavar='OP=RATE')
+    parser.add_argument('--task-duration', type=float, default=6.0, help='через сколько секунд задача готова')
+    parser.add_argument('--app-port', type=int, default=9300)
+    parser.add_argument('--standin-port', type=int, default=9301)
+    parser.add_argument('--output', help='JSON отчёт, по умолчанию bench/results/loadtest-<время>.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='сравнить два отчёта')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = run(args)
+    print_report(report)
+    output = args.output or os.path.join(BASE_DIR, 'bench', 'results',
+                                         f"loadtest-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"📄 {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+🧪 Локальные заглушки Kie.ai и OpenAI для нагрузочных тестов
+
+    python bench/standins.py --port 9100 --latency 0.5
+    python bench/standins.py --latency 0.2 --jitter 0.3 --distribution exponential \
+        --op-latency createTask=1.5 --op-latency chat=0.8 --op-failure createTask=0.05
+
+Эмулирует:
+    POST /api/v1/jobs/createTask     -> {"code": 200, "data": {"taskId": ...}}
+    GET  /api/v1/jobs/recordInfo     -> waiting / generating / success
+    POST /api/v1/jobs/cancelTask     -> {"code": 200} (для KIE_CANCEL_PATH=/cancelTask)
+    POST /v1/chat/completions        -> ответ OpenAI с одним сообщением
+    GET  /_stats                     -> число вызовов и отказов по операциям
+
+Задержка ответа - базовая (--latency или --op-latency операции) плюс случайная
+добавка масштаба --jitter из распределения --distribution:
+fixed (без добавки), uniform, exponential или lognormal (длинный хвост).
+
+Приложение направляется на заглушку переменными окружения
+KIE_API_URL=http://127.0.0.1:9100/api/v1/jobs и
+OPENAI_API_URL=http://127.0.0.1:9100/v1/chat/completions.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+
+OPERATIONS = ('createTask', 'recordInfo', 'cancelTask', 'chat')
+OPERATION_PATHS = {'chat': 'chat/completions'}
+
+
+class StandinUpstream:
+    """ASGI приложение-заглушка с настраиваемой задержкой и долей ошибок"""
+
+    def __init__(self, latency=0.5, jitter=0.0, failure_rate=0.0, task_duration=3.0,
+                 distribution='lognormal', op_latency=None, op_failure=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.task_duration = task_duration
+        self.distribution = distribution
+        self.op_latency = op_latency or {}  # операция -> базовая задержка
+        self.op_failure = op_failure or {}  # операция -> доля ответов 503
+        self.tasks = {}  # taskId -> время создания
+        self.calls = {op: 0 for op in OPERATIONS}
+        self.failures = {op: 0 for op in OPERATIONS}
+
+    def jitter_sample(self):
+        if not self.jitter or self.distribution == 'fixed':
+            return 0.0
+        if self.distribution == 'uniform':
+            return random.uniform(0, self.jitter)
+        if self.distribution == 'exponential':
+            return random.expovariate(1 / self.jitter)
+        # Логнормальный хвост похож на реальные задержки внешних API
+        return random.lognormvariate(0, 1) * self.jitter
+
+    async def delay(self, operation):
+        seconds = self.op_latency.get(operation, self.latency) + self.jitter_sample()
+        if seconds > 0:
+            await asyncio.sleep(seconds)
+
+    def failed(self, operation):
+        rate = self.op_failure.get(operation, self.failure_rate)
+        return rate and random.random() < rate
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+
+        path = scope['path']
+        if path == '/_stats':
+            return await self.respond(send, 200, {'calls': self.calls, 'failures': self.failures})
+
+        operation = next((op for op in OPERATIONS if path.endswith('/' + OPERATION_PATHS.get(op, op))), None)
+        await self.delay(operation)
+        if operation is not None and self.failed(operation):
+            self.failures[operation] += 1
+            return await self.respond(send, 503, {'code': 503, 'msg': 'stand-in failure'})
+
+        if path.endswith('/createTask'):
+            self.calls['createTask'] += 1
+            task_id = uuid.uuid4().hex
+            self.tasks[task_id] = time.time()
+            return await self.respond(send, 200, {'code': 200, 'msg': 'success', 'data': {'taskId': task_id}})
+
+        if path.endswith('/recordInfo'):
+            self.calls['recordInfo'] += 1
+            query = dict(part.split('=', 1) for part in scope['query_string'].decode().split('&') if '=' in part)
+            task_id = query.get('taskId', '')
+            created = self.tasks.setdefault(task_id, time.time())
+            age = time.time() - created
+            if age >= self.task_duration:
+                data = {'taskId': task_id, 'state': 'success',
+                        'resultJson': json.dumps({'resultUrls': [f'https://example.com/{task_id}.png']}),
+                        'createTime': int(created * 1000),
+                        'completeTime': int((created + self.task_duration) * 1000),
+                        'costTime': int(self.task_duration * 1000)}
+            else:
+                data = {'taskId': task_id, 'state': 'waiting' if age < self.task_duration / 3 else 'generating'}
+            return await self.respond(send, 200, {'code': 200, 'msg': 'success', 'data': data})
+
+        if path.endswith('/cancelTask'):
+            self.calls['cancelTask'] += 1
+            return await self.respond(send, 200, {'code': 200, 'msg': 'success'})
+
+        if path.endswith('/chat/completions'):
+            self.calls['chat'] += 1
+            try:
+                prompt = json.loads(body)['messages'][-1]['content']
+            except (ValueError, KeyError, IndexError):
+                prompt = ''
+            content = prompt.split(':', 1)[-1].strip() or 'stand-in prompt'
+            return await self.respond(send, 200, {
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}}]
+            })
+
+        await self.respond(send, 404, {'error': 'not found'})
+
+    async def respond(self, send, status, payload):
+        data = json.dumps(payload).encode()
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', b'application/json'),
+                                (b'content-length', str(len(data)).encode())]})
+        await send({'type': 'http.response.body', 'body': data})
+
+
+def serve(port, **options):
+    import uvicorn
+    uvicorn.run(StandinUpstream(**options), host='127.0.0.1', port=port,
+                log_level='warning', backlog=4096)
+
+
+def operation_values(items):
+    """['createTask=1.5', ...] -> {'createTask': 1.5}"""
+    values = {}
+    for item in items or ():
+        operation, _, value = item.partition('=')
+        if operation not in OPERATIONS:
+            raise SystemExit(f"неизвестная операция {operation}, допустимы: {', '.join(OPERATIONS)}")
+        values[operation] = float(value)
+    return values
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Заглушки Kie.ai и OpenAI')
+    parser.add_argument('--port', type=int, default=9100)
+    parser.add_argument('--latency', type=float, default=0.5, help='базовая задержка ответа, с')
+    parser.add_argument('--jitter', type=float, default=0.0, help='масштаб случайной добавки к задержке, с')
+    parser.add_argument('--distribution', choices=('fixed', 'uniform', 'exponential', 'lognormal'),
+                        default='lognormal', help='распределение добавки')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='доля ответов 503')
+    parser.add_argument('--op-latency', action='append', metavar='OP=SECONDS',
+                        help='базовая задержка операции (createTask, recordInfo, cancelTask, chat)')
+    parser.add_argument('--op-failure', action='append', metavar='OP=RATE', help='доля 503 для операции')
+    parser.add_argument('--task-duration', type=float, default=3.0, help='через сколько секунд задача готова')
+    args = parser.parse_args()
+    serve(args.port, latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+          task_duration=args.task_duration, distribution=args.distribution,
+          op_latency=operation_values(args.op_latency), op_failure=operation_values(args.op_failure))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+📦 Сборка статики для AI Cover Generator
+
+    python build_assets.py                       # хэшировать и сжать static/ -> static/dist/
+    python build_assets.py --extract index.html  # вынести inline <style>/<script> шаблона в static/
+
+Каждый CSS/JS файл копируется в static/dist/ с хэшем содержимого в имени
+(style.3f2a9c1b7d0e.css), рядом кладутся .gz и .br версии. Соответствие
+исходных имён хэшированным пишется в static/dist/manifest.json, его читает
+шаблонный хелпер asset_url() в app.py.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(BASE_DIR, 'static')
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')
+TEMPLATES_DIR = os.path.join(BASE_DIR, 'templates')
+ASSET_EXTENSIONS = ('.css', '.js', '.svg')
+
+STYLE_RE = re.compile(r'^([ \t]*)<style>\n(.*?)\n[ \t]*</style>\n', re.S | re.M)
+SCRIPT_RE = re.compile(r'^([ \t]*)<script>\n(.*?)\n[ \t]*</script>\n', re.S | re.M)
+
+
+def dedent_block(body, indent):
+    """Убирает отступ, с которым блок был вложен в HTML"""
+    lines = body.split('\n')
+    return '\n'.join(line[len(indent):] if line.startswith(indent) else line.lstrip()
+                     for line in lines).strip('\n') + '\n'
+
+
+def extract_inline(template_name):
+    """Выносит inline <style> и <script> без Jinja-разметки в static/css и static/js"""
+    path = os.path.join(TEMPLATES_DIR, template_name)
+    with open(path, encoding='utf-8') as f:
+        html = f.read()
+    name = os.path.splitext(template_name)[0]
+    written = []
+
+    def replace(match, kind, counter):
+        indent, body = match.group(1), match.group(2)
+        if '{{' in body or '{%' in body:
+            # Блок зависит от контекста шаблона - оставляем inline
+            return match.group(0)
+        counter[0] += 1
+        suffix = '' if counter[0] == 1 else f'-{counter[0]}'
+        rel = f'{kind}/{name}{suffix}.{kind}'
+        os.makedirs(os.path.join(STATIC_DIR, kind), exist_ok=True)
+        with open(os.path.join(STATIC_DIR, rel), 'w', encoding='utf-8') as out:
+            out.write(dedent_block(body, indent + '    '))
+        written.append(rel)
+        if kind == 'css':
+            return f'{indent}<link rel="stylesheet" href="{{{{ asset_url(\'{rel}\') }}}}">\n'
+        return f'{indent}<script src="{{{{ asset_url(\'{rel}\') }}}}"></script>\n'
+
+    style_count, script_count = [0], [0]
+    html = STYLE_RE.sub(lambda m: replace(m, 'css', style_count), html)
+    html = SCRIPT_RE.sub(lambda m: replace(m, 'js', script_count), html)
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(html)
+    return written
+
+
+def fingerprint(rel_path, data):
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    stem, ext = os.path.splitext(rel_path)
+    return f'{stem}.{digest}{ext}'
+
+
+def build():
+    """Хэширует и предварительно сжимает всю статику, пишет manifest.json"""
+    if os.path.isdir(DIST_DIR):
+        shutil.rmtree(DIST_DIR)
+    os.makedirs(DIST_DIR)
+
+    manifest = {}
+    for root, dirs, files in os.walk(STATIC_DIR):
+        dirs[:] = [d for d in dirs if os.path.join(root, d) != DIST_DIR]
+        for filename in sorted(files):
+            if not filename.endswith(ASSET_EXTENSIONS):
+                continue
+            src = os.path.join(root, filename)
+            rel = os.path.relpath(src, STATIC_DIR).replace(os.sep, '/')
+            with open(src, 'rb') as f:
+                data = f.read()
+
+            hashed = fingerprint(rel, data)
+            dst = os.path.join(DIST_DIR, hashed)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            with open(dst, 'wb') as f:
+                f.write(data)
+            # mtime=0 - одинаковый вход даёт побайтно одинаковый .gz
+            with open(dst + '.gz', 'wb') as f:
+                f.write(gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None:
+                with open(dst + '.br', 'wb') as f:
+                    f.write(brotli.compress(data, quality=11))
+
+            manifest[rel] = hashed
+            gz_size = os.path.getsize(dst + '.gz')
+            br_info = f", br {os.path.getsize(dst + '.br')}" if brotli is not None else ''
+            print(f"  {rel} -> {hashed} ({len(data)} байт, gz {gz_size}{br_info})")
+
+    with open(os.path.join(DIST_DIR, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    if brotli is None:
+        print("⚠️ Модуль brotli не установлен, .br файлы не созданы")
+    print(f"✅ Собрано {len(manifest)} файлов в {DIST_DIR}")
+    return manifest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Сборка статики AI Cover Generator')
+    parser.add_argument('--extract', metavar='TEMPLATE', action='append', default=[],
+                        help='вынести inline CSS/JS шаблона в static/ перед сборкой')
+    args = parser.parse_args()
+
+    for template in args.extract:
+        for rel in extract_inline(template):
+            print(f"📤 {template}: вынесено в static/{rel}")
+    build()
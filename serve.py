@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+🚀 Production запуск AI Cover Generator через gunicorn
+
+    python serve.py                                  # gthread воркеры, WSGI
+    python serve.py --worker-class asgi --workers 2  # uvicorn воркеры, asgi.application
+
+Приложение импортируется один раз в мастере (preload): init_db(), каталоги,
+регистрация OAuth и шаблоны не повторяются в каждом воркере. После fork воркер
+прогревается (warmup_worker: манифест статики, кэш фрагментов, сборщик загрузок,
+соединения к Kie.ai/OpenAI). По SIGTERM gunicorn перестаёт принимать запросы и
+ждёт начатые не дольше --graceful-timeout, затем воркер дожидается фоновых
+задач (drain_background_jobs; uvicorn воркер - в lifespan shutdown asgi.py).
+SIGHUP перезапускает воркеры по одному без потери запросов.
+
+Все параметры можно задать переменными окружения (указаны в --help).
+"""
+
+import argparse
+import multiprocessing
+import os
+
+from gunicorn.app.base import BaseApplication
+
+WORKER_CLASSES = {
+    'sync': 'sync',
+    'gthread': 'gthread',
+    'asgi': 'uvicorn.workers.UvicornWorker',
+}
+
+
+def default_workers():
+    return multiprocessing.cpu_count() * 2 + 1
+
+
+def when_ready(server):
+    import app as cover_app
+    with served_flask_app(server).app_context():
+        cover_app.cleanup_old_history()
+    cover_app.log_event('server_ready', f"🎨 AI Cover Generator: {server.cfg.workers} воркеров "
+                        f"{server.cfg.worker_class_str}", workers=server.cfg.workers,
+                        worker_class=server.cfg.worker_class_str, bind=server.cfg.bind)
+
+
+def served_flask_app(server):
+    """Flask приложение, которое обслуживает gunicorn (в asgi режиме - внутри asgi.application)"""
+    application = server.app.wsgi()
+    return getattr(application, 'flask_app', application)
+
+
+def post_fork(server, worker):
+    import app as cover_app
+    cover_app.warmup_worker(served_flask_app(server))
+
+
+def worker_exit(server, worker):
+    # Только для sync/gthread: uvicorn воркер дожидается фоновых задач в lifespan shutdown (asgi.py)
+    import app as cover_app
+    with served_flask_app(server).app_context():
+        cover_app.drain_background_jobs(server.cfg.graceful_timeout)
+
+
+class CoverServer(BaseApplication):
+    """gunicorn с настройками из аргументов, без отдельного конфигурационного файла"""
+
+    def __init__(self, options, asgi=False):
+        self.options = options
+        self.asgi = asgi
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        if self.asgi:
+            from asgi import application
+            return application
+        from app import app
+        return app
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Production запуск AI Cover Generator')
+    parser.add_argument('--bind', default=os.environ.get('BIND', '0.0.0.0:5002'),
+                        help='адрес (BIND)')
+    parser.add_argument('--workers', type=int,
+                        default=int(os.environ.get('WEB_CONCURRENCY', default_workers())),
+                        help='число процессов (WEB_CONCURRENCY)')
+    parser.add_argument('--worker-class', choices=sorted(WORKER_CLASSES),
+                        default=os.environ.get('WORKER_CLASS', 'gthread'),
+                        help='sync, gthread или asgi (WORKER_CLASS)')
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('WORKER_THREADS', '8')),
+                        help='потоков в gthread воркере (WORKER_THREADS)')
+    parser.add_argument('--timeout', type=int, default=int(os.environ.get('WORKER_TIMEOUT', '120')),
+                        help='секунд до перезапуска зависшего воркера (WORKER_TIMEOUT)')
+    parser.add_argument('--graceful-timeout', type=int,
+                        default=int(os.environ.get('GRACEFUL_TIMEOUT', '60')),
+                        help='секунд на завершение начатых запросов при остановке (GRACEFUL_TIMEOUT)')
+    parser.add_argument('--max-requests', type=int, default=int(os.environ.get('MAX_REQUESTS', '0')),
+                        help='перезапуск воркера после N запросов, 0 - никогда (MAX_REQUESTS)')
+    args = parser.parse_args()
+
+    options = {
+        'bind': args.bind,
+        'workers': args.workers,
+        'worker_class': WORKER_CLASSES[args.worker_class],
+        'threads': args.threads,
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'max_requests': args.max_requests,
+        'max_requests_jitter': args.max_requests // 10,
+        'preload_app': True,
+        'when_ready': when_ready,
+        'post_fork': post_fork,
+        # access лог пишет само приложение (JSON, с request_id и этапами)
+    }
+    if args.worker_class != 'asgi':
+        options['worker_exit'] = worker_exit
+    CoverServer(options, asgi=args.worker_class == 'asgi').run()
+
+
+if __name__ == '__main__':
+    main()
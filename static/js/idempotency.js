@@ -0,0 +1,43 @@
+// Ключи идемпотентности для запросов генерации.
+// Повтор того же запроса (двойной клик, повтор после обрыва сети) отправляется
+// с тем же ключом, и сервер возвращает уже созданную задачу вместо новой.
+// После успешного ответа ключ сбрасывается: следующая генерация - новая задача.
+const idempotencyKeys = {};
+
+function newIdempotencyKey() {
+    if (window.crypto && crypto.randomUUID) {
+        return crypto.randomUUID();
+    }
+    return Date.now().toString(16) + '-' + Math.random().toString(16).slice(2);
+}
+
+function idempotencyKey(endpoint, body) {
+    const previous = idempotencyKeys[endpoint];
+    if (previous && previous.body === body) {
+        return previous.key;
+    }
+    const key = newIdempotencyKey();
+    idempotencyKeys[endpoint] = { body: body, key: key };
+    return key;
+}
+
+function forgetIdempotencyKey(endpoint) {
+    delete idempotencyKeys[endpoint];
+}
+
+// fetch POST с JSON телом и заголовком Idempotency-Key
+async function postIdempotent(endpoint, payload) {
+    const body = JSON.stringify(payload);
+    const response = await fetch(endpoint, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'Idempotency-Key': idempotencyKey(endpoint, body)
+        },
+        body: body
+    });
+    if (response.ok) {
+        forgetIdempotencyKey(endpoint);
+    }
+    return response;
+}
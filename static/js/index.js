@@ -0,0 +1,461 @@
+// Загружаем сохранённое состояние из localStorage
+let selectedPlatform = localStorage.getItem('selectedPlatform') || 'youtube_banner';
+let selectedStyle = localStorage.getItem('selectedStyle') || 'modern';
+let selectedFormat = localStorage.getItem('selectedFormat') || 'realistic';
+let savedPrompt = localStorage.getItem('savedPrompt') || '';
+
+// Функция сохранения состояния
+function saveState() {
+    localStorage.setItem('selectedPlatform', selectedPlatform);
+    localStorage.setItem('selectedStyle', selectedStyle);
+    localStorage.setItem('selectedFormat', selectedFormat);
+    localStorage.setItem('savedPrompt', document.getElementById('prompt').value);
+}
+
+// Восстанавливаем состояние при загрузке
+document.addEventListener('DOMContentLoaded', () => {
+    // Восстанавливаем выбранную платформу
+    const platformBtn = document.querySelector(`.platform-btn[data-platform="${selectedPlatform}"]`);
+    if (platformBtn) {
+        document.querySelectorAll('.platform-btn').forEach(b => b.classList.remove('active'));
+        platformBtn.classList.add('active');
+        const width = platformBtn.dataset.width;
+        const height = platformBtn.dataset.height;
+        document.getElementById('size-info').textContent = `${width} × ${height} px`;
+    }
+    
+    // Восстанавливаем выбранный стиль
+    const styleBtn = document.querySelector(`.style-btn[data-style="${selectedStyle}"]`);
+    if (styleBtn) {
+        document.querySelectorAll('.style-btn').forEach(b => b.classList.remove('active'));
+        styleBtn.classList.add('active');
+    }
+    
+    // Восстанавливаем выбранный формат
+    const formatBtn = document.querySelector(`.format-btn[data-format="${selectedFormat}"]`);
+    if (formatBtn) {
+        document.querySelectorAll('.format-btn').forEach(b => b.classList.remove('active'));
+        formatBtn.classList.add('active');
+    }
+    
+    // Восстанавливаем промпт
+    if (savedPrompt) {
+        document.getElementById('prompt').value = savedPrompt;
+    }
+});
+
+// Сохраняем состояние при изменении
+window.addEventListener('beforeunload', saveState);
+
+// Platform selection
+document.querySelectorAll('.platform-btn').forEach(btn => {
+    btn.addEventListener('click', () => {
+        document.querySelectorAll('.platform-btn').forEach(b => b.classList.remove('active'));
+        btn.classList.add('active');
+        selectedPlatform = btn.dataset.platform;
+        localStorage.setItem('selectedPlatform', selectedPlatform);
+        
+        const width = btn.dataset.width;
+        const height = btn.dataset.height;
+        document.getElementById('size-info').textContent = `${width} × ${height} px`;
+    });
+});
+
+// Style selection
+document.querySelectorAll('.style-btn').forEach(btn => {
+    btn.addEventListener('click', () => {
+        document.querySelectorAll('.style-btn').forEach(b => b.classList.remove('active'));
+        btn.classList.add('active');
+        selectedStyle = btn.dataset.style;
+        localStorage.setItem('selectedStyle', selectedStyle);
+    });
+});
+
+// Format selection
+document.querySelectorAll('.format-btn').forEach(btn => {
+    btn.addEventListener('click', () => {
+        document.querySelectorAll('.format-btn').forEach(b => b.classList.remove('active'));
+        btn.classList.add('active');
+        selectedFormat = btn.dataset.format;
+        localStorage.setItem('selectedFormat', selectedFormat);
+    });
+});
+
+// Сохраняем промпт при вводе
+document.getElementById('prompt').addEventListener('input', () => {
+    localStorage.setItem('savedPrompt', document.getElementById('prompt').value);
+});
+
+// Example prompts
+document.querySelectorAll('.example-btn').forEach(btn => {
+    btn.addEventListener('click', () => {
+        const prompt = btn.dataset.prompt;
+        document.getElementById('prompt').value = prompt;
+        localStorage.setItem('savedPrompt', prompt);
+    });
+});
+
+// Toggle images section
+function toggleImagesSection() {
+    const content = document.getElementById('images-content');
+    const icon = document.getElementById('toggle-icon');
+    if (content.style.display === 'none') {
+        content.style.display = 'block';
+        icon.classList.add('open');
+    } else {
+        content.style.display = 'none';
+        icon.classList.remove('open');
+    }
+}
+
+// Get image URLs
+function getImageUrls() {
+    const urls = [];
+    for (let i = 1; i <= 5; i++) {
+        const input = document.getElementById(`image-url-${i}`);
+        if (input && input.value.trim()) {
+            urls.push(input.value.trim());
+        }
+    }
+    return urls;
+}
+
+async function handleFileUpload(photoNum, input) {
+    const file = input.files[0];
+    if (!file) return;
+    
+    const formData = new FormData();
+    formData.append('file', file);
+    
+    const uploadBtn = document.querySelector(`button[onclick*="file-upload-${photoNum}"]`);
+    if (uploadBtn) {
+        uploadBtn.disabled = true;
+        uploadBtn.textContent = '⏳ Загрузка...';
+    }
+    
+    try {
+        const response = await fetch('/covers/api/upload', {
+            method: 'POST',
+            body: formData
+        });
+        
+        const data = await response.json();
+        
+        if (data.success) {
+            // Заполняем соответствующее поле URL
+            const urlInput = document.getElementById(`image-url-${photoNum}`);
+            if (urlInput) {
+                urlInput.value = data.url;
+            }
+            if (uploadBtn) {
+                uploadBtn.classList.add('uploaded');
+                uploadBtn.textContent = '✅ Загружено';
+            }
+        } else {
+            alert('Ошибка загрузки: ' + (data.error || 'Неизвестная ошибка'));
+            if (uploadBtn) {
+                uploadBtn.disabled = false;
+                uploadBtn.textContent = `📁 Загрузить фото ${photoNum}`;
+            }
+        }
+    } catch (error) {
+        alert('Ошибка загрузки: ' + error.message);
+        if (uploadBtn) {
+            uploadBtn.disabled = false;
+            uploadBtn.textContent = `📁 Загрузить фото ${photoNum}`;
+        }
+    }
+}
+
+// Загрузка нескольких фото одним запросом - заполняет свободные слоты
+async function handleBatchUpload(input) {
+    const freeSlots = [];
+    for (let i = 1; i <= 5; i++) {
+        const urlInput = document.getElementById(`image-url-${i}`);
+        if (urlInput && !urlInput.value.trim()) {
+            freeSlots.push(i);
+        }
+    }
+    const files = Array.from(input.files).slice(0, freeSlots.length);
+    input.value = '';
+    if (!files.length) {
+        if (!freeSlots.length) alert('Все 5 слотов для фото уже заняты');
+        return;
+    }
+    
+    const formData = new FormData();
+    files.forEach(file => formData.append('files', file));
+    
+    const batchBtn = document.getElementById('batch-upload-btn');
+    batchBtn.disabled = true;
+    batchBtn.textContent = `⏳ Загрузка ${files.length}...`;
+    
+    try {
+        const response = await fetch('/covers/api/upload/batch', {
+            method: 'POST',
+            body: formData
+        });
+        const data = await response.json();
+        const errors = [];
+        
+        (data.files || []).forEach(result => {
+            if (!result.success) {
+                errors.push(`${result.name || ''}: ${result.error}`);
+                return;
+            }
+            const slot = freeSlots.shift();
+            document.getElementById(`image-url-${slot}`).value = result.url;
+            const uploadBtn = document.querySelector(`button[onclick*="file-upload-${slot}"]`);
+            if (uploadBtn) {
+                uploadBtn.classList.add('uploaded');
+                uploadBtn.disabled = true;
+                uploadBtn.textContent = '✅ Загружено';
+            }
+        });
+        
+        if (data.error) errors.push(data.error);
+        if (errors.length) alert('Ошибка загрузки:\n' + errors.join('\n'));
+    } catch (error) {
+        alert('Ошибка загрузки: ' + error.message);
+    }
+    
+    batchBtn.disabled = false;
+    batchBtn.textContent = '📂 Загрузить несколько';
+}
+
+// Prompt Generator Functions
+function togglePromptGenerator() {
+    const content = document.getElementById('prompt-generator-content');
+    const icon = document.getElementById('prompt-toggle-icon');
+    if (content.style.display === 'none') {
+        content.style.display = 'block';
+        icon.classList.add('open');
+    } else {
+        content.style.display = 'none';
+        icon.classList.remove('open');
+    }
+}
+
+async function generatePrompt() {
+    const topic = document.getElementById('generator-topic').value.trim();
+    if (!topic) {
+        alert('Пожалуйста, укажите тему обложки');
+        return;
+    }
+    
+    const description = document.getElementById('generator-description').value.trim();
+    const btn = document.getElementById('generate-prompt-btn');
+    btn.disabled = true;
+    btn.textContent = '⏳ Генерирую...';
+    
+    try {
+        const response = await fetch('/covers/api/generate-prompt', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                topic: topic,
+                description: description,
+                platform: selectedPlatform,
+                style: selectedStyle,
+                format: selectedFormat
+            })
+        });
+        
+        const data = await response.json();
+        
+        if (data.error) {
+            throw new Error(data.error);
+        }
+        
+        // Show generated prompt
+        document.getElementById('generated-prompt-text').textContent = data.prompt;
+        document.getElementById('generated-prompt-box').style.display = 'block';
+        
+    } catch (error) {
+        alert('Ошибка: ' + error.message);
+    } finally {
+        btn.disabled = false;
+        btn.textContent = '✨ Сгенерировать промпт';
+    }
+}
+
+function acceptGeneratedPrompt() {
+    const promptText = document.getElementById('generated-prompt-text').textContent;
+    document.getElementById('prompt').value = promptText;
+    localStorage.setItem('savedPrompt', promptText);
+    document.getElementById('generated-prompt-box').style.display = 'none';
+    togglePromptGenerator();
+}
+
+function regeneratePrompt() {
+    generatePrompt();
+}
+
+function editGeneratedPrompt() {
+    const promptText = document.getElementById('generated-prompt-text').textContent;
+    document.getElementById('prompt').value = promptText;
+    localStorage.setItem('savedPrompt', promptText);
+    document.getElementById('generated-prompt-box').style.display = 'none';
+}
+
+// Attach generate prompt button
+document.getElementById('generate-prompt-btn').addEventListener('click', generatePrompt);
+
+// Variables for stop functionality
+let currentTaskId = null;
+let statusCheckInterval = null;
+let isStopped = false;
+
+// Stop button handler
+document.getElementById('stop-btn').addEventListener('click', async () => {
+    if (currentTaskId) {
+        isStopped = true;
+        if (statusCheckInterval) {
+            clearInterval(statusCheckInterval);
+            statusCheckInterval = null;
+        }
+        
+        // Try to cancel task on server
+        try {
+            await fetch(`/covers/api/stop/${currentTaskId}`, { method: 'POST' });
+        } catch (e) {
+            console.log('Stop request failed:', e);
+        }
+        
+        // Reset UI
+        document.getElementById('loading').style.display = 'none';
+        document.getElementById('generate-btn').disabled = false;
+        document.getElementById('stop-btn').style.display = 'none';
+        document.getElementById('result-placeholder').style.display = 'flex';
+        currentTaskId = null;
+        alert('Генерация остановлена');
+    }
+});
+
+// Generate button
+document.getElementById('generate-btn').addEventListener('click', async () => {
+    const prompt = document.getElementById('prompt').value.trim();
+    
+    if (!prompt) {
+        alert('Пожалуйста, опишите желаемую обложку');
+        return;
+    }
+    
+    // Reset stop flag
+    isStopped = false;
+    
+    // Get reference image URLs
+    const imageUrls = getImageUrls();
+    
+    // Show loading
+    document.getElementById('result-placeholder').style.display = 'none';
+    document.getElementById('result-image').style.display = 'none';
+    document.getElementById('error-message').style.display = 'none';
+    document.getElementById('loading').style.display = 'flex';
+    document.getElementById('generate-btn').disabled = true;
+    document.getElementById('stop-btn').style.display = 'block';
+    
+    try {
+        // Create task with image URLs and format
+        const response = await postIdempotent('/covers/api/generate', {
+            platform: selectedPlatform,
+            style: selectedStyle,
+            format: selectedFormat,
+            prompt: prompt,
+            image_urls: imageUrls
+        });
+        
+        const data = await response.json();
+        
+        if (data.error) {
+            throw new Error(data.error);
+        }
+        
+        // Poll for result
+        currentTaskId = data.taskId;
+        document.getElementById('loading-text').textContent = 'Генерация... Это может занять 30-60 секунд';
+        
+        let attempts = 0;
+        const maxAttempts = 60;
+        
+        const checkStatus = async () => {
+            if (isStopped) {
+                return;
+            }
+            
+            if (attempts >= maxAttempts) {
+                throw new Error('Превышено время ожидания. Попробуйте снова.');
+            }
+            
+            const statusResponse = await fetch(`/covers/api/status/${currentTaskId}`);
+            const statusData = await statusResponse.json();
+            
+            if (statusData.state === 'success' && statusData.imageUrl) {
+                // Success!
+                document.getElementById('loading').style.display = 'none';
+                document.getElementById('result-image').style.display = 'flex';
+                document.getElementById('generated-image').src = statusData.imageUrl;
+                document.getElementById('download-link').href = statusData.imageUrl;
+                document.getElementById('generate-btn').disabled = false;
+                document.getElementById('stop-btn').style.display = 'none';
+                currentTaskId = null;
+                if (statusCheckInterval) {
+                    clearInterval(statusCheckInterval);
+                    statusCheckInterval = null;
+                }
+            } else if (statusData.state === 'fail') {
+                throw new Error(statusData.error || 'Генерация не удалась');
+            } else if (statusData.state === 'cancelled') {
+                // Остановлена (например, в другой вкладке) - дальше не опрашиваем
+                document.getElementById('loading').style.display = 'none';
+                document.getElementById('generate-btn').disabled = false;
+                document.getElementById('stop-btn').style.display = 'none';
+                document.getElementById('result-placeholder').style.display = 'flex';
+                currentTaskId = null;
+            } else {
+                // Still processing
+                attempts++;
+                if (!isStopped) {
+                    statusCheckInterval = setTimeout(checkStatus, 2000);
+                }
+            }
+        };
+        
+        await checkStatus();
+        
+    } catch (error) {
+        if (!isStopped) {
+            document.getElementById('loading').style.display = 'none';
+            document.getElementById('error-message').style.display = 'block';
+            document.getElementById('error-text').textContent = error.message;
+        }
+        document.getElementById('generate-btn').disabled = false;
+        document.getElementById('stop-btn').style.display = 'none';
+        currentTaskId = null;
+        if (statusCheckInterval) {
+            clearInterval(statusCheckInterval);
+            statusCheckInterval = null;
+        }
+    }
+});
+
+function resetGenerator() {
+    document.getElementById('result-image').style.display = 'none';
+    document.getElementById('error-message').style.display = 'none';
+    document.getElementById('result-placeholder').style.display = 'flex';
+    document.getElementById('prompt').value = '';
+    localStorage.setItem('savedPrompt', '');
+    // Clear image URLs
+    for (let i = 1; i <= 5; i++) {
+        const input = document.getElementById(`image-url-${i}`);
+        if (input) input.value = '';
+        const fileInput = document.getElementById(`file-upload-${i}`);
+        if (fileInput) fileInput.value = '';
+        const uploadBtn = document.querySelector(`button[onclick*="file-upload-${i}"]`);
+        if (uploadBtn) {
+            uploadBtn.classList.remove('uploaded');
+            uploadBtn.disabled = false;
+            uploadBtn.textContent = `📁 Загрузить фото ${i}`;
+        }
+    }
+}
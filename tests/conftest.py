@@ -0,0 +1,51 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as covers  # noqa: E402
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """Фабрика приложений с отдельными БД и каталогами в tmp_path; фоновые потоки выключены"""
+    def make(**overrides):
+        config = {
+            'DATABASE': str(tmp_path / 'users.db'),
+            'UPLOAD_FOLDER': str(tmp_path / 'uploads'),
+            'OUTPUT_FOLDER': str(tmp_path / 'output'),
+            'COMIC_FOLDER': str(tmp_path / 'comics'),
+            'PROFILE_DIR': str(tmp_path / 'profiles'),
+            'UPLOAD_GC_INTERVAL': 0,
+            'METRICS_FLUSH_INTERVAL': 0,
+            'BATCH_TICK': 0,
+        }
+        config.update(overrides)
+        return covers.create_app(config)
+    return make
+
+
+@pytest.fixture
+def flask_app(make_app):
+    return make_app()
+
+
+@pytest.fixture
+def user_id(flask_app):
+    with flask_app.app_context():
+        conn = covers.get_db()
+        cursor = conn.execute("INSERT INTO users (username, email, api_token) VALUES ('tester', 'tester@example.com', 'kie-token')")
+        conn.commit()
+        conn.close()
+    return cursor.lastrowid
+
+
+@pytest.fixture
+def client(flask_app, user_id):
+    """Тестовый клиент с сессией пользователя"""
+    client = flask_app.test_client()
+    with client.session_transaction() as session:
+        session['user_id'] = user_id
+    return client
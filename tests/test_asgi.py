@@ -0,0 +1,112 @@
+import asyncio
+import threading
+
+import pytest
+from flask import request
+
+pytest.importorskip('aiohttp')
+asgi = pytest.importorskip('asgi')
+
+
+async def call(application, method, path, body=b'', headers=()):
+    """Один HTTP запрос к ASGI приложению: (код ответа, заголовки, куски тела)"""
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+    async def send(message):
+        sent.append(message)
+
+    path, _, query = path.partition('?')
+    await application({'type': 'http', 'method': method, 'path': path, 'root_path': '', 'http_version': '1.1',
+                       'query_string': query.encode(), 'headers': list(headers), 'scheme': 'http',
+                       'server': ('testserver', 80), 'client': ('127.0.0.1', 1234)}, receive, send)
+    start = sent[0]
+    return start['status'], dict(start['headers']), [m.get('body', b'') for m in sent[1:]]
+
+
+def test_flask_routes_run_concurrently_in_pool(flask_app):
+    both_inside = threading.Barrier(2, timeout=5)
+
+    def wait_for_neighbour():
+        both_inside.wait()  # в одном потоке второй запрос сюда бы не попал
+        return threading.current_thread().name
+    flask_app.add_url_rule('/covers/test/barrier', 'barrier', wait_for_neighbour)
+    application = asgi.ThreadPoolWsgiToAsgi(flask_app)
+
+    async def main():
+        return await asyncio.gather(*(call(application, 'GET', '/covers/test/barrier') for _ in range(2)))
+    results = asyncio.run(main())
+    assert [status for status, _, _ in results] == [200, 200]
+    assert len({b''.join(chunks) for _, _, chunks in results}) == 2
+
+
+def test_streamed_response_and_request_body(flask_app):
+    def stream():
+        parts = request.get_data(as_text=True).split(',')
+        return (f'{part}:' for part in parts), 201
+    flask_app.add_url_rule('/covers/test/stream', 'stream', stream, methods=['POST'])
+    application = asgi.ThreadPoolWsgiToAsgi(flask_app)
+    status, headers, chunks = asyncio.run(call(
+        application, 'POST', '/covers/test/stream?x=1', b'a,b,c', [(b'content-type', b'text/plain')]))
+    assert status == 201 and headers[b'content-type'].startswith(b'text/html')
+    assert chunks == [b'a:', b'b:', b'c:', b'']
+
+
+def session_cookie(flask_app, user_id):
+    value = flask_app.session_interface.get_signing_serializer(flask_app).dumps({'user_id': user_id})
+    return (b'cookie', f"{flask_app.config['SESSION_COOKIE_NAME']}={value}".encode())
+
+
+def test_flow_steps_see_app_config(make_app, tmp_path, monkeypatch):
+    flask_app = make_app(DATABASE=str(tmp_path / 'async.db'))
+    from app import Config, FlowPause, app_state
+
+    def config_flow():
+        before = Config.DATABASE
+        yield FlowPause(0)
+        return {'before': before, 'after': Config.DATABASE,
+                'state': app_state() is flask_app.extensions['covers_state']}, 200
+    flask_app.add_url_rule('/covers/test/config', 'test_config', lambda: '')
+    monkeypatch.setitem(asgi.ASYNC_FLOWS, 'test_config', lambda user_id, args, data, key: config_flow())
+    application = asgi.AsyncCoverApp(flask_app)
+
+    async def main():
+        try:
+            return await call(application, 'GET', '/covers/test/config', headers=[session_cookie(flask_app, 1)])
+        finally:
+            await application.client.close()
+            application.executor.shutdown()
+    status, _, chunks = asyncio.run(main())
+    assert status == 200
+    assert flask_app.json.loads(b''.join(chunks)) == {
+        'before': str(tmp_path / 'async.db'), 'after': str(tmp_path / 'async.db'), 'state': True}
+
+
+def test_lifespan_starts_and_drains_background_threads(make_app):
+    flask_app = make_app(UPLOAD_GC_INTERVAL=3600, BATCH_TICK=3600)
+    state = flask_app.extensions['covers_state']
+    application = asgi.AsyncCoverApp(flask_app)
+    events = asyncio.Queue()
+    sent = []
+
+    async def send(message):
+        sent.append(message['type'])
+
+    async def main():
+        lifespan = asyncio.create_task(application({'type': 'lifespan'}, events.get, send))
+        await events.put({'type': 'lifespan.startup'})
+        while not sent:
+            await asyncio.sleep(0.01)
+        threads = (state.upload_gc_thread, state.batch_scheduler_thread)
+        alive = [thread is not None and thread.is_alive() for thread in threads]
+        await events.put({'type': 'lifespan.shutdown'})
+        await lifespan
+        return alive, threads
+
+    alive, threads = asyncio.run(main())
+    assert alive == [True, True]
+    assert sent == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    assert state.shutdown_event.is_set() and not any(thread.is_alive() for thread in threads)
@@ -0,0 +1,98 @@
+import pytest
+
+import app as covers
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload):
+        self.status_code = status_code
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+@pytest.fixture
+def kie(monkeypatch):
+    """Подменяет вызовы Kie.ai: outcomes - ответы или исключения по очереди"""
+    calls = []
+    outcomes = []
+
+    def perform(call):
+        calls.append(call)
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    monkeypatch.setattr(covers, 'perform_upstream_call', perform)
+    return calls, outcomes
+
+
+@pytest.fixture
+def batch(flask_app, client):
+    response = client.post('/covers/api/batches', json={'items': [{'prompt': 'cat', 'platform': 'youtube_thumbnail'}]})
+    assert response.status_code == 202
+    return response.get_json()['batchId']
+
+
+@pytest.fixture
+def ctx(flask_app):
+    with flask_app.app_context():
+        yield
+
+
+def created(task_id):
+    return FakeResponse(200, {'code': 200, 'data': {'taskId': task_id}})
+
+
+def item(batch_id):
+    conn = covers.get_db()
+    row = conn.execute('SELECT * FROM batch_items WHERE batch_id = ?', (batch_id,)).fetchone()
+    conn.close()
+    return row
+
+
+@pytest.mark.parametrize('outcome, status', [
+    (covers.UpstreamConnectError('connection refused'), 'queued'),
+    (FakeResponse(429, {'code': 429, 'msg': 'rate limited'}), 'queued'),
+    (FakeResponse(503, ValueError), 'queued'),
+    (FakeResponse(200, {'code': 455, 'msg': 'maintenance'}), 'queued'),
+    (TimeoutError('read timeout'), 'failed'),
+    (FakeResponse(500, {'code': 500, 'msg': 'internal error'}), 'failed'),
+    (FakeResponse(504, {'code': 504, 'msg': 'gateway timeout'}), 'failed'),
+    (FakeResponse(200, {'code': 402, 'msg': 'no credits'}), 'failed'),
+])
+def test_submit_retries_only_when_task_was_not_created(make_app, client, kie, outcome, status, monkeypatch):
+    flask_app = make_app(UPSTREAM_RETRIES=0)
+    calls, outcomes = kie
+    if isinstance(outcome, FakeResponse) and outcome.payload is ValueError:
+        monkeypatch.setattr(outcome, 'json', lambda: (_ for _ in ()).throw(ValueError('not json')))
+    outcomes.append(outcome)
+    with flask_app.app_context():
+        batch_id = client.post('/covers/api/batches', json={
+            'items': [{'prompt': 'cat', 'platform': 'youtube_thumbnail'}]}).get_json()['batchId']
+        covers.run_batch_tick()
+        row = item(batch_id)
+    assert (row['status'], row['attempts'], len(calls)) == (status, 1, 1)
+
+
+def test_resubmit_after_crash_reuses_task(ctx, batch, kie):
+    calls, outcomes = kie
+    outcomes.append(created('task-1'))
+    covers.run_batch_tick()
+    assert (item(batch)['status'], item(batch)['task_id']) == ('processing', 'task-1')
+
+    # Воркер умер до записи результата: элемент снова в очереди
+    conn = covers.get_db()
+    conn.execute("UPDATE batch_items SET status = 'queued', task_id = NULL WHERE batch_id = ?", (batch,))
+    conn.close()
+    covers.run_batch_tick()
+    row = item(batch)
+    assert (row['status'], row['task_id'], len(calls)) == ('processing', 'task-1', 1)
+
+
+def test_batch_item_retryable():
+    assert covers.batch_item_retryable({'error': 'open', 'service': 'kie', 'retry_after': 5}, 503)
+    assert covers.batch_item_retryable({'error': 'rate limit', 'code': 429, 'retryable': True}, 400)
+    assert not covers.batch_item_retryable({'error': 'rate limit', 'code': 429, 'retryable': False}, 400)
+    assert not covers.batch_item_retryable({'error': 'read timed out'}, 500)
@@ -0,0 +1,104 @@
+import pytest
+
+import app as covers
+
+
+@pytest.fixture
+def clock(make_app, monkeypatch):
+    """Управляемое time.monotonic и Config breaker'а с маленьким окном"""
+    now = [1000.0]
+    monkeypatch.setattr(covers.time, 'monotonic', lambda: now[0])
+    with make_app(BREAKER_MIN_CALLS=4, BREAKER_ERROR_RATE=0.5, BREAKER_OPEN_SECONDS=30).app_context():
+        yield now
+
+
+@pytest.fixture
+def breaker(clock):
+    return covers.CircuitBreaker('kie', 'Kie.ai', slow_call=10.0)
+
+
+def trip(breaker):
+    for ok in (True, True, False, False):
+        breaker.before_call()
+        breaker.record(ok, 0.1)
+
+
+def test_opens_on_error_rate(breaker):
+    for ok in (True, True, False):
+        breaker.record(ok, 0.1)
+    assert breaker.state == 'closed'  # меньше BREAKER_MIN_CALLS - не судим
+    breaker.record(False, 0.1)
+    assert breaker.state == 'open' and breaker.is_open()
+    with pytest.raises(covers.CircuitOpenError) as error:
+        breaker.before_call()
+    assert error.value.retry_after == 30
+    assert breaker.snapshot()['rejected'] == 1
+
+
+def test_opens_on_slow_calls(breaker):
+    for _ in range(4):
+        breaker.record(True, 12.0)
+    assert breaker.state == 'open'
+
+
+def test_half_open_lets_one_probe_and_closes_on_success(breaker, clock):
+    trip(breaker)
+    clock[0] += 30
+    assert not breaker.is_open()
+    breaker.before_call()  # пробный вызов
+    assert breaker.state == 'half_open'
+    with pytest.raises(covers.CircuitOpenError):
+        breaker.before_call()  # второй ждёт результата пробного
+    breaker.record(True, 0.1)
+    assert breaker.state == 'closed' and breaker.snapshot()['window_calls'] == 0
+    breaker.before_call()
+
+
+def test_failed_probe_reopens(breaker, clock):
+    trip(breaker)
+    clock[0] += 30
+    breaker.before_call()
+    breaker.record(False, 0.1)
+    assert breaker.state == 'open' and breaker.snapshot()['opened'] == 2
+    with pytest.raises(covers.CircuitOpenError):
+        breaker.before_call()
+
+
+def test_slow_probe_reopens(breaker, clock):
+    trip(breaker)
+    clock[0] += 30
+    breaker.before_call()
+    breaker.record(True, 11.0)
+    assert breaker.state == 'open'
+
+
+def test_old_calls_leave_window(breaker, clock):
+    for ok in (False, False, False):
+        breaker.record(ok, 0.1)
+    clock[0] += 61
+    breaker.record(False, 0.1)
+    assert breaker.state == 'closed'
+
+
+def test_upstream_status_requires_operator(make_app, user_id):
+    flask_app = make_app(METRICS_TOKEN='secret', ADMIN_EMAILS={'admin@example.com'})
+    anonymous = flask_app.test_client()
+    assert anonymous.get('/covers/api/upstream-status').status_code == 401
+    assert anonymous.get('/covers/api/upstream-status',
+                         headers={'Authorization': 'Bearer wrong'}).status_code == 401
+    response = anonymous.get('/covers/api/upstream-status', headers={'Authorization': 'Bearer secret'})
+    assert response.status_code == 200 and 'kie' in response.get_json()['breakers']
+
+    user = flask_app.test_client()
+    with user.session_transaction() as session:
+        session['user_id'] = user_id
+    assert user.get('/covers/api/upstream-status').status_code == 403
+
+
+def test_upstream_status_for_admin_without_token(make_app, user_id):
+    flask_app = make_app(ADMIN_EMAILS={'tester@example.com'})
+    admin = flask_app.test_client()
+    assert admin.get('/covers/api/upstream-status', headers={'Authorization': 'Bearer '}).status_code == 401
+    with admin.session_transaction() as session:
+        session['user_id'] = user_id
+    assert admin.get('/covers/api/upstream-status').status_code == 200
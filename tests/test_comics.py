@@ -0,0 +1,87 @@
+import io
+import os
+import time
+
+import pytest
+from PIL import Image
+
+import app as covers
+
+
+class FakeResponse:
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+
+def encoded(size, mode, color, fmt):
+    buffer = io.BytesIO()
+    Image.new(mode, size, color).save(buffer, fmt)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def ctx(make_app, tmp_path):
+    with make_app(COMIC_PANEL_MAX=100, COMIC_GUTTER=10, COMIC_FOLDER=str(tmp_path / 'comics')).app_context():
+        yield
+
+
+def add_comic(comic_id, status, created_at, blocks=0, user_id=1):
+    conn = covers.get_db()
+    conn.execute('INSERT INTO comics (id, user_id, layout, status, panels, filename, created_at) '
+                 'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                 (comic_id, user_id, 'grid', status, blocks, f'{comic_id}.jpg' if status == 'ready' else None,
+                  created_at))
+    for block in range(1, blocks + 1):
+        task_id = f'{comic_id}-{block}'
+        conn.execute('INSERT INTO comic_panels (comic_id, block, task_id) VALUES (?, ?, ?)', (comic_id, block, task_id))
+        conn.execute("INSERT INTO generations (user_id, task_id, platform, style, prompt, status, image_url) "
+                     "VALUES (?, ?, 'comic', 'cartoon', 'p', 'completed', ?)",
+                     (user_id, task_id, f'https://img.example/{task_id}.jpg'))
+    conn.close()
+
+
+def test_compose_fits_panels_into_cells(ctx, tmp_path):
+    add_comic('c1', 'composing', time.time(), blocks=3)
+    flow = covers.compose_comic_flow('c1')
+    calls = next(flow)
+    assert [call.url for call in calls] == [f'https://img.example/c1-{block}.jpg' for block in (1, 2, 3)]
+    panels = [FakeResponse(encoded((400, 200), 'RGB', (255, 0, 0), 'JPEG')),
+              FakeResponse(encoded((100, 100), 'RGBA', (0, 255, 0, 128), 'PNG')),
+              FakeResponse(encoded((50, 80), 'P', 3, 'GIF'))]
+    with pytest.raises(StopIteration) as done:
+        flow.send(panels)
+    width, height, size = done.value.value
+    # Три кадра в ряд, ячейка 100x100 (кадр 400x200 уменьшен до 100x50)
+    assert (width, height) == (3 * 100 + 4 * 10, 100 + 2 * 10)
+    path = tmp_path / 'comics' / 'c1.jpg'
+    assert size == os.path.getsize(path)
+    with Image.open(path) as comic:
+        assert comic.size == (width, height)
+        red = comic.getpixel((10 + 50, 10 + 50))
+        assert red[0] > 200 and red[1] < 60
+        assert comic.getpixel((10 + 50, 12)) == pytest.approx((255, 255, 255), abs=8)  # поля над кадром 100x50
+
+
+def test_compose_fails_on_missing_panel(ctx):
+    add_comic('c2', 'composing', time.time(), blocks=2)
+    flow = covers.compose_comic_flow('c2')
+    next(flow)
+    with pytest.raises(RuntimeError, match='Кадр 2 не скачан: HTTP 404'):
+        flow.send([FakeResponse(encoded((10, 10), 'RGB', 0, 'JPEG')), FakeResponse(b'', status_code=404)])
+
+
+def test_cleanup_keeps_comics_in_progress(ctx, tmp_path):
+    old = time.time() - 4 * 86400
+    for status in ('pending', 'composing', 'ready', 'failed'):
+        add_comic(status, status, old)
+    add_comic('fresh', 'ready', time.time())
+    os.makedirs(tmp_path / 'comics')
+    (tmp_path / 'comics' / 'ready.jpg').write_bytes(b'jpg')
+
+    covers.cleanup_old_history()
+    conn = covers.get_db()
+    left = {row['id'] for row in conn.execute('SELECT id FROM comics')}
+    conn.close()
+    assert left == {'pending', 'composing', 'fresh'}
+    assert not (tmp_path / 'comics' / 'ready.jpg').exists()
@@ -0,0 +1,86 @@
+import sqlite3
+
+from flask import url_for
+
+import app as covers
+
+
+def test_config_is_per_app(make_app, tmp_path):
+    first = make_app(DATABASE=str(tmp_path / 'first.db'))
+    second = make_app(DATABASE=str(tmp_path / 'second.db'), UPLOAD_FOLDER=str(tmp_path / 'second'))
+    with first.app_context():
+        assert covers.Config.DATABASE == str(tmp_path / 'first.db')
+        assert covers.Config.UPLOAD_FOLDER == str(tmp_path / 'uploads')
+        covers.get_db().close()
+    with second.app_context():
+        assert covers.Config.DATABASE == str(tmp_path / 'second.db')
+        assert covers.Config.UPLOAD_FOLDER == str(tmp_path / 'second')
+    assert second.config['UPLOAD_FOLDER'] == str(tmp_path / 'second')
+    # Вне контекста - значения по умолчанию, глобальный класс не тронут
+    assert covers.Config.DATABASE == covers.DefaultConfig.DATABASE
+    assert (tmp_path / 'first.db').exists() and not (tmp_path / 'second.db').exists()
+
+
+def test_background_job_sees_app_config(make_app, tmp_path):
+    flask_app = make_app(DATABASE=str(tmp_path / 'job.db'))
+    with flask_app.app_context():
+        job = covers.in_app_context(lambda: covers.Config.DATABASE)
+    result = flask_app.extensions['covers_state'].batch_executor.submit(job).result()
+    assert result == str(tmp_path / 'job.db')
+
+
+def test_background_state_is_per_app(make_app, tmp_path):
+    first = make_app(UPLOAD_GC_INTERVAL=3600, BATCH_WORKERS=2)
+    second = make_app(UPLOAD_FOLDER=str(tmp_path / 'second'), UPLOAD_GC_INTERVAL=3600, BATCH_WORKERS=5)
+    states = [flask_app.extensions['covers_state'] for flask_app in (first, second)]
+    assert [state.batch_executor._max_workers for state in states] == [2, 5]
+    try:
+        for flask_app in (first, second):
+            with flask_app.app_context():
+                covers.start_upload_gc()
+        # Второе приложение запускает свой сборщик, а не видит поток первого
+        assert all(state.upload_gc_thread.is_alive() for state in states)
+        assert states[0].upload_gc_thread is not states[1].upload_gc_thread
+        assert (tmp_path / 'second' / '.partial').is_dir()
+
+        # Остановка первого приложения не трогает второе
+        with first.app_context():
+            covers.drain_background_jobs(timeout=5)
+        assert not states[0].upload_gc_thread.is_alive()
+        assert states[1].upload_gc_thread.is_alive() and not states[1].shutdown_event.is_set()
+        assert states[1].batch_executor.submit(lambda: 'ok').result() == 'ok'
+    finally:
+        for state in states:
+            state.shutdown_event.set()
+
+
+def test_url_builder(flask_app):
+    with flask_app.test_request_context():
+        assert url_for('covers.uploaded_file', filename='a.png') == '/covers/uploads/a.png'
+        assert url_for('covers.uploaded_file', filename='a.png', v=2) == '/covers/uploads/a.png?v=2'
+
+
+def test_schema_created_on_first_connection(flask_app, tmp_path):
+    with flask_app.app_context():
+        covers.get_db().close()
+    tables = {row[0] for row in sqlite3.connect(tmp_path / 'users.db').execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert {'users', 'generations', 'batches', 'idempotency_keys'} <= tables
+
+
+def test_warmup_uses_given_app(make_app, tmp_path, monkeypatch):
+    monkeypatch.setattr(covers, 'warm_upstream_connections', lambda: None)
+    flask_app = make_app(UPLOAD_FOLDER=str(tmp_path / 'warm'))
+    covers.warmup_worker(flask_app)
+    state = flask_app.extensions['covers_state']
+    assert state.asset_manifest is not None and 'partials/index_sidebar.html' in state.fragment_cache
+    assert (tmp_path / 'warm' / '.partial').is_dir() and (tmp_path / 'users.db').exists()
+
+
+def test_drain_runs_once(flask_app, monkeypatch):
+    events = []
+    monkeypatch.setattr(covers, 'log_event', lambda event, *args, **kwargs: events.append(event))
+    with flask_app.app_context():
+        covers.drain_background_jobs(timeout=1)
+        covers.drain_background_jobs(timeout=1)
+    assert events.count('worker_drained') == 1
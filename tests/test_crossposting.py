@@ -0,0 +1,38 @@
+import itertools
+
+import app as covers
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+def test_counts_generations_per_task(flask_app, client, user_id, monkeypatch):
+    task_ids = (f'task-{n}' for n in itertools.count(1))
+    monkeypatch.setattr(covers, 'perform_upstream_call',
+                        lambda call: FakeResponse({'code': 200, 'data': {'taskId': next(task_ids)}}))
+    response = client.post('/covers/api/generate', json={
+        'prompt': 'cat', 'platforms': ['youtube_thumbnail', 'telegram', 'facebook_post', 'instagram_post']})
+    body = response.get_json()
+    assert response.status_code == 200
+    assert len(body['tasks']) == 2 and len(body['platforms']) == 4
+
+    with flask_app.app_context():
+        conn = covers.get_db()
+        c = conn.cursor()
+        assert c.execute('SELECT COUNT(*) FROM generations').fetchone()[0] == 4
+        assert c.execute('SELECT generations_count FROM users WHERE id = ?', (user_id,)).fetchone()[0] == 2
+
+        for task in body['tasks']:
+            assert covers.finish_generation(c, task['taskId'], 'success', image_url='https://img.example/x.png')
+        assert not covers.finish_generation(c, body['tasks'][0]['taskId'], 'failed')
+        rollups = c.execute('SELECT platform, total, success FROM generation_rollups ORDER BY platform').fetchall()
+        conn.close()
+    assert sum(row['total'] for row in rollups) == 2
+    assert sorted(row['platform'] for row in rollups) == sorted(task['platforms'][0] for task in body['tasks'])
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import app as covers
+
+
+@pytest.fixture
+def ctx(flask_app):
+    with flask_app.app_context():
+        yield
+
+
+def add_generation(user_id, task_id, status, days_old, prompt='cover'):
+    conn = covers.get_db()
+    conn.execute('INSERT INTO generations (user_id, task_id, platform, prompt, status, created_at) '
+                 "VALUES (?, ?, 'youtube', ?, ?, ?)",
+                 (user_id, task_id, prompt, status, (datetime.now() - timedelta(days=days_old)).isoformat()))
+    conn.close()
+
+
+def test_cleanup_expires_every_finished_status(ctx, user_id):
+    for status in ('success', 'failed', 'cancelled', 'processing'):
+        add_generation(user_id, f'old-{status}', status, 4)
+    add_generation(user_id, 'new-success', 'success', 1)
+
+    assert covers.cleanup_old_history() == 3
+    conn = covers.get_db()
+    left = {row['task_id'] for row in conn.execute('SELECT task_id FROM generations')}
+    conn.close()
+    assert left == {'old-processing', 'new-success'}
+
+
+SEARCH_PROMPTS = ('Мой ЁЖИК в тумане', 'Café Ñandú neon', 'Ελλάδα ї straße')
+
+
+@pytest.fixture
+def searchable(ctx, user_id):
+    for i, prompt in enumerate(SEARCH_PROMPTS):
+        add_generation(user_id, f'task-{i}', 'success', 0, prompt)
+
+
+def search(client, q):
+    response = client.get('/covers/api/history/search', query_string={'q': q})
+    assert response.status_code == 200
+    return [row['prompt'] for row in response.get_json()['results']]
+
+
+def test_index_and_search_fold_agree(searchable):
+    conn = covers.get_db()
+    conn.execute("CREATE VIRTUAL TABLE temp.search_vocab USING fts5vocab(main, generations_fts, 'row')")
+    indexed = {row[0] for row in conn.execute('SELECT term FROM temp.search_vocab')}
+    conn.close()
+    folded = {term for prompt in SEARCH_PROMPTS for term in covers.search_term_re.findall(covers.search_fold(prompt))}
+    assert folded <= indexed
+    assert {'ежик', 'мой', 'cafe', 'nandu', 'ελλάδα', 'ї'} <= folded
+
+
+@pytest.mark.parametrize('q, found', [
+    ('ёжик', ['Мой ЁЖИК в тумане']),
+    ('ЕЖ тум', ['Мой ЁЖИК в тумане']),
+    ('мой', ['Мой ЁЖИК в тумане']),
+    ('мои', []),  # й - отдельная буква и в индексе, и при ранжировании
+    ('cafe nandú', ['Café Ñandú neon']),
+    ('ελλάδα', ['Ελλάδα ї straße']),
+    ('ї', ['Ελλάδα ї straße']),
+])
+def test_search_folds_like_the_index(client, searchable, q, found):
+    assert search(client, q) == found
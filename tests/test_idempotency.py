@@ -0,0 +1,114 @@
+import pytest
+
+import app as covers
+
+
+class FakeResponse:
+    def __init__(self, status_code, payload=None):
+        self.status_code = status_code
+        self.payload = payload or {}
+
+    def json(self):
+        return self.payload
+
+
+def task_flow(calls, status=200):
+    """flow генерации, который запоминает, что его выполнили"""
+    def make_flow(idempotent):
+        calls.append(idempotent)
+        return ({'success': True, 'task_id': f'task-{len(calls)}'}, status)
+        yield  # noqa - генератор, как настоящие flow
+    return make_flow
+
+
+@pytest.fixture
+def ctx(make_app):
+    flask_app = make_app(IDEMPOTENCY_WAIT=0)
+    with flask_app.app_context():
+        yield
+
+
+def run(key, data, make_flow, user_id=1):
+    return covers.run_flow(covers.idempotent_flow(user_id, 'generate_cover', key, data, make_flow))
+
+
+def test_replay_returns_saved_response(ctx):
+    calls = []
+    body, status = run('k1', {'prompt': 'cat'}, task_flow(calls))
+    assert (status, body['task_id'], calls) == (200, 'task-1', [True])
+    body, status = run('k1', {'prompt': 'cat'}, task_flow(calls))
+    assert status == 200 and body['task_id'] == 'task-1' and body['idempotent_replay']
+    assert calls == [True]
+
+
+def test_without_key_flow_is_not_idempotent(ctx):
+    calls = []
+    run(None, {'prompt': 'cat'}, task_flow(calls))
+    run(None, {'prompt': 'cat'}, task_flow(calls))
+    assert calls == [False, False]
+
+
+def test_same_key_other_body_conflicts(ctx):
+    calls = []
+    run('k1', {'prompt': 'cat'}, task_flow(calls))
+    body, status = run('k1', {'prompt': 'dog'}, task_flow(calls))
+    assert status == 422 and calls == [True]
+
+
+def test_failed_request_releases_key(ctx):
+    calls = []
+    assert run('k1', {'prompt': 'cat'}, task_flow(calls, status=400))[1] == 400
+    assert run('k1', {'prompt': 'cat'}, task_flow(calls))[1] == 200
+    assert calls == [True, True]
+
+
+def owner_in_flight(key, data):
+    """Первый запрос, занявший ключ и застрявший на вызове Kie.ai"""
+    def make_flow(idempotent):
+        response = yield covers.UpstreamCall('POST', 'http://kie.invalid/createTask')
+        return ({'success': True, 'task_id': 'owner', 'status_code': response.status_code}, 200)
+    flow = covers.idempotent_flow(1, 'generate_cover', key, data, make_flow)
+    assert isinstance(next(flow), covers.UpstreamCall)
+    return flow
+
+
+def test_duplicate_of_running_request_gets_409(ctx):
+    owner = owner_in_flight('k1', {'prompt': 'cat'})
+    calls = []
+    body, status = run('k1', {'prompt': 'cat'}, task_flow(calls))
+    assert status == 409 and calls == []
+    owner.close()  # закрытый flow освобождает ключ
+    assert run('k1', {'prompt': 'cat'}, task_flow(calls))[1] == 200
+
+
+def test_stale_pending_key_is_taken_over(ctx):
+    owner = owner_in_flight('k1', {'prompt': 'cat'})
+    conn = covers.get_db()
+    conn.execute("UPDATE idempotency_keys SET lease_until = 1 WHERE key = 'k1'")
+    conn.close()
+
+    calls = []
+    body, status = run('k1', {'prompt': 'cat'}, task_flow(calls))
+    assert (status, body['task_id'], calls) == (200, 'task-1', [True])
+
+    # Прежний владелец всё же дождался ответа: перехваченную запись он не перезаписывает
+    with pytest.raises(StopIteration):
+        owner.send(FakeResponse(200))
+    body, status = run('k1', {'prompt': 'cat'}, task_flow(calls))
+    assert body['task_id'] == 'task-1' and body['idempotent_replay']
+
+
+@pytest.mark.parametrize('status, idempotent, retry', [
+    (429, False, True), (503, False, True),
+    (502, False, False), (504, False, False), (502, True, True), (504, True, True),
+    (500, True, False), (200, False, False),
+])
+def test_create_task_retry_statuses(status, idempotent, retry):
+    assert covers.retryable_result(FakeResponse(status), idempotent) is retry
+
+
+def test_create_task_retry_kie_codes_and_errors():
+    assert covers.retryable_result(FakeResponse(200, {'code': 455}))
+    assert not covers.retryable_result(FakeResponse(200, {'code': 401}))
+    assert covers.retryable_result(covers.UpstreamConnectError('refused'))
+    assert not covers.retryable_result(TimeoutError('read timeout'), idempotent=True)
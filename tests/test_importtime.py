@@ -0,0 +1,11 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench'))
+
+import importtime  # noqa: E402
+
+
+def test_import_budget():
+    errors, report = importtime.check(runs=3)
+    assert not errors, report
@@ -0,0 +1,30 @@
+import os
+
+import pytest
+
+import app as covers
+
+
+@pytest.fixture
+def profiles(tmp_path):
+    """Каталог маршрута, где порядок по имени не совпадает с порядком по времени"""
+    directory = tmp_path / 'route'
+    directory.mkdir()
+    for mtime, name in ((100, 'c.folded'), (200, 'a.folded'), (300, 'b.pstats')):
+        path = directory / name
+        path.write_text('stack 1\n')
+        os.utime(path, (mtime, mtime))
+    return directory
+
+
+@pytest.mark.parametrize('max_files, kept', [
+    (2, ['a.folded', 'b.pstats']),
+    (5, ['a.folded', 'b.pstats', 'c.folded']),
+    (1, ['b.pstats']),
+    (0, ['b.pstats']),
+    (-3, ['b.pstats']),
+])
+def test_rotation_keeps_newest(make_app, profiles, max_files, kept):
+    with make_app(PROFILE_MAX_FILES=max_files).app_context():
+        covers.rotate_profiles(str(profiles))
+    assert sorted(os.listdir(profiles)) == kept
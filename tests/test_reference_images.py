@@ -0,0 +1,47 @@
+from concurrent.futures import Future
+
+import pytest
+
+import app as covers
+
+
+@pytest.fixture
+def uploads(make_app, tmp_path):
+    folder = tmp_path / 'uploads'
+    folder.mkdir()
+    (folder / 'photo.png').write_bytes(b'png')
+    with make_app(UPLOAD_FOLDER=str(folder), PUBLIC_URL='https://covers.example', REFERENCE_WAIT_TIMEOUT=5).app_context():
+        yield folder
+
+
+def finish(flow):
+    try:
+        while True:
+            assert isinstance(next(flow), covers.FlowPause)
+    except StopIteration as stop:
+        return stop.value
+
+
+def test_urls_are_cleaned_and_limited(uploads):
+    urls = ['', ' https://img.example/a.jpg ', '/covers/uploads/photo.png', 'https://img.example/b.jpg']
+    assert finish(covers.process_image_urls_flow(urls, 2)) == [
+        'https://img.example/a.jpg', 'https://covers.example/covers/uploads/photo.png']
+
+
+def test_waits_for_running_normalization_with_pauses(uploads):
+    job = Future()
+    covers.app_state().normalize_jobs['photo.png'] = job
+    flow = covers.process_image_urls_flow(['/covers/uploads/photo.png'], 5)
+    assert isinstance(next(flow), covers.FlowPause)
+    assert isinstance(next(flow), covers.FlowPause)
+    (uploads / 'photo.ref.jpg').write_bytes(b'jpg')
+    job.set_result('photo.ref.jpg')
+    assert finish(flow) == ['https://covers.example/covers/uploads/photo.ref.jpg']
+
+
+def test_falls_back_to_original_after_timeout(uploads, monkeypatch):
+    covers.app_state().normalize_jobs['photo.png'] = Future()
+    flow = covers.process_image_urls_flow(['/covers/uploads/photo.png'], 5)
+    assert isinstance(next(flow), covers.FlowPause)
+    monkeypatch.setattr(covers.time, 'time', lambda: float('inf'))
+    assert finish(flow) == ['https://covers.example/covers/uploads/photo.png']
@@ -0,0 +1,50 @@
+import threading
+import time
+
+import pytest
+
+import app as covers
+
+
+@pytest.fixture
+def ctx(make_app):
+    with make_app(SQLITE_BUSY_TIMEOUT=5).app_context():
+        yield
+
+
+def hold_write_lock(seconds):
+    writer = covers.get_db()
+    writer.execute('BEGIN IMMEDIATE')
+    writer.execute("INSERT INTO users (username, email) VALUES ('writer', 'writer@example.com')")
+
+    def release():
+        time.sleep(seconds)
+        writer.execute('COMMIT')
+        writer.close()
+    thread = threading.Thread(target=release)
+    thread.start()
+    return thread
+
+
+def test_busy_statement_waits_for_lock(ctx):
+    thread = hold_write_lock(0.2)
+    conn = covers.get_db()
+    started = time.perf_counter()
+    conn.execute("INSERT INTO users (username, email) VALUES ('reader', 'reader@example.com')")
+    assert time.perf_counter() - started >= 0.15
+    conn.close()
+    thread.join()
+
+
+def test_busy_inside_transaction_fails_fast(ctx):
+    conn = covers.get_db()
+    conn.execute('BEGIN')
+    conn.execute('SELECT COUNT(*) FROM users').fetchone()
+    thread = hold_write_lock(1)
+    started = time.perf_counter()
+    with pytest.raises(covers.sqlite3.OperationalError, match='locked'):
+        conn.execute("INSERT INTO users (username, email) VALUES ('reader', 'reader@example.com')")
+    assert time.perf_counter() - started < 0.5
+    conn.execute('ROLLBACK')
+    conn.close()
+    thread.join()
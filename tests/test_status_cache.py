@@ -0,0 +1,91 @@
+import json
+import time
+
+import pytest
+
+import app as covers
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def json(self):
+        return self.payload
+
+
+def record_info(state, url='https://example.com/cover.png'):
+    data = {'state': state}
+    if state == 'success':
+        data['resultJson'] = json.dumps({'resultUrls': [url]})
+    return FakeResponse({'code': 200, 'data': data})
+
+
+@pytest.fixture
+def task_id(flask_app, user_id):
+    task_id = f'task-{time.monotonic_ns()}'  # кэш в памяти общий для процесса
+    with flask_app.app_context():
+        conn = covers.get_db()
+        conn.execute("INSERT INTO generations (user_id, task_id, platform, prompt, status, submitted_at) "
+                     "VALUES (?, ?, 'youtube', 'cat', 'processing', ?)", (user_id, task_id, time.time()))
+        conn.commit()
+        conn.close()
+        yield task_id
+
+
+def generation_status(task_id):
+    conn = covers.get_db()
+    row = conn.execute('SELECT status FROM generations WHERE task_id = ?', (task_id,)).fetchone()
+    conn.close()
+    return row['status']
+
+
+def finish(flow, value):
+    with pytest.raises(StopIteration) as stop:
+        flow.send(value)
+    return stop.value.value
+
+
+def test_concurrent_polls_share_one_upstream_call(user_id, task_id):
+    owner = covers.check_status_flow(user_id, task_id)
+    waiter = covers.check_status_flow(user_id, task_id)
+    assert isinstance(next(owner), covers.UpstreamCall)
+    assert isinstance(next(waiter), covers.FlowPause)
+
+    body, status = finish(owner, record_info('success'))
+    assert status == 200 and body['state'] == 'success'
+    body, status = finish(waiter, None)
+    assert status == 200 and body['imageUrl'] == 'https://example.com/cover.png'
+    assert generation_status(task_id) == 'success'
+
+
+def test_waiter_finishes_generation_when_owner_fails_after_put(user_id, task_id, monkeypatch):
+    owner = covers.check_status_flow(user_id, task_id)
+    waiter = covers.check_status_flow(user_id, task_id)
+    assert isinstance(next(owner), covers.UpstreamCall)
+    assert isinstance(next(waiter), covers.FlowPause)
+
+    # Владелец аренды успел положить итог в кэш, но упал до записи в generations
+    def broken(*args, **kwargs):
+        raise RuntimeError('connection lost')
+    monkeypatch.setattr(covers, 'finish_generation', broken)
+    assert finish(owner, record_info('success'))[1] == 500
+    monkeypatch.undo()
+    assert generation_status(task_id) == 'processing'
+
+    # Ожидающий берёт итог из кэша (без второго вызова Kie.ai) и завершает генерацию сам
+    body, status = finish(waiter, None)
+    assert status == 200 and body['state'] == 'success'
+    assert generation_status(task_id) == 'success'
+
+
+def test_later_poll_repairs_generation_from_cached_result(user_id, task_id, monkeypatch):
+    owner = covers.check_status_flow(user_id, task_id)
+    next(owner)
+    monkeypatch.setattr(covers, 'finish_generation', lambda *args, **kwargs: 1 / 0)
+    assert finish(owner, record_info('fail'))[1] == 500
+    monkeypatch.undo()
+
+    body, status = covers.run_flow(covers.check_status_flow(user_id, task_id))
+    assert status == 200 and body['state'] == 'fail'
+    assert generation_status(task_id) == 'failed'
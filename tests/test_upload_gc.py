@@ -0,0 +1,102 @@
+import pytest
+
+import app as covers
+
+
+@pytest.fixture
+def uploads(make_app, tmp_path):
+    """Приложение с каталогом загрузок; upload(name) кладёт давно не использованный файл на учёт"""
+    folder = tmp_path / 'uploads'
+    folder.mkdir()
+    flask_app = make_app(UPLOAD_FOLDER=str(folder), PUBLIC_URL='https://covers.example')
+
+    def upload(name, user_id=1, ref=None):
+        (folder / name).write_bytes(b'x' * 100)
+        if ref:
+            (folder / ref).write_bytes(b'x' * 10)
+        conn = covers.get_db()
+        conn.execute("INSERT INTO uploads (filename, user_id, ref_filename, bytes, last_used_at) "
+                     "VALUES (?, ?, ?, ?, '2000-01-01 00:00:00')", (name, user_id, ref, 110 if ref else 100))
+        conn.close()
+
+    with flask_app.app_context():
+        yield folder, upload
+
+
+def tracked():
+    conn = covers.get_db()
+    names = {row['filename'] for row in conn.execute('SELECT filename FROM uploads')}
+    conn.close()
+    return names
+
+
+def add_generation(task_id, urls, status='processing'):
+    conn = covers.get_db()
+    c = conn.cursor()
+    c.execute("INSERT INTO generations (user_id, task_id, platform, style, prompt, status) "
+              "VALUES (1, ?, 'telegram', 'modern', 'p', ?)", (task_id, status))
+    covers.record_upload_refs(c, task_id, urls)
+    conn.close()
+
+
+def execute(sql, *parameters):
+    conn = covers.get_db()
+    conn.execute(sql, parameters)
+    conn.close()
+
+
+def collect():
+    """Проход сборщика, когда grace у всех фото уже истёк"""
+    execute("UPDATE uploads SET last_used_at = '2000-01-01 00:00:00'")
+    covers.collect_upload_garbage()
+
+
+def test_orphans_are_collected_and_references_kept(uploads):
+    folder, upload = uploads
+    upload('orphan.png')
+    upload('used.png', ref='used.ref.jpg')
+    upload('local.png')
+    # Ссылка на нормализованную копию и локальный путь указывают на оригинал
+    add_generation('task-1', ['https://covers.example/covers/uploads/used.ref.jpg', '/covers/uploads/local.png'],
+                   status='completed')
+
+    collect()
+    assert tracked() == {'used.png', 'local.png'}
+    assert not (folder / 'orphan.png').exists() and (folder / 'used.ref.jpg').exists()
+
+    # Удалённая генерация (очистка истории) отпускает свои фото
+    execute("DELETE FROM generations WHERE task_id = 'task-1'")
+    collect()
+    assert tracked() == set()
+    assert not (folder / 'used.png').exists() and not (folder / 'used.ref.jpg').exists()
+
+
+def test_running_batch_holds_its_uploads(uploads, client):
+    folder, upload = uploads
+    upload('batch.png')
+    upload('other.png')
+    response = client.post('/covers/api/batches', json={'items': [
+        {'prompt': 'a', 'image_urls': ['/covers/uploads/batch.png']},
+        {'prompt': 'b', 'image_urls': '/covers/uploads/batch.png|https://img.example/remote.jpg'},
+    ]})
+    batch_id = response.get_json()['batchId']
+
+    collect()
+    assert tracked() == {'batch.png'}
+
+    execute("UPDATE batches SET status = 'done' WHERE id = ?", batch_id)
+    collect()
+    assert tracked() == set() and not (folder / 'batch.png').exists()
+
+
+def test_quota_eviction_skips_active_work(make_app, uploads, client):
+    folder, upload = uploads
+    for name in ('idle.png', 'generating.png', 'finished.png', 'queued.png'):
+        upload(name)
+    add_generation('task-1', ['/covers/uploads/generating.png'])
+    add_generation('task-2', ['/covers/uploads/finished.png', '/covers/uploads/idle.png'], status='completed')
+    client.post('/covers/api/batches', json={'items': [{'prompt': 'a', 'image_urls': ['/covers/uploads/queued.png']}]})
+
+    with make_app(UPLOAD_FOLDER=str(folder), UPLOAD_GLOBAL_QUOTA=0).app_context():
+        collect()
+    assert tracked() == {'generating.png', 'queued.png'}